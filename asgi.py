@@ -0,0 +1,9 @@
+from web import create_app
+from web.longpoll import create_asgi_app
+
+
+app = create_asgi_app(create_app())
+
+
+### TO RUN WITH THE CHAT LONG-POLL ###
+# uvicorn asgi:app --workers 4
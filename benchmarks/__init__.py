@@ -0,0 +1,10 @@
+"""
+Load-testing and benchmark suite for instaclone.
+
+Seeds a database with a synthetic social graph (benchmarks.graph), drives the Flask test client through
+user scenarios (benchmarks.scenarios) and reports latency percentiles, queries per request and memory usage.
+
+usage:
+    python -m benchmarks.run --users 1000 --save
+    python -m benchmarks.run --users 1000 --compare <commit>
+"""
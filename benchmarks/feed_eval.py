@@ -0,0 +1,147 @@
+"""
+Offline evaluation of the ranked home feed (web/ranking.py) on the synthetic graph. For every sampled user a share
+of their likes on pictures of the candidate window is held out - the features are computed as if these likes did
+not exist and the held-out pictures are the ones the user is going to engage with. Orders of the candidates are
+compared by recall@k, NDCG@k and MRR of the held-out pictures:
+
+    chronological   the "latest" feed
+    ranked          score_candidates
+    random          a shuffled window, the floor
+
+Pictures the user liked but which are not held out are left out of all orders. The scoring time per user is
+reported with NumPy and with the pure Python fallback.
+
+usage:
+    python -m benchmarks.feed_eval
+    python -m benchmarks.feed_eval --users 2000 --sample 300 --holdout 0.3 --affinity 0.5
+    python -m benchmarks.feed_eval --half-life 720
+"""
+from .graph import GraphConfig, seed
+from .run import create_benchmark_app
+from web import db
+from web.models import Like
+from web.ranking import candidate_features, score_candidates
+from time import perf_counter
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+
+
+def held_out_case(user_id, rng, holdout):
+    """
+    Features of the user's candidates without a random share of the user's likes on them.
+
+    :return: Tuple (picture IDs, features, set of held-out picture IDs, set of other liked picture IDs) or None if
+        the user liked no candidate.
+    """
+    picture_ids, author_ids, features = candidate_features(user_id)
+    liked = {row.picture_id for row in db.session.query(Like.picture_id).filter(
+        Like.author_id == user_id, Like.picture_id.in_(picture_ids))} if picture_ids else set()
+    if not liked:
+        return None
+    held = set(rng.sample(sorted(liked), max(1, round(len(liked) * holdout))))
+    held_per_author = {}
+    for index, picture_id in enumerate(picture_ids):
+        if picture_id in held:
+            features["likes"][index] = max(features["likes"][index] - 1, 0)
+            held_per_author[author_ids[index]] = held_per_author.get(author_ids[index], 0) + 1
+    features["affinity_likes"] = [max(value - held_per_author.get(author_id, 0), 0)
+                                  for value, author_id in zip(features["affinity_likes"], author_ids)]
+    return picture_ids, features, held, liked - held
+
+
+def metrics(order, held, k_values):
+    """
+    Recall@k and NDCG@k for every k, MRR of the held-out pictures in the order.
+    """
+    positions = [position for position, picture_id in enumerate(order) if picture_id in held]
+    result = {}
+    for k in k_values:
+        hits = [position for position in positions if position < k]
+        ideal = sum(1 / math.log2(position + 2) for position in range(min(len(held), k)))
+        result[f"recall@{k}"] = len(hits) / len(held)
+        result[f"ndcg@{k}"] = sum(1 / math.log2(position + 2) for position in hits) / ideal
+    result["mrr"] = 1 / (positions[0] + 1) if positions else 0.0
+    return result
+
+
+def time_scoring(cases, numpy_enabled):
+    """
+    Milliseconds of score_candidates per user, with NumPy or with the pure Python fallback.
+    """
+    saved = sys.modules.get("numpy")
+    if not numpy_enabled:
+        # importing a module set to None raises ImportError
+        sys.modules["numpy"] = None
+    try:
+        start = perf_counter()
+        for _, features, _, _ in cases:
+            score_candidates(features)
+        return (perf_counter() - start) / len(cases) * 1000
+    finally:
+        if saved is None:
+            sys.modules.pop("numpy", None)
+        else:
+            sys.modules["numpy"] = saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--sample", type=int, default=200, help="evaluated users")
+    parser.add_argument("--holdout", type=float, default=0.3, help="share of the likes held out per user")
+    parser.add_argument("--affinity", type=float, default=0.5,
+                        help="share of likes given by close followers of the author, see GraphConfig")
+    parser.add_argument("--half-life", type=float, help="FEED_HALF_LIFE_HOURS, the application default if not set")
+    args = parser.parse_args()
+
+    app = create_benchmark_app(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'feed_eval.db')}")
+    if args.half_life:
+        app.config["FEED_HALF_LIFE_HOURS"] = args.half_life
+    rng = random.Random(args.seed)
+    k_values = (10, 30)
+    with app.app_context():
+        db.drop_all()
+        graph = seed(GraphConfig(users=args.users, seed=args.seed, follower_like_share=args.affinity))
+        print(f"seeded graph: {graph.counts}")
+        cases = []
+        for user_id in rng.sample(graph.user_ids, len(graph.user_ids)):
+            case = held_out_case(user_id, rng, args.holdout)
+            if case:
+                cases.append(case)
+            if len(cases) == args.sample:
+                break
+        if not cases:
+            print("no user liked a picture of their feed")
+            return
+
+        totals = {order: {} for order in ("chronological", "ranked", "random")}
+        for picture_ids, features, held, known in cases:
+            scores = score_candidates(features)
+            ranked = [picture_id for _, picture_id in sorted(zip(scores, picture_ids), reverse=True)]
+            shuffled = rng.sample(picture_ids, len(picture_ids))
+            for order, ids in (("chronological", picture_ids), ("ranked", ranked), ("random", shuffled)):
+                result = metrics([picture_id for picture_id in ids if picture_id not in known], held, k_values)
+                for name, value in result.items():
+                    totals[order][name] = totals[order].get(name, 0.0) + value
+
+        names = list(totals["ranked"])
+        print(f"{len(cases)} users, {sum(len(case[2]) for case in cases)} held-out likes, "
+              f"{sum(len(case[0]) for case in cases) / len(cases):.0f} candidates per user")
+        print(f"{'order':<16}" + "".join(f"{name:>12}" for name in names))
+        for order, values in totals.items():
+            print(f"{order:<16}" + "".join(f"{values[name] / len(cases):>12.3f}" for name in names))
+        try:
+            import numpy  # noqa: F401
+            print(f"scoring per user: numpy {time_scoring(cases, True):.3f} ms, "
+                  f"python {time_scoring(cases, False):.3f} ms")
+        except ImportError:
+            print(f"scoring per user: python {time_scoring(cases, False):.3f} ms (numpy not installed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Synthetic social graph generator. Rows are created with bulk INSERT statements, bypassing the ORM unit of work, so
+that graphs with tens of thousands of users can be seeded in seconds.
+"""
+from web import db
+from web.models import User, Picture, Comment, Like, Story, Notification, UserMessage, Bookmark, followers
+from web.trending import recompute_scores
+from werkzeug.security import generate_password_hash
+from dataclasses import dataclass, field
+import datetime as dt
+import random
+
+
+PASSWORD = "benchmark"
+PICTURE_FILE = "/static/img/homepage.png"
+BATCH_SIZE = 5000
+
+
+@dataclass
+class GraphConfig:
+    users: int = 1000
+    # followers follow a power law - few users are followed by many, most by a handful
+    pareto_alpha: float = 1.5
+    max_follows: int = 200
+    pictures_per_user: float = 5
+    likes_per_picture: float = 8
+    comments_per_picture: float = 2
+    stories_per_user: float = 0.3
+    messages_per_user: float = 10
+    notifications_per_user: float = 20
+    bookmarks_per_user: float = 10
+    # share (below 1) of the likers of a picture drawn from the author's followers, weighted by how close they are
+    # to the author - 0 draws all likers by popularity, more gives likes a per-author affinity, see feed_eval.py
+    follower_like_share: float = 0.0
+    days: int = 90
+    seed: int = 42
+
+
+@dataclass
+class Graph:
+    """
+    Summary of a seeded graph, used by scenarios to pick interesting users.
+    """
+    config: GraphConfig
+    user_ids: list = field(default_factory=list)
+    # user with the largest number of followed users - the heaviest home feed
+    heavy_user_id: int = None
+    # user with the largest number of followers - the most popular profile
+    popular_user_id: int = None
+    # (user_id, partner_id) with the longest conversation
+    chat_pair: tuple = None
+    # user with the largest number of bookmarks
+    heavy_saver_id: int = None
+    counts: dict = field(default_factory=dict)
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def _timestamp(rng, now, days):
+    return now - dt.timedelta(seconds=rng.randint(0, days * 24 * 3600))
+
+
+def _count(rng, mean):
+    # exponential distribution around the mean, keeps a long tail of very active users
+    return int(rng.expovariate(1 / mean)) if mean > 0 else 0
+
+
+def _reset_sequences():
+    # explicit ids do not advance postgres sequences, move them past the seeded rows
+    if db.engine.dialect.name != "postgresql":
+        return
+    for table in (User.__table__, Picture.__table__, Comment.__table__):
+        db.session.execute(db.text(f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                                   f"(SELECT MAX(id) FROM \"{table.name}\"))"))
+
+
+def seed(config=None):
+    """
+    Creates all tables and fills them with a synthetic graph. Must be called inside an application context with an
+    empty database.
+
+    :param config: GraphConfig, defaults are used if not given.
+    :return: Graph summary.
+    """
+    config = config or GraphConfig()
+    rng = random.Random(config.seed)
+    now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    db.create_all()
+    graph = Graph(config=config)
+
+    # users - one password hash shared by all users, hashing is the slowest part otherwise
+    password = generate_password_hash(PASSWORD, method="sha256")
+    users = [{"id": i, "email": f"user{i}@bench.example.com", "username": f"user{i}", "password": password,
+              "description": f"benchmark user {i}", "avatar": "/static/img/default-user.png",
+              "date_created": _timestamp(rng, now, config.days), "not_recommend": False,
+              "last_message_sent_time": now - dt.timedelta(days=1)}
+             for i in range(1, config.users + 1)]
+    _insert(User.__table__, users)
+    graph.user_ids = [user["id"] for user in users]
+
+    # followers - popularity weights drawn from a pareto distribution, follow counts as well
+    popularity = [rng.paretovariate(config.pareto_alpha) for _ in graph.user_ids]
+    follow_rows = []
+    followed_count = {}
+    follower_count = {}
+    # followers of every author with their closeness, only with follower_like_share
+    close_followers = {}
+    for user_id in graph.user_ids:
+        wanted = min(int(rng.paretovariate(config.pareto_alpha) * 3), config.max_follows, config.users - 1)
+        targets = set(rng.choices(graph.user_ids, weights=popularity, k=wanted))
+        targets.discard(user_id)
+        for target in targets:
+            follow_rows.append({"follower_id": user_id, "followed_id": target})
+            follower_count[target] = follower_count.get(target, 0) + 1
+            if config.follower_like_share:
+                close_followers.setdefault(target, []).append((user_id, rng.paretovariate(config.pareto_alpha)))
+        followed_count[user_id] = len(targets)
+    _insert(followers, follow_rows)
+    graph.heavy_user_id = max(followed_count, key=followed_count.get)
+    graph.popular_user_id = max(follower_count, key=follower_count.get)
+
+    # pictures - popular users post more
+    pictures = []
+    for user_id, weight in zip(graph.user_ids, popularity):
+        for _ in range(_count(rng, config.pictures_per_user * min(weight, 5))):
+            pictures.append({"id": len(pictures) + 1, "author_id": user_id, "description": "synthetic picture",
+                             "location": "", "file": PICTURE_FILE, "private": rng.random() < 0.05,
+                             "date_created": _timestamp(rng, now, config.days)})
+    _insert(Picture.__table__, pictures)
+
+    # likes and comments on pictures, likers are drawn by popularity as well
+    likes = []
+    comments = []
+    for picture in pictures:
+        likers = set(rng.choices(graph.user_ids, weights=popularity, k=_count(rng, config.likes_per_picture)))
+        if config.follower_like_share and close_followers.get(picture["author_id"]):
+            fans, closeness = zip(*close_followers[picture["author_id"]])
+            wanted = round(len(likers) * config.follower_like_share / (1 - config.follower_like_share))
+            likers.update(rng.choices(fans, weights=closeness, k=wanted))
+        for liker in likers:
+            likes.append({"author_id": liker, "picture_id": picture["id"], "comment_id": None,
+                          "date_created": picture["date_created"]})
+        for _ in range(_count(rng, config.comments_per_picture)):
+            comments.append({"id": len(comments) + 1, "author_id": rng.choice(graph.user_ids),
+                             "picture_id": picture["id"], "text": "synthetic comment", "deleted": False,
+                             "date_created": picture["date_created"]})
+    _insert(Comment.__table__, comments)
+    for comment in comments:
+        if rng.random() < 0.3:
+            likes.append({"author_id": rng.choice(graph.user_ids), "picture_id": None, "comment_id": comment["id"],
+                          "date_created": comment["date_created"]})
+    _insert(Like.__table__, likes)
+    Comment.recount_likes()
+    Picture.recount_likes()
+    recompute_scores()
+
+    # bookmarks - a few heavy savers keep thousands of pictures
+    bookmarks = []
+    saved_count = {}
+    for user_id in graph.user_ids:
+        saved = {rng.randrange(len(pictures)) + 1 for _ in range(min(_count(rng, config.bookmarks_per_user),
+                                                                     len(pictures)))}
+        bookmarks.extend({"user_id": user_id, "picture_id": picture_id,
+                          "created_at": _timestamp(rng, now, config.days)} for picture_id in saved)
+        saved_count[user_id] = len(saved)
+    _insert(Bookmark.__table__, bookmarks)
+    graph.heavy_saver_id = max(saved_count, key=saved_count.get)
+
+    # stories - posted within the last 12 hours so that none of them expires during a benchmark run
+    stories = [{"author_id": user_id, "file": PICTURE_FILE, "time_span": 24,
+                "date_created": now - dt.timedelta(minutes=rng.randint(0, 12 * 60))}
+               for user_id in graph.user_ids for _ in range(_count(rng, config.stories_per_user))]
+    _insert(Story.__table__, stories)
+
+    # messages - conversations between followers
+    messages = []
+    conversations = {}
+    for row in rng.sample(follow_rows, min(len(follow_rows), config.users)):
+        pair = (row["follower_id"], row["followed_id"])
+        for _ in range(_count(rng, config.messages_per_user)):
+            sender, recipient = pair if rng.random() < 0.5 else pair[::-1]
+            messages.append({"sender_id": sender, "recipient_id": recipient, "body": "synthetic message",
+                             "seen": rng.random() < 0.9, "timestamp": _timestamp(rng, now, config.days)})
+            conversations[pair] = conversations.get(pair, 0) + 1
+    messages.sort(key=lambda message: message["timestamp"])
+    _insert(UserMessage.__table__, messages)
+    graph.chat_pair = max(conversations, key=conversations.get) if conversations else (1, 2)
+
+    # notifications
+    notifications = [{"sender_id": rng.choice(graph.user_ids), "recipient_id": user_id, "type": "like",
+                      "body": "synthetic notification", "link": "/home",
+                      "timestamp": _timestamp(rng, now, config.days)}
+                     for user_id in graph.user_ids for _ in range(_count(rng, config.notifications_per_user))]
+    _insert(Notification.__table__, notifications)
+
+    _reset_sequences()
+    db.session.commit()
+    graph.counts = {"users": len(users), "followers": len(follow_rows), "pictures": len(pictures),
+                    "comments": len(comments), "likes": len(likes), "bookmarks": len(bookmarks),
+                    "stories": len(stories), "messages": len(messages), "notifications": len(notifications)}
+    return graph
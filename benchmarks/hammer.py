@@ -0,0 +1,143 @@
+"""
+Concurrency check of likes, two assertions in turn:
+- double-click: all threads like a new picture at once as one user - the picture ends with exactly one like and its
+  write-behind like count (see web/counters.py) is 1 once flushed and folded
+- mixed: many threads like (and double-click) one picture at the same time, several threads share a user and the odd
+  ones unlike at the end - every user has at most one like, the picture has exactly one like per user whose last
+  action was "like" and its like count matches its likes
+The script exits with status 1 if an assertion fails or any request failed.
+
+usage:
+    python -m benchmarks.hammer
+    python -m benchmarks.hammer --db postgresql://localhost/instaclone_bench --threads 64 --users 16
+"""
+from .graph import GraphConfig, seed
+from .run import create_benchmark_app
+from .scenarios import Recorder
+from web import db
+from web.models import Like, Picture
+from web.counters import flush_likes, fold_likes
+from threading import Barrier, Thread
+from time import perf_counter
+import argparse
+import os
+import sys
+import tempfile
+
+
+def hammer(app, picture_id, user_ids, threads, clicks, unlike=True):
+    """
+    Starts all threads at once, each one clicks like `clicks` times, with `unlike` the odd ones unlike at the end.
+
+    :return: Tuple (expected likers, number of failed requests, requests per second)
+    """
+    barrier = Barrier(threads)
+    benches = []
+
+    def worker(index):
+        bench = Recorder(app)
+        bench.login(user_ids[index % len(user_ids)])
+        benches.append(bench)
+        barrier.wait()
+        for _ in range(clicks):
+            bench.get(f"/like-picture/{picture_id}", referrer=f"/picture/{picture_id}", htmx=True)
+        if unlike and index % 2:
+            bench.get(f"/unlike-picture/{picture_id}", referrer=f"/picture/{picture_id}", htmx=True)
+
+    workers = [Thread(target=worker, args=(index,)) for index in range(threads)]
+    started = perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = perf_counter() - started
+    # a user shared by several threads ends liked if any of its threads did not unlike - the last write wins only
+    # per thread, so only users whose threads all agree are checked exactly
+    last_action = {}
+    for index in range(threads):
+        last_action.setdefault(user_ids[index % len(user_ids)], set()).add("unlike" if unlike and index % 2 else "like")
+    requests = sum(len(bench.latencies) for bench in benches)
+    errors = sum(bench.errors for bench in benches)
+    return last_action, errors, requests / elapsed
+
+
+def check_double_click(app, user_id, threads, clicks):
+    """
+    All threads like a new picture at the same time as one user.
+
+    :return: Requests per second.
+    """
+    with app.app_context():
+        picture = Picture(description="hammer", file="/static/img/homepage.png", author_id=user_id)
+        db.session.add(picture)
+        db.session.commit()
+        picture_id = picture.id
+    _, errors, throughput = hammer(app, picture_id, [user_id], threads, clicks, unlike=False)
+    with app.app_context():
+        flush_likes()
+        fold_likes()
+        likes = Like.query.filter_by(picture_id=picture_id).count()
+        like_total = db.session.get(Picture, picture_id).like_total
+    assert errors == 0, f"double-click: {errors} failed requests"
+    assert likes == 1, f"double-click: {likes} likes of one user"
+    assert like_total == 1, f"double-click: like count {like_total} instead of 1"
+    return throughput
+
+
+def check_mixed(app, picture_id, user_ids, threads, clicks):
+    """
+    Threads of several users like and unlike one picture at the same time.
+
+    :return: Tuple (number of likes of the users, requests per second).
+    """
+    last_action, errors, throughput = hammer(app, picture_id, user_ids, threads, clicks)
+    with app.app_context():
+        likes = db.session.query(Like.author_id, db.func.count(Like.id)).filter(
+            Like.picture_id == picture_id, Like.author_id.in_(user_ids)).group_by(Like.author_id).all()
+        # journaled likes not flushed by the periodic threads yet
+        flush_likes()
+        fold_likes()
+        like_total = db.session.get(Picture, picture_id).like_total
+        total = Like.query.filter_by(picture_id=picture_id).count()
+    assert errors == 0, f"mixed: {errors} failed requests"
+    duplicates = [author_id for author_id, count in likes if count > 1]
+    assert not duplicates, f"mixed: duplicate likes of users {duplicates}"
+    liked = {author_id for author_id, count in likes}
+    for user_id, actions in last_action.items():
+        assert actions != {"like"} or user_id in liked, f"mixed: user {user_id} liked but has no like"
+        assert actions != {"unlike"} or user_id not in liked, f"mixed: user {user_id} unliked but still has a like"
+    assert like_total == total, f"mixed: like count {like_total} does not match {total} likes"
+    return len(liked), throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="database URI, defaults to a temporary SQLite file")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--users", type=int, default=8, help="distinct users shared by the threads")
+    parser.add_argument("--clicks", type=int, default=5, help="like requests per thread")
+    args = parser.parse_args()
+
+    database_uri = args.db or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'hammer.db')}"
+    app = create_benchmark_app(database_uri)
+    with app.app_context():
+        db.drop_all()
+        graph = seed(GraphConfig(users=max(args.users, 50), seed=7))
+        picture_id = db.session.query(Picture.id).filter(Picture.private.is_(False)).order_by(Picture.id).limit(
+            1).scalar()
+        user_ids = graph.user_ids[-args.users:]
+        Like.query.filter(Like.picture_id == picture_id, Like.author_id.in_(user_ids)).delete()
+        db.session.commit()
+
+    try:
+        throughput = check_double_click(app, user_ids[0], args.threads, args.clicks)
+        print(f"double-click: {args.threads} threads, 1 user, {throughput:.0f} requests/s, 1 like")
+        liked, throughput = check_mixed(app, picture_id, user_ids, args.threads, args.clicks)
+        print(f"mixed: {args.threads} threads, {len(user_ids)} users, {throughput:.0f} requests/s, {liked} likes")
+    except AssertionError as error:
+        print(error)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Idle chat windows served by WSGI short polling and by the ASGI long-poll (web/longpoll.py). Every client keeps one
+conversation open for --seconds without a change, then its partner sends a message. Reported per mode: requests,
+SQL statements of the idle period, delay until the message reached the clients, peak memory and the number of
+threads. The ASGI delay includes rendering the chat of every client, WSGI delays are the simulated poll delays only.
+
+WSGI clients follow their pollers in simulated time (the delays computed by web/polling.py), ASGI clients are held
+on the event loop in real time - the ASGI mode needs a2wsgi.
+
+usage:
+    python -m benchmarks.longpoll
+    python -m benchmarks.longpoll --clients 1000 --seconds 10
+"""
+from .graph import GraphConfig, seed
+from .run import create_benchmark_app, percentile
+from .scenarios import Recorder, _POLLER
+from web import db
+from web.helpers import conversation_states
+from web.models import UserMessage
+from html import unescape
+from sqlalchemy import event
+from time import perf_counter
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import tracemalloc
+
+
+def open_clients(app, graph, clients):
+    """
+    Logs in a client for each conversation (user i chatting with user i+1).
+
+    :return: List of (Recorder, user ID, partner ID).
+    """
+    opened = []
+    for user_id, partner_id in zip(graph.user_ids[:clients], graph.user_ids[1:clients + 1]):
+        bench = Recorder(app)
+        bench.login(user_id)
+        opened.append((bench, user_id, partner_id))
+    return opened
+
+
+def send_messages(app, opened):
+    with app.app_context():
+        for _, user_id, partner_id in opened:
+            db.session.add(UserMessage(sender_id=partner_id, recipient_id=user_id, body="wake up"))
+        db.session.commit()
+
+
+class StatementCounter(object):
+    """
+    Counts SQL statements of all threads while enabled.
+    """
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def run_wsgi(app, opened, seconds, counter):
+    """
+    Short polling - every client opens its chat window and follows the message poller. The message is sent after
+    `seconds` and delivered with the first poll after that.
+    """
+    tracemalloc.start()
+    due = {}
+    for bench, user_id, partner_id in opened:
+        html = bench.get(f"/chat/{partner_id}").get_data(as_text=True)
+        for poller_id, url, delay in _POLLER.findall(html):
+            if poller_id == "message-poll":
+                due[user_id] = (float(delay), unescape(url), bench)
+    counter.count = 0
+    requests = 0
+    delays = []
+    for user_id, (now, url, bench) in due.items():
+        while now <= seconds:
+            html = bench.get(url, referrer="/chat", htmx=True).get_data(as_text=True)
+            requests += 1
+            poller_id, url, delay = _POLLER.findall(html)[0]
+            now, url = now + float(delay), unescape(url)
+        delays.append(now - seconds)
+    statements = counter.count
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"mode": "wsgi", "requests": requests, "statements": statements, "p50_s": round(percentile(delays, 50), 3),
+            "p95_s": round(percentile(delays, 95), 3), "peak_memory_kb": round(peak / 1024, 1),
+            "threads": threading.active_count()}
+
+
+def run_asgi(app, opened, seconds, counter):
+    """
+    Long-poll - every client waits in the ASGI application until the message arrives.
+    """
+    from web.longpoll import create_asgi_app
+    application = create_asgi_app(app)
+    app.config["LONG_POLL_SECONDS"] = seconds * 10
+    with app.app_context():
+        states = conversation_states([(user_id, partner_id) for _, user_id, partner_id in opened])
+
+    async def client(bench, user_id, partner_id, delivered):
+        latest_id, read_id = states[(user_id, partner_id)]
+        cookie = "; ".join(f"{cookie.name}={cookie.value}" for cookie in bench.client.cookie_jar)
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": f"/refresh-messages/{partner_id}", "raw_path": b"", "root_path": "",
+                 "query_string": f"after={latest_id}&seen={read_id}&wait=1".encode(), "server": ("localhost", 80),
+                 "client": ("127.0.0.1", 1), "headers": [(b"host", b"localhost"), (b"cookie", cookie.encode()),
+                                                         (b"hx-request", b"true")]}
+        status = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+
+        await application(scope, receive, send)
+        delivered.append((perf_counter(), status[0]))
+
+    async def wait_and_send():
+        delivered = []
+        tasks = [asyncio.create_task(client(bench, user_id, partner_id, delivered))
+                 for bench, user_id, partner_id in opened]
+        await asyncio.sleep(seconds)
+        threads, statements = threading.active_count(), counter.count
+        sent = perf_counter()
+        await asyncio.to_thread(send_messages, app, opened)
+        await asyncio.gather(*tasks)
+        return delivered, sent, threads, statements
+
+    tracemalloc.start()
+    counter.count = 0
+    delivered, sent, threads, statements = asyncio.run(wait_and_send())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    delays = [at - sent for at, _ in delivered]
+    return {"mode": "asgi", "requests": len(delivered), "statements": statements,
+            "p50_s": round(percentile(delays, 50), 3), "p95_s": round(percentile(delays, 95), 3),
+            "peak_memory_kb": round(peak / 1024, 1), "threads": threads,
+            "errors": sum(1 for _, status in delivered if status >= 400)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="database URI, defaults to a temporary SQLite file")
+    parser.add_argument("--clients", type=int, default=200, help="open chat windows")
+    parser.add_argument("--seconds", type=float, default=5, help="idle time before the message is sent")
+    parser.add_argument("--modes", default="wsgi,asgi")
+    args = parser.parse_args()
+
+    database_uri = args.db or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'longpoll.db')}"
+    app = create_benchmark_app(database_uri)
+    with app.app_context():
+        db.drop_all()
+        graph = seed(GraphConfig(users=args.clients + 1, seed=11))
+        counter = StatementCounter(db.engine)
+
+    columns = ("requests", "statements", "p50_s", "p95_s", "peak_memory_kb", "threads")
+    print(f"{args.clients} clients idle for {args.seconds} s")
+    print(f"{'mode':<10}" + "".join(f"{column:>16}" for column in columns))
+    for mode in args.modes.split(","):
+        opened = open_clients(app, graph, args.clients)
+        result = (run_wsgi if mode == "wsgi" else run_asgi)(app, opened, args.seconds, counter)
+        print(f"{mode:<10}" + "".join(f"{result[column]:>16}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
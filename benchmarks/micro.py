@@ -0,0 +1,129 @@
+"""
+Micro-benchmarks of the hot helper functions at several graph sizes. Besides timing, every function is checked for
+its number of SQL statements - it must not grow with the size of the graph. The script exits with status 1 if any
+function breaks this bound, so it can guard these paths in CI.
+
+usage:
+    python -m benchmarks.micro
+    python -m benchmarks.micro --sizes 1000,10000 --repeat 10
+"""
+from .graph import GraphConfig, seed
+from .run import create_benchmark_app
+from .scenarios import Recorder
+from web import db
+from web.models import User, Picture, Like
+from web.helpers import followed_posts, followed_stories, recommended_by_followed, recommended_follow_you
+from web.profiler import RequestProfile
+from flask import g
+from flask_login import login_user
+from time import perf_counter
+import argparse
+import os
+import sys
+import tempfile
+
+
+def graph_config(rows, seed_value):
+    """
+    Graph with roughly the given number of rows over all tables - about 20 rows per user.
+    """
+    return GraphConfig(users=max(50, rows // 20), pictures_per_user=1.5, likes_per_picture=3, comments_per_picture=1,
+                       stories_per_user=0.2, messages_per_user=2, notifications_per_user=2, seed=seed_value)
+
+
+def most_liked_picture_id():
+    return db.session.query(Like.picture_id).filter(Like.picture_id.isnot(None)).group_by(Like.picture_id).order_by(
+        db.func.count(Like.id).desc()).limit(1).scalar()
+
+
+def measure(app, user_id, function, repeat):
+    """
+    Calls the function in a fresh request context as the given user.
+
+    :return: Tuple (number of SQL statements of the first call, list of durations in seconds)
+    """
+    queries = None
+    durations = []
+    for _ in range(repeat):
+        with app.test_request_context():
+            login_user(db.session.get(User, user_id))
+            g._profile = RequestProfile()
+            started = perf_counter()
+            function()
+            durations.append(perf_counter() - started)
+            if queries is None:
+                queries = g._profile.query_count
+    return queries, durations
+
+
+def measure_view(app, user_id, url, repeat):
+    bench = Recorder(app)
+    bench.login(user_id)
+    for _ in range(repeat):
+        bench.get(url)
+    return bench.queries[0], bench.latencies
+
+
+def run_size(rows, repeat, seed_value):
+    database_uri = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'micro.db')}"
+    app = create_benchmark_app(database_uri)
+    with app.app_context():
+        graph = seed(graph_config(rows, seed_value))
+        picture_id = most_liked_picture_id()
+    user_id = graph.heavy_user_id
+
+    def mutual_likes():
+        db.session.get(Picture, picture_id).mutual_likes()
+
+    def new_notifications():
+        db.session.get(User, user_id).new_notifications()
+
+    def new_messages():
+        db.session.get(User, user_id).new_messages()
+
+    cases = {
+        "followed_posts": followed_posts,
+        "followed_stories": followed_stories,
+        "recommended_by_followed": recommended_by_followed,
+        "recommended_follow_you": recommended_follow_you,
+        "Picture.mutual_likes": mutual_likes,
+        "User.new_notifications": new_notifications,
+        "User.new_messages": new_messages,
+    }
+    results = {name: measure(app, user_id, function, repeat) for name, function in cases.items()}
+    results["views.chat_central"] = measure_view(app, user_id, "/chat-central", repeat)
+    return graph.counts, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated graph sizes in rows")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=GraphConfig.seed)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    by_size = {}
+    for size in sizes:
+        counts, by_size[size] = run_size(size, args.repeat, args.seed)
+        print(f"size {size}: {sum(counts.values())} rows {counts}")
+
+    print(f"{'function':<26}" + "".join(f"{f'{size} rows':>26}" for size in sizes))
+    failed = []
+    for name in by_size[sizes[0]]:
+        line = f"{name:<26}"
+        for size in sizes:
+            queries, durations = by_size[size][name]
+            line += f"{f'{min(durations) * 1000:.2f} ms / {queries} q':>26}"
+        print(line)
+        # complexity bound - the number of statements must not grow with the graph
+        baseline = by_size[sizes[0]][name][0]
+        if any(by_size[size][name][0] > baseline for size in sizes[1:]):
+            failed.append(name)
+    if failed:
+        print(f"query count grows with graph size: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
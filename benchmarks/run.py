@@ -0,0 +1,151 @@
+"""
+Seeds a synthetic graph, runs the scenarios and reports p50/p95/p99 latency, queries per request and peak memory.
+Results are stored in benchmarks/results/<commit>.json and can be compared with the results of another commit.
+
+WARNING: all tables of the --db database are dropped before seeding.
+"""
+from .graph import GraphConfig, seed
+from .scenarios import Recorder, SCENARIOS
+from web import create_app, db
+import argparse
+import datetime as dt
+import json
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile.
+
+    :param values: List of numbers.
+    :param percent: Percentile between 0 and 100.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def create_benchmark_app(database_uri, replica_uris=()):
+    """
+    Creates the application with the request profiler enabled - the number of queries is read from its
+    Server-Timing header.
+    """
+    return create_app({"SQLALCHEMY_DATABASE_URI": database_uri,
+                       "DB_REPLICA_URIS": list(replica_uris),
+                       "PROFILER_ENABLED": True,
+                       "WTF_CSRF_ENABLED": False,
+                       "MAIL_TRANSPORT": "memory"})
+
+
+def copy_sqlite(database_uri, index):
+    """
+    Copies the seeded SQLite database as a read replica - it does not replicate later writes, like a lagging replica.
+
+    :return: URI of the copy.
+    """
+    path = database_uri[len("sqlite:///"):]
+    replica = f"{os.path.splitext(path)[0]}-replica{index}.db"
+    shutil.copyfile(path, replica)
+    return f"sqlite:///{replica}"
+
+
+def run_scenario(app, graph, name, rounds):
+    bench = Recorder(app)
+    tracemalloc.start()
+    for _ in range(rounds):
+        SCENARIOS[name](bench, graph)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = [latency * 1000 for latency in bench.latencies]
+    return {
+        "requests": len(latencies),
+        "errors": bench.errors,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "queries_per_request": round(sum(bench.queries) / len(bench.queries), 2) if bench.queries else 0,
+        "max_queries": max(bench.queries, default=0),
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def print_report(results, baseline=None):
+    columns = ("p50_ms", "p95_ms", "p99_ms", "queries_per_request", "max_queries", "peak_memory_kb")
+    print(f"{'scenario':<20}" + "".join(f"{column:>22}" for column in columns))
+    for name, result in results["scenarios"].items():
+        line = f"{name:<20}"
+        for column in columns:
+            value = result[column]
+            cell = f"{value}"
+            if baseline and name in baseline["scenarios"]:
+                before = baseline["scenarios"][name][column]
+                if before:
+                    cell += f" ({(value - before) / before * 100:+.0f}%)"
+            line += f"{cell:>22}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="database URI, defaults to a temporary SQLite file")
+    parser.add_argument("--users", type=int, default=GraphConfig.users)
+    parser.add_argument("--seed", type=int, default=GraphConfig.seed)
+    parser.add_argument("--rounds", type=int, default=3, help="how many times each scenario is repeated")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenario names")
+    parser.add_argument("--save", action="store_true", help="store results in benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", help="commit (or path to a results file) to compare with")
+    parser.add_argument("--replica", action="append", default=[],
+                        help='read replica URI, repeatable - "copy" copies the seeded SQLite database')
+    args = parser.parse_args()
+
+    database_uri = args.db or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    app = create_benchmark_app(database_uri)
+    with app.app_context():
+        db.drop_all()
+        graph = seed(GraphConfig(users=args.users, seed=args.seed))
+    print(f"seeded graph: {graph.counts}")
+    if args.replica:
+        replicas = [copy_sqlite(database_uri, index) if uri == "copy" else uri
+                    for index, uri in enumerate(args.replica)]
+        app = create_benchmark_app(database_uri, replicas)
+
+    results = {"commit": current_commit(), "date": dt.datetime.now().isoformat(timespec="seconds"),
+               "database": database_uri.split(":")[0],
+               "counts": graph.counts, "scenarios": {}}
+    for name in args.scenarios.split(","):
+        results["scenarios"][name] = run_scenario(app, graph, name, args.rounds)
+
+    baseline = None
+    if args.compare:
+        path = args.compare if os.path.exists(args.compare) else os.path.join(RESULTS_DIR, f"{args.compare}.json")
+        with open(path) as file:
+            baseline = json.load(file)
+        print(f"compared with {baseline['commit']} ({baseline['date']})")
+    print_report(results, baseline)
+
+    if args.save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
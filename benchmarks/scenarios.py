@@ -0,0 +1,170 @@
+"""
+User scenarios driven through the Flask test client. Every scenario logs in as a user of the synthetic graph and
+issues the same requests the browser (and HTMX) would issue.
+"""
+from .graph import PASSWORD
+from time import perf_counter
+from html import unescape
+import re
+
+
+_QUERIES = re.compile(r'db;dur=[\d.]+;desc="(\d+) queries"')
+# URL of the next page requested by the last gallery tile
+_NEXT_PAGE = re.compile(r'hx-get="(/load-page/[^"]+)"')
+# HTMX pollers, each response renders the poller again with the next URL and delay - see web/polling.py
+_POLLER = re.compile(r'id="([\w-]+-poll)"\s+hx-get="([^"]+)"\s+hx-trigger="load delay:([\d.]+)s"')
+
+
+class Recorder(object):
+    """
+    Wraps the test client, measures latency of every request and reads the number of SQL statements from the
+    Server-Timing header set by web.profiler.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+
+    def login(self, user_id):
+        self.client.get("/logout")
+        self.client.post("/login", data={"email": f"user{user_id}@bench.example.com", "password": PASSWORD})
+
+    def get(self, url, referrer="/home", htmx=False, headers=None):
+        headers = {"Referer": f"http://localhost{referrer}", **(headers or {})}
+        if htmx:
+            headers["HX-Request"] = "true"
+        started = perf_counter()
+        response = self.client.get(url, headers=headers)
+        self.latencies.append(perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors += 1
+        match = _QUERIES.search(response.headers.get("Server-Timing", ""))
+        if match:
+            self.queries.append(int(match.group(1)))
+        return response
+
+
+### SCENARIOS ###
+def home_feed_scroll(bench, graph, steps=10):
+    """
+    Opens the home page of the user following the most users and scrolls the feed.
+    """
+    user_id = graph.heavy_user_id
+    bench.login(user_id)
+    bench.get("/home")
+    for page in range(0, steps * 6, 6):
+        bench.get(f"/load-page/{user_id}/{page}", referrer="/home", htmx=True)
+
+
+def profile_paging(bench, graph, steps=10):
+    """
+    Opens the profile with the most followers and scrolls the gallery.
+    """
+    user_id = graph.popular_user_id
+    bench.login(graph.heavy_user_id)
+    bench.get(f"/profile/{user_id}")
+    for page in range(0, steps * 6, 6):
+        bench.get(f"/load-page/{user_id}/{page}", referrer=f"/profile/{user_id}", htmx=True)
+
+
+def bookmarks_paging(bench, graph, steps=10):
+    """
+    Opens the saved posts of the user with the most bookmarks and scrolls them, following the keyset cursor.
+    """
+    user_id = graph.heavy_saver_id
+    bench.login(user_id)
+    response = bench.get(f"/bookmarked/{user_id}")
+    for _ in range(steps):
+        match = _NEXT_PAGE.search(response.get_data(as_text=True))
+        if not match:
+            break
+        response = bench.get(unescape(match.group(1)), referrer=f"/bookmarked/{user_id}", htmx=True)
+
+
+def explore_paging(bench, graph, steps=10):
+    """
+    Opens the explore page and scrolls the trending pictures, following the keyset cursor.
+    """
+    bench.login(graph.heavy_user_id)
+    response = bench.get("/explore")
+    for _ in range(steps):
+        match = _NEXT_PAGE.search(response.get_data(as_text=True))
+        if not match:
+            break
+        response = bench.get(unescape(match.group(1)), referrer="/explore", htmx=True)
+
+
+def api_feed_scroll(bench, graph, steps=10):
+    """
+    Scrolls the home feed of the user following the most users through the JSON API like the mobile client - a page
+    of pictures with their authors and like states per request, following the cursor.
+    """
+    user_id = graph.heavy_user_id
+    response = bench.client.post("/api/v1/tokens", json={"email": f"user{user_id}@bench.example.com",
+                                                         "password": PASSWORD})
+    headers = {"Authorization": f"Bearer {response.json['token']}"}
+    fields = "id,file,description,author,like_count,liked"
+    cursor = ""
+    for _ in range(steps):
+        response = bench.get(f"/api/v1/feed?limit=6&fields={fields}&cursor={cursor}", headers=headers)
+        cursor = response.json["next_cursor"] if response.status_code == 200 else None
+        if not cursor:
+            break
+
+
+def chat_polling(bench, graph, seconds=120):
+    """
+    Opens the longest conversation and follows its pollers like the browser does - the chat window and the navbar
+    icons - for the given number of simulated seconds without new messages. Idle pollers back off, so the number of
+    requests shows how much load an open tab generates.
+    """
+    user_id, partner_id = graph.chat_pair
+    bench.login(user_id)
+    bench.get("/chat-central")
+    response = bench.get(f"/chat/{partner_id}")
+    # due time of every poller in simulated seconds
+    due = {poller_id: (float(delay), unescape(url)) for poller_id, url, delay in
+           _POLLER.findall(response.get_data(as_text=True))}
+    while due:
+        poller_id, (now, url) = min(due.items(), key=lambda item: item[1][0])
+        if now > seconds:
+            break
+        response = bench.get(url, referrer=f"/chat/{partner_id}", htmx=True)
+        for found_id, url, delay in _POLLER.findall(response.get_data(as_text=True)):
+            due[found_id] = (now + float(delay), unescape(url))
+
+
+def search(bench, graph, steps=10):
+    """
+    Searches for users page by page.
+    """
+    bench.login(graph.heavy_user_id)
+    for page in range(1, steps + 1):
+        bench.get(f"/search?q=user&page={page}")
+
+
+def follow_churn(bench, graph, steps=10):
+    """
+    Follows and unfollows users from their profile header.
+    """
+    user_id = graph.heavy_user_id
+    bench.login(user_id)
+    targets = [target for target in graph.user_ids if target != user_id][:steps]
+    for target in targets:
+        # twice - follow and unfollow again, the graph stays the same for the next round
+        bench.get(f"/follow/{target}/{target}", referrer=f"/profile/{target}", htmx=True)
+        bench.get(f"/follow/{target}/{target}", referrer=f"/profile/{target}", htmx=True)
+
+
+SCENARIOS = {
+    "home_feed_scroll": home_feed_scroll,
+    "profile_paging": profile_paging,
+    "bookmarks_paging": bookmarks_paging,
+    "explore_paging": explore_paging,
+    "api_feed_scroll": api_feed_scroll,
+    "chat_polling": chat_polling,
+    "search": search,
+    "follow_churn": follow_churn,
+}
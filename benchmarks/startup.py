@@ -0,0 +1,135 @@
+"""
+Worker start-up cost per phase: importing the web package module by module, every init_* step of create_app,
+db.create_all, the first request and the warm-up of web/startup.py. Every mode runs in a fresh interpreter, like a
+new worker:
+
+    baseline   DB_CREATE_ALL=1, templates compiled on first use
+    fast       DB_CREATE_ALL=0, TEMPLATE_CACHE_DIR filled by a previous start
+
+usage:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 5 --importtime
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+# optional integrations that should not be imported by a worker start
+LAZY_MODULES = ("elasticsearch", "tinify", "timeago", "requests", "prometheus_client", "redis", "maxminddb")
+
+
+def start(database_uri, create_all, template_cache):
+    """
+    Starts the application in this interpreter and times its phases, called in a child process.
+
+    :return: Dictionary of phase name to seconds, and the optional modules imported by the start.
+    """
+    from time import perf_counter
+    import importlib
+    import pkgutil
+    phases = {}
+    started = perf_counter()
+    import web
+    phases["import web"] = perf_counter() - started
+    for module in pkgutil.iter_modules(web.__path__):
+        begin = perf_counter()
+        importlib.import_module(f"web.{module.name}")
+        phases[f"import web.{module.name}"] = perf_counter() - begin
+    phases["import total"] = perf_counter() - started
+
+    def timed(name, function):
+        def wrapper(*args, **kwargs):
+            begin = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                phases[name] = phases.get(name, 0) + perf_counter() - begin
+        return wrapper
+
+    for name, module in list(sys.modules.items()):
+        if name.startswith("web.") and module is not None:
+            for attribute in dir(module):
+                if attribute.startswith("init_") and getattr(getattr(module, attribute), "__module__", "") == name:
+                    setattr(module, attribute, timed(attribute, getattr(module, attribute)))
+    web.db.create_all = timed("db.create_all", web.db.create_all)
+
+    begin = perf_counter()
+    app = web.create_app({"SQLALCHEMY_DATABASE_URI": database_uri, "DB_CREATE_ALL": create_all,
+                          "TEMPLATE_CACHE_DIR": template_cache, "MAIL_TRANSPORT": "memory", "TASKS_EAGER": True})
+    phases["create_app"] = perf_counter() - begin
+    client = app.test_client()
+    begin = perf_counter()
+    client.get("/login")
+    phases["first request"] = perf_counter() - begin
+    begin = perf_counter()
+    client.get("/login")
+    phases["second request"] = perf_counter() - begin
+    from web.startup import warm_up
+    phases["warm_up"] = warm_up(app)
+    phases["total"] = perf_counter() - started
+    return {"phases": phases, "lazy_imported": [name for name in LAZY_MODULES if name in sys.modules]}
+
+
+def run_child(database_uri, create_all, template_cache):
+    output = subprocess.check_output(
+        [sys.executable, "-m", "benchmarks.startup", "--child", json.dumps([database_uri, create_all, template_cache])],
+        text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(output.splitlines()[-1])
+
+
+def import_times(top):
+    """
+    The slowest modules imported by "import web" (cumulative microseconds, python -X importtime).
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import web"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="database URI with the schema, defaults to a temporary SQLite file")
+    parser.add_argument("--runs", type=int, default=3, help="starts per mode, the median is reported")
+    parser.add_argument("--importtime", action="store_true", help="also list the slowest imports")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(start(*json.loads(args.child))))
+        return
+    # imported only here, benchmarks.run imports the web package the child processes measure
+    from .run import percentile
+
+    directory = tempfile.mkdtemp()
+    database_uri = args.db or f"sqlite:///{os.path.join(directory, 'startup.db')}"
+    template_cache = os.path.join(directory, "templates")
+    # creates the schema and fills the template cache, like the previous start of a deployment
+    run_child(database_uri, True, template_cache)
+
+    modes = {"baseline": (True, None), "fast": (False, template_cache)}
+    results = {mode: [run_child(database_uri, *options) for _ in range(args.runs)] for mode, options in modes.items()}
+    names = list(results["baseline"][0]["phases"])
+    print(f"median of {args.runs} starts, ms")
+    print(f"{'phase':<28}" + "".join(f"{mode:>12}" for mode in modes))
+    for name in names:
+        medians = [percentile([run["phases"].get(name, 0) * 1000 for run in results[mode]], 50) for mode in modes]
+        if max(medians) >= 0.1:
+            print(f"{name:<28}" + "".join(f"{median:>12.1f}" for median in medians))
+    for mode in modes:
+        print(f"{mode}: optional modules imported on start: {', '.join(results[mode][0]['lazy_imported']) or '-'}")
+    if args.importtime:
+        print("\nslowest imports of 'import web', cumulative ms")
+        for microseconds, module in import_times(15):
+            print(f"{microseconds / 1000:>10.1f}  {module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Bytes on the wire of a feed scroll - the home page, the next pages of the home feed and of the profile gallery
+loaded by HTMX - with every Accept-Encoding the application supports, and a second scroll revalidating the pages
+with the ETags of the first one, like the browser does when the user comes back:
+
+    identity    uncompressed
+    gzip        COMPRESS_LEVEL
+    br          COMPRESS_BROTLI_QUALITY, if the brotli module is installed
+
+usage:
+    python -m benchmarks.transfer
+    python -m benchmarks.transfer --users 2000 --steps 20
+"""
+from .graph import GraphConfig, seed
+from .scenarios import Recorder
+from .run import create_benchmark_app
+from web import db
+from time import perf_counter
+import argparse
+import os
+import tempfile
+
+
+def wire_size(response):
+    # status line, headers and body as sent
+    headers = sum(len(f"{name}: {value}\r\n") for name, value in response.headers.items())
+    return len(f"HTTP/1.1 {response.status}\r\n") + headers + 2 + len(response.get_data())
+
+
+def scroll_urls(graph, steps):
+    """
+    (URL, referrer) of the scroll - the home feed of the user following the most users and the gallery of the
+    most followed profile.
+    """
+    urls = [("/home", "/home")]
+    urls += [(f"/load-page/{graph.heavy_user_id}/{page}", "/home") for page in range(0, steps * 6, 6)]
+    urls += [(f"/profile/{graph.popular_user_id}", "/home")]
+    urls += [(f"/load-page/{graph.popular_user_id}/{page}", f"/profile/{graph.popular_user_id}")
+             for page in range(0, steps * 6, 6)]
+    return urls
+
+
+def scroll(bench, urls, encoding, etags=None):
+    """
+    Requests the URLs with the Accept-Encoding, revalidating with the ETags if given.
+
+    :return: Dictionary with bytes, requests, 304 responses, seconds and the ETags of the responses.
+    """
+    result = {"bytes": 0, "requests": 0, "not_modified": 0, "seconds": 0.0, "etags": {}}
+    for url, referrer in urls:
+        headers = {"Accept-Encoding": encoding}
+        if etags and etags.get(url):
+            headers["If-None-Match"] = etags[url]
+        started = perf_counter()
+        response = bench.get(url, referrer=referrer, htmx=url.startswith("/load-page"), headers=headers)
+        result["seconds"] += perf_counter() - started
+        result["bytes"] += wire_size(response)
+        result["requests"] += 1
+        result["not_modified"] += response.status_code == 304
+        result["etags"][url] = response.headers.get("ETag")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--steps", type=int, default=10, help="pages of the home feed and of the gallery")
+    args = parser.parse_args()
+
+    app = create_benchmark_app(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'transfer.db')}")
+    with app.app_context():
+        db.drop_all()
+        graph = seed(GraphConfig(users=args.users, seed=args.seed))
+    print(f"seeded graph: {graph.counts}")
+    urls = scroll_urls(graph, args.steps)
+    encodings = ["identity", "gzip"]
+    try:
+        import brotli  # noqa: F401
+        encodings.append("br")
+    except ImportError:
+        print("brotli not installed, br is not measured")
+
+    bench = Recorder(app)
+    bench.login(graph.heavy_user_id)
+    # warms up the fragment cache and the templates, every encoding then renders the same pages
+    scroll(bench, urls, "identity")
+    baseline = None
+    print(f"{len(urls)} requests per scroll")
+    print(f"{'scroll':<24}{'kB':>10}{'saved':>10}{'304s':>8}{'ms':>10}")
+    for encoding in encodings:
+        first = scroll(bench, urls, encoding)
+        again = scroll(bench, urls, encoding, first["etags"])
+        baseline = baseline or first["bytes"]
+        for name, result in ((encoding, first), (f"{encoding} revalidated", again)):
+            print(f"{name:<24}{result['bytes'] / 1024:>10.1f}{1 - result['bytes'] / baseline:>10.0%}"
+                  f"{result['not_modified']:>8}{result['seconds'] * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
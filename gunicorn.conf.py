@@ -0,0 +1,29 @@
+import os
+
+
+### TO RUN IN PRODUCTION ###
+# gunicorn app:app - this file is read from the working directory
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+# the application is imported and set up once in the master, workers are forked from it and share its memory
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    # compile templates before the workers are forked
+    if server.cfg.preload_app:
+        from web.startup import warm_up
+        warm_up(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    # without preload_app every worker warms up on its own, before it accepts requests
+    if not worker.cfg.preload_app:
+        from web.startup import warm_up
+        warm_up(worker.wsgi)
+
+
+def child_exit(server, worker):
+    # live gauges of the stopped worker, see PROMETHEUS_MULTIPROC_DIR in metrics.py
+    from web.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
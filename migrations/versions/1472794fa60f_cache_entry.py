@@ -0,0 +1,34 @@
+"""cache entry - values of the cache backend shared by all workers through the database
+
+Revision ID: 1472794fa60f
+Revises: c6bbabaa1793
+Create Date: 2026-10-19 09:35:46.940381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1472794fa60f'
+down_revision = 'c6bbabaa1793'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_entry',
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('value', sa.Text(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+    with op.batch_alter_table('cache_entry', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_cache_entry_expires_at'), ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cache_entry', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_cache_entry_expires_at'))
+
+    op.drop_table('cache_entry')
@@ -0,0 +1,36 @@
+"""comment like count - like counter of comments and the index of comment pages
+
+Revision ID: 1fdba827606a
+Revises: b1b718f73f66
+Create Date: 2026-10-19 09:34:36.840784
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1fdba827606a'
+down_revision = 'b1b718f73f66'
+branch_labels = None
+depends_on = None
+
+
+comment = sa.table('comment', sa.column('id', sa.Integer()), sa.column('like_count', sa.Integer()))
+like = sa.table('like', sa.column('id', sa.Integer()), sa.column('comment_id', sa.Integer()))
+
+
+def upgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_index('ix_comment_picture', ['picture_id', 'id'], unique=False)
+
+    # counts of the existing likes
+    count = sa.select(sa.func.count(like.c.id)).where(like.c.comment_id == comment.c.id).scalar_subquery()
+    op.execute(comment.update().values(like_count=count))
+
+
+def downgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_index('ix_comment_picture')
+        batch_op.drop_column('like_count')
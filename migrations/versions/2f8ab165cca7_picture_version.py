@@ -0,0 +1,26 @@
+"""picture version - bumped on every change shown in cached post cards and gallery tiles
+
+Revision ID: 2f8ab165cca7
+Revises: 6855e098ba12
+Create Date: 2026-10-19 09:33:07.192181
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f8ab165cca7'
+down_revision = '6855e098ba12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('picture', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('picture', schema=None) as batch_op:
+        batch_op.drop_column('version')
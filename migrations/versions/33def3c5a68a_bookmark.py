@@ -0,0 +1,50 @@
+"""bookmark - user_picture gets a primary key and the time of the bookmark
+
+Revision ID: 33def3c5a68a
+Revises: 450fb3903784
+Create Date: 2026-10-19 09:34:06.999588
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '33def3c5a68a'
+down_revision = '450fb3903784'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the old association table has no key and may hold a bookmark twice - the rows are copied once each into the
+    # new table, existing bookmarks are dated to the migration
+    op.rename_table('user_picture', 'user_picture_old')
+    op.create_table('user_picture',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('picture_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+    sa.ForeignKeyConstraint(['picture_id'], ['picture.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'picture_id')
+    )
+    op.execute('INSERT INTO user_picture (user_id, picture_id) SELECT DISTINCT user_id, picture_id '
+               'FROM user_picture_old WHERE user_id IS NOT NULL AND picture_id IS NOT NULL')
+    op.drop_table('user_picture_old')
+    with op.batch_alter_table('user_picture', schema=None) as batch_op:
+        batch_op.create_index('ix_user_picture_user_created', ['user_id', 'created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user_picture', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_picture_user_created')
+
+    op.rename_table('user_picture', 'user_picture_old')
+    op.create_table('user_picture',
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('picture_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['picture_id'], ['picture.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO user_picture (user_id, picture_id) SELECT user_id, picture_id FROM user_picture_old')
+    op.drop_table('user_picture_old')
@@ -0,0 +1,59 @@
+"""conversation read - read watermarks of conversations and indexes of unseen messages
+
+Revision ID: 450fb3903784
+Revises: 457e47c55380
+Create Date: 2026-10-19 09:33:43.771776
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '450fb3903784'
+down_revision = '457e47c55380'
+branch_labels = None
+depends_on = None
+
+
+user_message = sa.table('user_message', sa.column('id', sa.Integer()), sa.column('sender_id', sa.Integer()),
+                        sa.column('recipient_id', sa.Integer()), sa.column('timestamp', sa.DateTime()),
+                        sa.column('seen', sa.Boolean()))
+conversation_read = sa.table('conversation_read', sa.column('user_id', sa.Integer()),
+                             sa.column('partner_id', sa.Integer()), sa.column('last_read_message_id', sa.Integer()),
+                             sa.column('read_at', sa.DateTime()))
+
+
+def upgrade():
+    with op.batch_alter_table('user_message', schema=None) as batch_op:
+        batch_op.create_index('ix_user_message_conversation', ['sender_id', 'recipient_id'], unique=False)
+        batch_op.create_index('ix_user_message_unseen', ['recipient_id', 'sender_id'], unique=False,
+                              postgresql_where=sa.text('seen = false'), sqlite_where=sa.text('seen = 0'))
+
+    op.create_table('conversation_read',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('partner_id', sa.Integer(), nullable=False),
+    sa.Column('last_read_message_id', sa.Integer(), nullable=True),
+    sa.Column('read_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['partner_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'partner_id')
+    )
+
+    # watermarks of existing conversations from the seen flags - all messages below the first unseen one are read,
+    # the whole conversation if none is unseen
+    first_unseen = sa.func.min(sa.case((user_message.c.seen.is_(False), user_message.c.id)))
+    watermark = sa.func.coalesce(first_unseen - 1, sa.func.max(user_message.c.id))
+    rows = sa.select(user_message.c.recipient_id, user_message.c.sender_id, watermark,
+                     sa.func.max(user_message.c.timestamp)).group_by(user_message.c.recipient_id,
+                                                                     user_message.c.sender_id)
+    op.execute(conversation_read.insert().from_select(
+        ['user_id', 'partner_id', 'last_read_message_id', 'read_at'], rows))
+
+
+def downgrade():
+    op.drop_table('conversation_read')
+    with op.batch_alter_table('user_message', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_message_unseen', postgresql_where=sa.text('seen = false'),
+                            sqlite_where=sa.text('seen = 0'))
+        batch_op.drop_index('ix_user_message_conversation')
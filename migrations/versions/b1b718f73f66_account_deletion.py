@@ -0,0 +1,47 @@
+"""account deletion - deleted flag of users and progress of background account deletions
+
+Revision ID: b1b718f73f66
+Revises: 33def3c5a68a
+Create Date: 2026-10-19 09:34:23.933399
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1b718f73f66'
+down_revision = '33def3c5a68a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+    op.create_table('account_deletion',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('username', sa.String(), nullable=True),
+    sa.Column('status', sa.String(), nullable=True),
+    sa.Column('step', sa.String(), nullable=True),
+    sa.Column('rows_deleted', sa.Integer(), nullable=True),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('account_deletion', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_account_deletion_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('account_deletion', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_account_deletion_user_id'))
+
+    op.drop_table('account_deletion')
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('deleted')
@@ -0,0 +1,31 @@
+"""trending scores - time-decayed scores of pictures for the explore page
+
+Revision ID: c6bbabaa1793
+Revises: fe0bf6daaad3
+Create Date: 2026-10-19 09:35:38.475244
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6bbabaa1793'
+down_revision = 'fe0bf6daaad3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # scores start at 0 and are computed by the next recompute of trending.py ("flask trending recompute")
+    with op.batch_alter_table('picture', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('trending_score', sa.Float(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('trending_epoch', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_index('ix_picture_trending', ['trending_epoch', 'trending_score'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('picture', schema=None) as batch_op:
+        batch_op.drop_index('ix_picture_trending')
+        batch_op.drop_column('trending_epoch')
+        batch_op.drop_column('trending_score')
@@ -0,0 +1,42 @@
+"""unique likes - one like per user and picture or comment
+
+Revision ID: d74bb2342494
+Revises: 1fdba827606a
+Create Date: 2026-10-19 09:34:59.161773
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd74bb2342494'
+down_revision = '1fdba827606a'
+branch_labels = None
+depends_on = None
+
+
+like = sa.table('like', sa.column('id', sa.Integer()), sa.column('author_id', sa.Integer()),
+               sa.column('picture_id', sa.Integer()), sa.column('comment_id', sa.Integer()))
+comment = sa.table('comment', sa.column('id', sa.Integer()), sa.column('like_count', sa.Integer()))
+
+
+def upgrade():
+    # duplicates left by double clicks are deleted first, the constraints could not be created with them - the
+    # oldest like of every (author, picture) or (author, comment) pair is kept
+    for target in (like.c.picture_id, like.c.comment_id):
+        keep = sa.select(sa.func.min(like.c.id)).where(target.isnot(None)).group_by(like.c.author_id, target)
+        op.execute(like.delete().where(target.isnot(None), like.c.id.notin_(keep)))
+    # comment like counts included the duplicates
+    count = sa.select(sa.func.count(like.c.id)).where(like.c.comment_id == comment.c.id).scalar_subquery()
+    op.execute(comment.update().values(like_count=count))
+
+    with op.batch_alter_table('like', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_like_author_picture', ['author_id', 'picture_id'])
+        batch_op.create_unique_constraint('uq_like_author_comment', ['author_id', 'comment_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('like', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_like_author_comment', type_='unique')
+        batch_op.drop_constraint('uq_like_author_picture', type_='unique')
@@ -0,0 +1,45 @@
+"""chunked upload - resumable uploads of pictures, stories and avatars
+
+Revision ID: dadf2390aa8e
+Revises: 1472794fa60f
+Create Date: 2026-10-19 09:35:57.105886
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'dadf2390aa8e'
+down_revision = '1472794fa60f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chunked_upload',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('purpose', sa.String(), nullable=True),
+    sa.Column('meta', sa.String(), nullable=True),
+    sa.Column('length', sa.Integer(), nullable=True),
+    sa.Column('offset', sa.Integer(), nullable=False),
+    sa.Column('image_type', sa.String(), nullable=True),
+    sa.Column('checksum', sa.String(), nullable=True),
+    sa.Column('result', sa.String(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_chunked_upload_expires_at'), ['expires_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_chunked_upload_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('chunked_upload', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_chunked_upload_user_id'))
+        batch_op.drop_index(batch_op.f('ix_chunked_upload_expires_at'))
+
+    op.drop_table('chunked_upload')
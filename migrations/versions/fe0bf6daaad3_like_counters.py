@@ -0,0 +1,53 @@
+"""like counters - write-behind like counts of pictures, their shards and the journal of like events
+
+Revision ID: fe0bf6daaad3
+Revises: d74bb2342494
+Create Date: 2026-10-19 09:35:25.307247
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fe0bf6daaad3'
+down_revision = 'd74bb2342494'
+branch_labels = None
+depends_on = None
+
+
+picture = sa.table('picture', sa.column('id', sa.Integer()), sa.column('like_count', sa.Integer()))
+like = sa.table('like', sa.column('id', sa.Integer()), sa.column('picture_id', sa.Integer()))
+
+
+def upgrade():
+    with op.batch_alter_table('picture', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+    op.create_table('picture_like_shard',
+    sa.Column('picture_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('delta', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['picture_id'], ['picture.id'], ),
+    sa.PrimaryKeyConstraint('picture_id', 'shard')
+    )
+    op.create_table('like_event',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('picture_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('delta', sa.Integer(), nullable=False),
+    sa.Column('link', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    # counts of the existing likes, the shards start empty
+    count = sa.select(sa.func.count(like.c.id)).where(like.c.picture_id == picture.c.id).scalar_subquery()
+    op.execute(picture.update().values(like_count=count))
+
+
+def downgrade():
+    op.drop_table('like_event')
+    op.drop_table('picture_like_shard')
+    with op.batch_alter_table('picture', schema=None) as batch_op:
+        batch_op.drop_column('like_count')
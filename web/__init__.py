@@ -5,27 +5,92 @@ import secrets
 from flask_mail import Mail
 from dotenv import load_dotenv
 import os
-import timeago
 import datetime as dt
 from flask_migrate import Migrate
-from elasticsearch import Elasticsearch
 
 
 load_dotenv()
 mail = Mail()
-db = SQLAlchemy()
+# reads of read-only views are routed to replicas, see replicas.py
+from .replicas import RoutingSession
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
     app.config["SECRET_KEY"] = secrets.token_hex(16)
     app.config['MAX_CONTENT_LENGTH'] = 6 * 1024 * 1024  # max upload size 6MB
 
     # database config
     app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("SQLALCHEMY_DATABASE_URI")
-    db.init_app(app)
-    from .models import User  # cannot be imported before db initialized
-    migrate = Migrate(app, db, render_as_batch=True)
+    # read replicas - comma separated URIs, users who just wrote read from the primary for DB_REPLICA_PIN_SECONDS
+    app.config['DB_REPLICA_URIS'] = [uri for uri in os.getenv("DB_REPLICA_URIS", "").split(",") if uri]
+    app.config['DB_REPLICA_PIN_SECONDS'] = int(os.getenv("DB_REPLICA_PIN_SECONDS", 5))
+
+    # request profiler config - Server-Timing header and log line for every request, optional debug toolbar
+    app.config['PROFILER_ENABLED'] = os.getenv("PROFILER_ENABLED") == "1"
+    app.config['PROFILER_TOOLBAR'] = os.getenv("PROFILER_TOOLBAR") == "1"
+    # requests over the limit raise QueryBudgetExceeded in tests and log a warning otherwise
+    max_queries = os.getenv("PROFILER_MAX_QUERIES")
+    app.config['PROFILER_MAX_QUERIES'] = int(max_queries) if max_queries else None
+
+    # prometheus metrics - /metrics endpoint, set PROMETHEUS_MULTIPROC_DIR when running multiple gunicorn workers
+    app.config['METRICS_ENABLED'] = os.getenv("METRICS_ENABLED") == "1"
+
+    # fragment cache for rendered post cards and gallery tiles - "memory" (per worker), "redis://..." or "" (off)
+    app.config['FRAGMENT_CACHE_URL'] = os.getenv("FRAGMENT_CACHE_URL", "memory")
+    # cache of the logged in user's row shared by all workers - "redis://..." or "" (off, the user is loaded from the
+    # database on every request); "memory" is per worker, changes made by one worker reach the others after the TTL
+    app.config['USER_CACHE_URL'] = os.getenv("USER_CACHE_URL", "")
+    app.config['USER_CACHE_TTL'] = int(os.getenv("USER_CACHE_TTL", 30))
+
+    # deleted accounts are removed by a background job, rows per DELETE statement
+    app.config['ACCOUNT_DELETION_BATCH'] = int(os.getenv("ACCOUNT_DELETION_BATCH", 1000))
+    # failed deletions and deletions without progress for N seconds are started again
+    app.config['ACCOUNT_DELETION_STALE_SECONDS'] = int(os.getenv("ACCOUNT_DELETION_STALE_SECONDS", 600))
+
+    # HTMX pollers back off while nothing changes, values over 1 stretch all polling intervals to shed load - they
+    # also stretch on their own when requests queue for over N ms (needs X-Request-Start from the proxy)
+    app.config['POLL_LOAD_FACTOR'] = float(os.getenv("POLL_LOAD_FACTOR", 1))
+    app.config['POLL_BUSY_QUEUE_MS'] = float(os.getenv("POLL_BUSY_QUEUE_MS", 100))
+
+    # messages and notifications older than ARCHIVE_AFTER_DAYS move to compressed monthly files in ARCHIVE_DIR,
+    # 0 archives only with "flask archive run"
+    app.config['ARCHIVE_DIR'] = os.getenv("ARCHIVE_DIR", "archive")
+    app.config['ARCHIVE_AFTER_DAYS'] = int(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+
+    # worker start - DB_CREATE_ALL=0 relies on the migrations for the schema ("flask db upgrade"), TEMPLATE_CACHE_DIR
+    # stores compiled templates shared by all workers, see gunicorn.conf.py
+    app.config['DB_CREATE_ALL'] = os.getenv("DB_CREATE_ALL", "1") == "1"
+    app.config['TEMPLATE_CACHE_DIR'] = os.getenv("TEMPLATE_CACHE_DIR")
+    # full text search, the client is created on first use
+    app.config['ELASTICSEARCH_URL'] = os.getenv("ELASTICSEARCH_URL")
+
+    # explore page - likes and comments count towards the trending score of a picture, halving every N hours
+    app.config['TRENDING_HALF_LIFE_HOURS'] = float(os.getenv("TRENDING_HALF_LIFE_HOURS", 24))
+
+    # home feed - "latest" or "ranked" for users who did not choose, rankings are cached in FEED_CACHE_URL
+    # ("database" or "redis://..." - "memory" is per worker and only works with a single one)
+    app.config['FEED_DEFAULT_MODE'] = os.getenv("FEED_DEFAULT_MODE", "latest")
+    app.config['FEED_CACHE_URL'] = os.getenv("FEED_CACHE_URL", "database")
+
+    # JSON API - bearer tokens are signed with API_TOKEN_SECRET (same for all workers) and expire after N hours
+    app.config['API_TOKEN_SECRET'] = os.getenv("API_TOKEN_SECRET")
+    app.config['API_TOKEN_HOURS'] = int(os.getenv("API_TOKEN_HOURS", 24 * 30))
+
+    # resumable uploads - chunks are assembled in UPLOAD_TEMP_DIR, unfinished uploads are removed after N hours
+    app.config['UPLOAD_TEMP_DIR'] = os.getenv("UPLOAD_TEMP_DIR", "upload-parts")
+    app.config['UPLOAD_MAX_SIZE'] = int(os.getenv("UPLOAD_MAX_SIZE", 50 * 1024 * 1024))
+    app.config['UPLOAD_EXPIRE_HOURS'] = int(os.getenv("UPLOAD_EXPIRE_HOURS", 24))
+
+    # HTTP - weak ETags of HTMX fragments answer unchanged ones with 304, text responses of COMPRESS_MIN_SIZE bytes
+    # and more are compressed with brotli (if installed) or gzip; turn off if the proxy in front already compresses
+    app.config['ETAGS_ENABLED'] = os.getenv("ETAGS_ENABLED", "1") == "1"
+    app.config['COMPRESS_ENABLED'] = os.getenv("COMPRESS_ENABLED", "1") == "1"
+    app.config['COMPRESS_MIN_SIZE'] = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+
+    # geolocation of uploads - path to a MaxMind .mmdb City database, ip-api.com is used without it
+    app.config['GEO_DATABASE'] = os.getenv("GEO_DATABASE")
 
     # mail config
     app.config['MAIL_SERVER'] = 'smtp.gmail.com'
@@ -35,21 +100,88 @@ def create_app():
     app.config['MAIL_DEFAULT_SENDER'] = os.getenv("MAIL_DEFAULT_SENDER")
     app.config['MAIL_USERNAME'] = os.getenv("MAIL_USERNAME")
     app.config['MAIL_PASSWORD'] = os.getenv("MAIL_PASSWORD")
+    # mails are queued in the database and sent in the background - "smtp", "file" (MAIL_FILE_DIR) or "memory"
+    app.config['MAIL_TRANSPORT'] = os.getenv("MAIL_TRANSPORT", "smtp")
+    app.config['MAIL_FILE_DIR'] = os.getenv("MAIL_FILE_DIR", "mail")
+    # reports of pictures are sent to the admin as one digest per MAIL_DIGEST_MINUTES
+    app.config['MAIL_DIGEST_MINUTES'] = int(os.getenv("MAIL_DIGEST_MINUTES", 15))
+
+    # overrides for tests and benchmarks
+    if test_config:
+        app.config.update(test_config)
+
+    db.init_app(app)
+    from .models import User  # cannot be imported before db initialized
+    migrate = Migrate(app, db, render_as_batch=True)
     mail.init_app(app)
 
-    # elasticsearch
-    app.elasticsearch = Elasticsearch(os.getenv("ELASTICSEARCH_URL")) if os.getenv("ELASTICSEARCH_URL") else None
+    # tables missing in development, template bytecode cache
+    from .startup import init_startup
+    init_startup(app)
 
-    # db context
-    with app.app_context():
-        db.create_all()
+    # conditional requests and compression - registered first, its after_request hook runs last
+    from .transfer import init_transfer
+    init_transfer(app)
 
+    # request profiler and metrics - registered before blueprints to also measure their before_request hooks
+    from .profiler import init_profiler
+    from .metrics import init_metrics
+    init_profiler(app)
+    init_metrics(app)
 
     # blueprints
     from .views import views
     from .auth import auth
     app.register_blueprint(views, url_prefix="/")
     app.register_blueprint(auth, url_prefix="/")
+    # JSON API under /api/v1
+    from .api import init_api
+    init_api(app)
+
+    # jinja fragment cache and cache of logged in users
+    from .cache import init_fragment_cache, init_user_cache, load_user
+    init_fragment_cache(app)
+    init_user_cache(app)
+
+    # background tasks, outbound mail queue, write-behind like counters, archival of old rows and trending scores
+    from .tasks import init_tasks
+    from .mailer import init_mailer
+    from .counters import init_counters
+    from .archive import init_archive
+    from .trending import init_trending
+    init_tasks(app)
+    init_mailer(app)
+    init_counters(app)
+    init_archive(app)
+    init_trending(app)
+
+    # ranked home feed, expired rankings are removed in the background
+    from .ranking import init_ranking
+    init_ranking(app)
+
+    # read replicas, their health checks run as background tasks
+    from .replicas import init_replicas
+    init_replicas(app)
+
+    # adaptive intervals of HTMX polling
+    from .polling import init_polling
+    init_polling(app)
+
+    # geolocation of uploaded pictures
+    from .geo import init_geo
+    init_geo(app)
+
+    # failed and stuck account deletions are started again in the background
+    from .deletion import init_deletion
+    init_deletion(app)
+
+    # resumable uploads under /uploads, expired ones are removed in the background
+    from .uploads import init_uploads
+    init_uploads(app)
+
+    # maintenance commands
+    from .commands import init_commands
+    init_commands(app)
 
     # login manager
     login_manager = LoginManager()
@@ -57,8 +189,8 @@ def create_app():
     login_manager.init_app(app)
 
     @login_manager.user_loader
-    def load_user(id):
-        return User.query.get(int(id))
+    def user_loader(id):
+        return load_user(int(id))
 
     # jinja custom filters
     @app.template_filter("datetime_format")
@@ -67,7 +199,8 @@ def create_app():
         # 1) takes date_created value from models given by func.now()
         # 2) take current UTC time from datetime module
         # 3) converts datetime object to be timezone naive
-        # 4) use timeago module
+        # 4) use timeago module (imported on first use)
+        import timeago
         now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
         return timeago.format(value, now)
 
@@ -0,0 +1,666 @@
+from flask import Blueprint, current_app, request, abort, url_for
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import check_password_hash
+from functools import wraps
+from time import time
+from . import db
+from .models import User, Picture, Comment, Like, UserMessage, Notification, followers, blocked
+from .cache import load_user, invalidate_user
+from .counters import record_like
+from .replicas import read_only
+from .trending import add_score
+from .archive import archived_messages
+from .helpers import add_like, remove_like, follow_user, mark_as_seen
+import datetime as dt
+import json
+import jwt
+
+
+# JSON REST API for the mobile and integration clients, documented in api-docs.html
+api = Blueprint("api", __name__)
+
+
+### SERIALIZATION ###
+def _default(value):
+    # values the json module does not encode, orjson encodes datetimes the same way
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(payload):
+    """
+    Encodes a response body with orjson if installed (several times faster on pages of objects), with the json
+    module otherwise. Both write compact JSON without whitespace.
+
+    :return: Bytes.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=_default).encode()
+    return orjson.dumps(payload, default=_default)
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(dumps(payload), status=status, mimetype="application/json")
+
+
+@api.errorhandler(HTTPException)
+def http_error(error):
+    # errors of the API are JSON as well - {"error": {"status": 404, "message": "..."}}
+    response = json_response({"error": {"status": error.code, "message": error.description}}, error.code)
+    # e.g. Allow of a 405
+    response.headers.extend((name, value) for name, value in error.get_headers() if name != "Content-Type")
+    if error.code == 401:
+        response.headers["WWW-Authenticate"] = "Bearer"
+    return response
+
+
+def routing_error(error):
+    # URLs under /api/ matching no route (404) or not its method (405) are not requests of the blueprint, their
+    # errors are handled by the application - JSON for the API, the default pages otherwise
+    if request.path.startswith("/api/"):
+        return http_error(error)
+    return error
+
+
+### AUTHENTICATION ###
+def create_token(user):
+    """
+    Bearer token of the API, valid for API_TOKEN_HOURS.
+
+    :return: Tuple (token, expiry as Unix time).
+    """
+    expires = int(time() + current_app.config["API_TOKEN_HOURS"] * 3600)
+    token = jwt.encode({"sub": str(user.id), "scope": "api", "exp": expires},
+                       key=current_app.config["API_TOKEN_SECRET"], algorithm="HS256")
+    return token, expires
+
+
+def token_user(token):
+    """
+    User of a bearer token, loaded through the cache of logged in users.
+
+    :return: User object or None if the token is invalid, expired or the account deleted.
+    """
+    try:
+        payload = jwt.decode(token, key=current_app.config["API_TOKEN_SECRET"], algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+    if payload.get("scope") != "api":
+        return None
+    return load_user(int(payload["sub"]))
+
+
+def token_required(view):
+    """
+    Authenticates the request with the "Authorization: Bearer <token>" header. The session cookie is ignored - the
+    API has no CSRF protection, so a browser must not be able to call it on behalf of a logged in user.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        user = token_user(token) if scheme.lower() == "bearer" and token else None
+        if user is None:
+            abort(401, "Missing or invalid token.")
+        # helpers and models read the user from current_user
+        current_app.login_manager._update_request_context_with_user(user)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+### REQUEST ARGUMENTS ###
+def _body():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, "Expected a JSON object.")
+    return body
+
+
+def _text(body, name, max_length):
+    value = body.get(name)
+    if not isinstance(value, str) or not value.strip() or len(value) > max_length:
+        abort(400, f"'{name}' must be a string of 1 to {max_length} characters.")
+    return value
+
+
+def _limit():
+    # page size of ?limit=, API_PAGE_SIZE by default
+    limit = request.args.get("limit", current_app.config["API_PAGE_SIZE"], type=int)
+    return max(1, min(limit, current_app.config["API_MAX_PAGE_SIZE"]))
+
+
+def _ids(name="ids"):
+    """
+    IDs of a batch request, ?ids=1,2,3 - at most API_BATCH_LIMIT, duplicates removed.
+
+    :return: List of IDs in the requested order.
+    """
+    try:
+        ids = list(dict.fromkeys(int(value) for value in request.args.get(name, "").split(",") if value.strip()))
+    except ValueError:
+        abort(400, f"'{name}' must be a comma separated list of IDs.")
+    if not ids:
+        abort(400, f"'{name}' is required.")
+    if len(ids) > current_app.config["API_BATCH_LIMIT"]:
+        abort(400, f"At most {current_app.config['API_BATCH_LIMIT']} IDs per request.")
+    return ids
+
+
+def _fields(available, default):
+    """
+    Fields of a sparse fieldset, ?fields=id,file,like_count - fields which need extra queries (counts, like states)
+    are only computed when requested.
+
+    :param available: Dictionary of field name to getter.
+    :param default: Fields returned without ?fields=.
+    :return: Tuple of field names.
+    """
+    value = request.args.get("fields")
+    if not value:
+        return default
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}.")
+    return fields
+
+
+def time_cursor(created, object_id):
+    """
+    Keyset cursor of lists ordered by creation time, "<created>_<id>" - the ID breaks ties, like bookmark_cursor.
+    """
+    return f"{created.isoformat()}_{object_id}"
+
+
+def _after_cursor(query, created_column, id_column):
+    # rows after the ?cursor= of the last row of the previous page, newest first
+    cursor = request.args.get("cursor")
+    if not cursor:
+        return query
+    try:
+        created, object_id = cursor.rsplit("_", 1)
+        created, object_id = dt.datetime.fromisoformat(created), int(object_id)
+    except ValueError:
+        abort(400, "Invalid cursor.")
+    return query.filter(db.or_(created_column < created, db.and_(created_column == created, id_column < object_id)))
+
+
+def _id_cursor():
+    # ?cursor= of lists ordered by ID
+    try:
+        return int(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError:
+        abort(400, "Invalid cursor.")
+
+
+def _page(items, limit, cursor_of):
+    # one extra row tells whether there is a next page
+    next_cursor = cursor_of(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+### ACCESS ###
+def hidden_user_ids(user):
+    """
+    Users hidden from the user - users they blocked and users who blocked them.
+
+    :return: Set of user IDs.
+    """
+    rows = db.session.query(blocked.c.blocked_id, blocked.c.blocker_id).filter(
+        db.or_(blocked.c.blocker_id == user.id, blocked.c.blocked_id == user.id))
+    return {user_id for row in rows for user_id in row} - {user.id}
+
+
+def _visible_user(user_id):
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted:
+        abort(404, "User not found.")
+    if user.id in hidden_user_ids(current_user):
+        abort(403, "Blocked user.")
+    return user
+
+
+def _visible_picture(picture_id, interactive=False):
+    """
+    Picture the current user may see - 404 if missing, 403 if its author is blocked. Interactive pictures accept
+    likes and comments, the author turned them off for private ones.
+    """
+    picture = db.session.get(Picture, picture_id)
+    if picture is None:
+        abort(404, "Picture not found.")
+    if picture.author_id in hidden_user_ids(current_user):
+        abort(403, "Blocked user.")
+    if interactive and picture.private:
+        abort(403, "Comments and likes have been turned off.")
+    return picture
+
+
+### SERIALIZERS ###
+# every resource has a dictionary of field name to getter(object, context) and its default fields; the context
+# holds what the requested fields need for the whole page, loaded with one query per field
+def _user_summary(user):
+    return {"id": user.id, "username": user.username, "avatar": user.avatar}
+
+
+USER_FIELDS = {
+    "id": lambda user, context: user.id,
+    "username": lambda user, context: user.username,
+    "description": lambda user, context: user.description,
+    "avatar": lambda user, context: user.avatar,
+    "date_created": lambda user, context: user.date_created,
+    "picture_count": lambda user, context: context["pictures"].get(user.id, 0),
+    "follower_count": lambda user, context: context["followers"].get(user.id, 0),
+    "following_count": lambda user, context: context["following"].get(user.id, 0),
+    "followed": lambda user, context: user.id in context["followed"],
+}
+USER_DEFAULT = ("id", "username", "avatar", "description")
+
+PICTURE_FIELDS = {
+    "id": lambda picture, context: picture.id,
+    "description": lambda picture, context: picture.description,
+    "location": lambda picture, context: picture.location,
+    "file": lambda picture, context: picture.file,
+    "private": lambda picture, context: bool(picture.private),
+    "date_created": lambda picture, context: picture.date_created,
+    "author_id": lambda picture, context: picture.author_id,
+    "author": lambda picture, context: _user_summary(picture.author),
+    "like_count": lambda picture, context: picture.like_total,
+    "comment_count": lambda picture, context: context["comments"].get(picture.id, 0),
+    "liked": lambda picture, context: picture.id in context["liked"],
+    "bookmarked": lambda picture, context: picture.id in context["bookmarked"],
+}
+PICTURE_DEFAULT = ("id", "description", "location", "file", "private", "date_created", "author_id", "like_count")
+
+COMMENT_FIELDS = {
+    "id": lambda comment, context: comment.id,
+    "text": lambda comment, context: comment.text,
+    "date_created": lambda comment, context: comment.date_created,
+    "author_id": lambda comment, context: comment.author_id,
+    "author": lambda comment, context: _user_summary(comment.author),
+    "like_count": lambda comment, context: comment.like_count,
+    "liked": lambda comment, context: comment.id in context["liked"],
+}
+COMMENT_DEFAULT = ("id", "text", "date_created", "author", "like_count")
+
+MESSAGE_FIELDS = {
+    "id": lambda message, context: message.id,
+    "sender_id": lambda message, context: message.sender_id,
+    "recipient_id": lambda message, context: message.recipient_id,
+    "body": lambda message, context: message.body,
+    "timestamp": lambda message, context: message.timestamp,
+    "seen": lambda message, context: bool(message.seen),
+}
+MESSAGE_DEFAULT = tuple(MESSAGE_FIELDS)
+
+
+def serialize(objects, getters, fields, context=None):
+    return [{name: getters[name](obj, context) for name in fields} for obj in objects]
+
+
+def _counts(column, ids, *criteria):
+    return dict(db.session.query(column, db.func.count()).filter(column.in_(ids), *criteria).group_by(
+        column).all()) if ids else {}
+
+
+def user_context(users, fields):
+    ids = [user.id for user in users]
+    context = {}
+    if "picture_count" in fields:
+        context["pictures"] = _counts(Picture.author_id, ids)
+    if "follower_count" in fields:
+        context["followers"] = _counts(followers.c.followed_id, ids)
+    if "following_count" in fields:
+        context["following"] = _counts(followers.c.follower_id, ids)
+    if "followed" in fields:
+        context["followed"] = current_user.followed_ids()
+    return context
+
+
+def picture_options(fields):
+    """
+    Loader options of the pictures for the requested fields - the author joined, the pending likes summed with the
+    page instead of one query per picture.
+    """
+    options = []
+    if "author" in fields:
+        options.append(db.joinedload(Picture.author))
+    if "like_count" in fields:
+        options.append(db.undefer(Picture.pending_likes))
+    return options
+
+
+def liked_picture_ids(user_id, picture_ids):
+    """
+    IDs of the given pictures liked by the user, one query for the whole batch.
+
+    :return: Set of picture IDs.
+    """
+    if not picture_ids:
+        return set()
+    return {row.picture_id for row in db.session.query(Like.picture_id).filter(
+        Like.author_id == user_id, Like.picture_id.in_(picture_ids))}
+
+
+def picture_context(pictures, fields):
+    ids = [picture.id for picture in pictures]
+    context = {}
+    if "comment_count" in fields:
+        context["comments"] = _counts(Comment.picture_id, ids, Comment.deleted.isnot(True))
+    if "liked" in fields:
+        context["liked"] = liked_picture_ids(current_user.id, ids)
+    if "bookmarked" in fields:
+        context["bookmarked"] = current_user.bookmarked_ids()
+    return context
+
+
+def picture_list(query, fields, limit):
+    # one page of pictures newest first, the cursor continues after the last one
+    query = _after_cursor(query, Picture.date_created, Picture.id)
+    pictures = query.order_by(Picture.date_created.desc(), Picture.id.desc()).options(
+        *picture_options(fields)).limit(limit + 1).all()
+    pictures, next_cursor = _page(pictures, limit, lambda picture: time_cursor(picture.date_created, picture.id))
+    return json_response({"data": serialize(pictures, PICTURE_FIELDS, fields, picture_context(pictures, fields)),
+                          "next_cursor": next_cursor})
+
+
+### TOKENS ###
+@api.route("/tokens", methods=["POST"])
+def create_api_token():
+    """
+    Exchanges email and password for a bearer token - {"email": ..., "password": ...}.
+    """
+    body = _body()
+    user = User.query.filter_by(email=body.get("email"), deleted=False).first()
+    if user is None or not isinstance(body.get("password"), str) or not check_password_hash(user.password,
+                                                                                           body["password"]):
+        abort(401, "Wrong email or password.")
+    token, expires = create_token(user)
+    return json_response({"token": token, "expires_at": expires, "user": _user_summary(user)}, 201)
+
+
+### FEED ###
+@api.route("/feed")
+@token_required
+@read_only
+def feed():
+    """
+    Pictures of followed users and of the current user, newest first - the "latest" home feed.
+    """
+    fields = _fields(PICTURE_FIELDS, PICTURE_DEFAULT)
+    followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == current_user.id)
+    query = Picture.query.filter(db.or_(Picture.author_id.in_(followed.scalar_subquery()),
+                                        Picture.author_id == current_user.id))
+    return picture_list(query, fields, _limit())
+
+
+### USERS ###
+@api.route("/me")
+@token_required
+@read_only
+def me():
+    fields = _fields(USER_FIELDS, USER_DEFAULT)
+    user = db.session.get(User, current_user.id)
+    return json_response({"data": serialize([user], USER_FIELDS, fields, user_context([user], fields))[0]})
+
+
+@api.route("/users")
+@token_required
+@read_only
+def users_batch():
+    """
+    Batch of users, ?ids=1,2,3 - users missing, deleted or blocked are listed in "missing".
+    """
+    ids = _ids()
+    fields = _fields(USER_FIELDS, USER_DEFAULT)
+    hidden = hidden_user_ids(current_user)
+    loaded = {user.id: user for user in User.query.filter(User.id.in_(ids), User.deleted.isnot(True))
+              if user.id not in hidden}
+    users = [loaded[user_id] for user_id in ids if user_id in loaded]
+    return json_response({"data": serialize(users, USER_FIELDS, fields, user_context(users, fields)),
+                          "missing": [user_id for user_id in ids if user_id not in loaded]})
+
+
+@api.route("/users/<int:id>")
+@token_required
+@read_only
+def user_detail(id):
+    fields = _fields(USER_FIELDS, USER_DEFAULT)
+    user = _visible_user(id)
+    return json_response({"data": serialize([user], USER_FIELDS, fields, user_context([user], fields))[0]})
+
+
+@api.route("/users/<int:id>/pictures")
+@token_required
+@read_only
+def user_pictures(id):
+    """
+    Pictures of the user's profile, newest first.
+    """
+    fields = _fields(PICTURE_FIELDS, PICTURE_DEFAULT)
+    user = _visible_user(id)
+    return picture_list(Picture.query.filter(Picture.author_id == user.id), fields, _limit())
+
+
+def _user_list(column, other_column, user_id):
+    # followers or followed users of a user by descending user ID, the cursor is the last ID
+    fields = _fields(USER_FIELDS, USER_DEFAULT)
+    limit = _limit()
+    query = User.query.join(followers, other_column == User.id).filter(column == user_id, User.deleted.isnot(True))
+    before = _id_cursor()
+    if before:
+        query = query.filter(User.id < before)
+    users, next_cursor = _page(query.order_by(User.id.desc()).limit(limit + 1).all(), limit, lambda user: str(user.id))
+    return json_response({"data": serialize(users, USER_FIELDS, fields, user_context(users, fields)),
+                          "next_cursor": next_cursor})
+
+
+@api.route("/users/<int:id>/followers")
+@token_required
+@read_only
+def user_followers(id):
+    user = _visible_user(id)
+    return _user_list(followers.c.followed_id, followers.c.follower_id, user.id)
+
+
+@api.route("/users/<int:id>/following")
+@token_required
+@read_only
+def user_following(id):
+    user = _visible_user(id)
+    return _user_list(followers.c.follower_id, followers.c.followed_id, user.id)
+
+
+@api.route("/users/<int:id>/follow", methods=["PUT", "DELETE"])
+@token_required
+def follow(id):
+    """
+    Follows (PUT) or unfollows (DELETE) the user. Idempotent - following a followed user changes nothing.
+    """
+    user = _visible_user(id)
+    if user.id == current_user.id:
+        abort(400, "Users cannot follow themselves.")
+    following = user.id in current_user.followed_ids()
+    if request.method == "PUT" and not following:
+        follow_user(user.id)
+        db.session.add(Notification(sender_id=current_user.id, recipient_id=user.id, type="follow",
+                                    body=f"{current_user.username} started following you.",
+                                    link=url_for("views.profile", id=current_user.id)))
+        db.session.commit()
+    elif request.method == "DELETE" and following:
+        follow_user(user.id)
+    return json_response({"data": {"user_id": user.id, "followed": request.method == "PUT"}})
+
+
+### PICTURES ###
+@api.route("/pictures")
+@token_required
+@read_only
+def pictures_batch():
+    """
+    Batch of pictures, ?ids=1,2,3 - pictures missing or of blocked users are listed in "missing".
+    """
+    ids = _ids()
+    fields = _fields(PICTURE_FIELDS, PICTURE_DEFAULT)
+    hidden = hidden_user_ids(current_user)
+    loaded = {picture.id: picture for picture in Picture.query.filter(Picture.id.in_(ids)).options(
+        *picture_options(fields)) if picture.author_id not in hidden}
+    pictures = [loaded[picture_id] for picture_id in ids if picture_id in loaded]
+    return json_response({"data": serialize(pictures, PICTURE_FIELDS, fields, picture_context(pictures, fields)),
+                          "missing": [picture_id for picture_id in ids if picture_id not in loaded]})
+
+
+@api.route("/pictures/<int:id>")
+@token_required
+@read_only
+def picture_detail(id):
+    fields = _fields(PICTURE_FIELDS, PICTURE_DEFAULT)
+    picture = _visible_picture(id)
+    return json_response({"data": serialize([picture], PICTURE_FIELDS, fields, picture_context([picture], fields))[0]})
+
+
+### LIKES ###
+@api.route("/likes")
+@token_required
+@read_only
+def like_states():
+    """
+    Like states of the current user for a batch of pictures, ?picture_ids=1,2,3 - {"1": true, "2": false, ...}.
+    """
+    ids = _ids("picture_ids")
+    liked = liked_picture_ids(current_user.id, ids)
+    return json_response({"data": {str(picture_id): picture_id in liked for picture_id in ids}})
+
+
+@api.route("/pictures/<int:id>/like", methods=["PUT", "DELETE"])
+@token_required
+def like(id):
+    """
+    Likes (PUT) or unlikes (DELETE) the picture. Idempotent like views.like_picture, the count is written behind.
+    """
+    picture = _visible_picture(id, interactive=True)
+    if request.method == "PUT" and add_like(current_user.id, picture_id=picture.id):
+        record_like(picture, current_user, 1)
+        db.session.commit()
+    elif request.method == "DELETE" and remove_like(current_user.id, picture_id=picture.id):
+        record_like(picture, current_user, -1)
+        db.session.commit()
+    return json_response({"data": {"picture_id": picture.id, "liked": request.method == "PUT"}})
+
+
+### COMMENTS ###
+@api.route("/pictures/<int:id>/comments", methods=["GET"])
+@token_required
+@read_only
+def comments(id):
+    """
+    Comments of the picture, newest first. The cursor is the ID of the last comment, like helpers.comment_page.
+    """
+    fields = _fields(COMMENT_FIELDS, COMMENT_DEFAULT)
+    limit = _limit()
+    picture = _visible_picture(id, interactive=True)
+    query = Comment.query.filter_by(picture_id=picture.id)
+    before = _id_cursor()
+    if before:
+        query = query.filter(Comment.id < before)
+    if "author" in fields:
+        query = query.options(db.joinedload(Comment.author))
+    page, next_cursor = _page(query.order_by(Comment.id.desc()).limit(limit + 1).all(), limit,
+                              lambda comment: str(comment.id))
+    context = {}
+    if "liked" in fields and page:
+        context["liked"] = {row.comment_id for row in db.session.query(Like.comment_id).filter(
+            Like.author_id == current_user.id, Like.comment_id.in_([comment.id for comment in page]))}
+    return json_response({"data": serialize(page, COMMENT_FIELDS, fields, context), "next_cursor": next_cursor})
+
+
+@api.route("/pictures/<int:id>/comments", methods=["POST"])
+@token_required
+def create_comment(id):
+    """
+    Comments the picture - {"text": ...}, same as the comment form of views.view_picture.
+    """
+    text = _text(_body(), "text", 750)
+    picture = _visible_picture(id, interactive=True)
+    comment = Comment(text=text, author_id=current_user.id, picture_id=picture.id)
+    db.session.add(comment)
+    picture.bump_version()
+    add_score(picture, "comment")
+    if picture.author_id != current_user.id:
+        db.session.add(Notification(sender_id=current_user.id, recipient_id=picture.author_id, type="comment",
+                                    body=f"{current_user.username} commented your post.",
+                                    link=url_for("views.view_picture", id=picture.id)))
+    db.session.commit()
+    return json_response({"data": serialize([comment], COMMENT_FIELDS, COMMENT_DEFAULT)[0]}, 201)
+
+
+### MESSAGES ###
+@api.route("/conversations/<int:id>/messages", methods=["GET"])
+@token_required
+@read_only
+def messages(id):
+    """
+    Messages of the conversation with the user, newest first - archived messages follow the ones in the table. The
+    cursor is the ID of the last message. Reading does not mark messages as seen, see mark-seen.
+    """
+    fields = _fields(MESSAGE_FIELDS, MESSAGE_DEFAULT)
+    limit = _limit()
+    partner = _visible_user(id)
+    before = _id_cursor()
+    query = UserMessage.query.filter(db.or_(
+        db.and_(UserMessage.sender_id == current_user.id, UserMessage.recipient_id == partner.id),
+        db.and_(UserMessage.sender_id == partner.id, UserMessage.recipient_id == current_user.id)))
+    if before:
+        query = query.filter(UserMessage.id < before)
+    found = query.order_by(UserMessage.id.desc()).limit(limit + 1).all()
+    if len(found) <= limit:
+        oldest = found[-1].id if found else before
+        found += reversed(archived_messages(current_user.id, partner.id, oldest, limit + 1 - len(found)))
+    page, next_cursor = _page(found, limit, lambda message: str(message.id))
+    return json_response({"data": serialize(page, MESSAGE_FIELDS, fields), "next_cursor": next_cursor})
+
+
+@api.route("/conversations/<int:id>/messages", methods=["POST"])
+@token_required
+def send_message(id):
+    """
+    Sends a message to the user - {"body": ...}.
+    """
+    body = _text(_body(), "body", 3000)
+    partner = _visible_user(id)
+    message = UserMessage(sender_id=current_user.id, recipient_id=partner.id, body=body)
+    db.session.add(message)
+    current_user.last_message_sent_time = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    db.session.commit()
+    invalidate_user(current_user.id)
+    return json_response({"data": serialize([message], MESSAGE_FIELDS, MESSAGE_DEFAULT)[0]}, 201)
+
+
+@api.route("/conversations/<int:id>/mark-seen", methods=["POST"])
+@token_required
+def mark_messages_seen(id):
+    """
+    Marks the messages received from the user as seen, like opening the chat window.
+    """
+    partner = _visible_user(id)
+    return json_response({"data": {"seen": mark_as_seen(current_user.id, partner.id)}})
+
+
+def init_api(app):
+    """
+    Registers the JSON API under /api/v1. Tokens are signed with API_TOKEN_SECRET, which must be the same for all
+    workers - the random SECRET_KEY is only a fallback for development.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("API_TOKEN_SECRET", None)
+    if not app.config["API_TOKEN_SECRET"]:
+        app.config["API_TOKEN_SECRET"] = app.config["SECRET_KEY"]
+    app.config.setdefault("API_TOKEN_HOURS", 24 * 30)
+    app.config.setdefault("API_PAGE_SIZE", 20)
+    app.config.setdefault("API_MAX_PAGE_SIZE", 100)
+    app.config.setdefault("API_BATCH_LIMIT", 50)
+    app.register_blueprint(api, url_prefix="/api/v1")
+    app.register_error_handler(HTTPException, routing_error)
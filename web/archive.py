@@ -0,0 +1,339 @@
+from flask import current_app
+from flask.cli import AppGroup
+from threading import Lock
+from types import SimpleNamespace
+from . import db
+from .models import UserMessage, Notification
+from .tasks import every
+import click
+import datetime as dt
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows - no locking, run the archival from one process only
+    fcntl = None
+
+
+logger = logging.getLogger("instaclone.archive")
+archive_cli = AppGroup("archive", help="Cold storage of old messages and notifications.")
+
+# one file per kind and month, e.g. archive/messages/2023-01.ndjson.z
+SUFFIX = ".ndjson.z"
+FOOTER = struct.Struct("<QQ8s")
+FOOTER_MAGIC = b"ARCHIVE2"
+# touched on every write of a kind, readers reload the keys of the archive when it changes
+GENERATION = ".generation"
+
+
+def _now():
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+def conversation_key(user_id, partner_id):
+    # both directions of a conversation are stored in one block
+    return f"{min(user_id, partner_id)}-{max(user_id, partner_id)}"
+
+
+# archived tables - model and the key grouping its rows into blocks read together
+ARCHIVES = {
+    "messages": (UserMessage, lambda row: conversation_key(row.sender_id, row.recipient_id)),
+    "notifications": (Notification, lambda row: str(row.recipient_id)),
+}
+
+
+### PARTITION FILES ###
+# A partition file is a sequence of zlib compressed blocks of newline-delimited JSON followed by a JSON index
+# {key: [[offset, length, rows], ...]} and a footer with the offset and length of the index. Every archival batch
+# appends its blocks (one per key) and a new index, earlier bytes are never changed - readers memory-map the file,
+# read the index of the last complete footer and decompress only the blocks of the key they need. Files are
+# rewritten (to a temporary file, then renamed) only to drop purged rows or to compact, see _append_partition.
+def _partition_dir(kind):
+    return os.path.join(current_app.config["ARCHIVE_DIR"], kind)
+
+
+def _touch_generation(path):
+    with open(os.path.join(os.path.dirname(path), GENERATION), "w") as file:
+        file.write(str(time.time_ns()))
+
+
+def _write_blocks(file, blocks, index):
+    # appends one block per key at the position of the file and its segment to the index
+    for key in sorted(blocks):
+        rows = sorted(blocks[key], key=lambda row: row["id"])
+        data = zlib.compress("".join(json.dumps(row) + "\n" for row in rows).encode())
+        index.setdefault(key, []).append([file.tell(), len(data), len(rows)])
+        file.write(data)
+    encoded = json.dumps(index).encode()
+    file.write(encoded)
+    file.write(FOOTER.pack(file.tell() - len(encoded), len(encoded), FOOTER_MAGIC))
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _write_partition(path, blocks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as file:
+        _write_blocks(file, blocks, {})
+    os.replace(f"{path}.tmp", path)
+    _touch_generation(path)
+
+
+def _append_partition(path, blocks):
+    """
+    Appends blocks to a partition - the cost of a batch does not grow with the month. Once the file is more than
+    twice the size of its live blocks (old indexes, rows written twice by an interrupted run) it is compacted.
+    """
+    if not os.path.exists(path):
+        _write_partition(path, blocks)
+        return
+    _, index = _open_partition(path)
+    index = {key: list(segments) for key, segments in index.items()}
+    with open(path, "ab") as file:
+        _write_blocks(file, blocks, index)
+    _touch_generation(path)
+    live = sum(segment[1] for segments in index.values() for segment in segments)
+    if os.path.getsize(path) > 2 * live:
+        _write_partition(path, _read_partition(path))
+
+
+def _parse_index(mapped):
+    # the last complete footer - bytes after it are an append in progress or one interrupted by a crash
+    end = mapped.rfind(FOOTER_MAGIC) + len(FOOTER_MAGIC)
+    if end < FOOTER.size:
+        return {}
+    offset, length, _ = FOOTER.unpack(mapped[end - FOOTER.size:end])
+    return json.loads(mapped[offset:offset + length])
+
+
+_partitions = {}
+_partitions_lock = Lock()
+
+
+def _open_partition(path):
+    """
+    Memory-mapped partition and its index, cached until the file changes. The index is the one of the last complete
+    footer, so a file caught in the middle of an append reads as before it.
+    """
+    stat = os.stat(path)
+    with _partitions_lock:
+        cached = _partitions.get(path)
+        if cached and cached[0] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return cached[1], cached[2]
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        index = _parse_index(mapped)
+        _partitions[path] = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), mapped, index)
+        return mapped, index
+
+
+def _read_block(mapped, index, key):
+    rows = {}
+    for offset, length, _ in index.get(key, ()):
+        for line in zlib.decompress(mapped[offset:offset + length]).splitlines():
+            row = json.loads(line)
+            # a row appended again by an interrupted run is read once
+            rows.setdefault(row["id"], row)
+    return sorted(rows.values(), key=lambda row: row["id"])
+
+
+def _read_partition(path):
+    if not os.path.exists(path):
+        return {}
+    mapped, index = _open_partition(path)
+    return {key: _read_block(mapped, index, key) for key in index}
+
+
+def _partitions_of(kind, newest_first=True):
+    directory = _partition_dir(kind)
+    if not os.path.isdir(directory):
+        return []
+    names = sorted((name for name in os.listdir(directory) if name.endswith(SUFFIX)), reverse=newest_first)
+    return [os.path.join(directory, name) for name in names]
+
+
+_archived_keys = {}
+
+
+def has_archived(kind, key):
+    """
+    True if the archive of the kind holds rows of the key. The keys of all partitions are cached per worker and
+    reloaded only when a partition was written, so most conversations cost one stat() instead of a read of every
+    partition.
+    """
+    try:
+        generation = os.stat(os.path.join(_partition_dir(kind), GENERATION)).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    with _partitions_lock:
+        cached = _archived_keys.get(kind)
+    if cached is None or cached[0] != generation:
+        keys = set()
+        for path in _partitions_of(kind):
+            keys.update(_open_partition(path)[1])
+        cached = (generation, keys)
+        with _partitions_lock:
+            _archived_keys[kind] = cached
+    return key in cached[1]
+
+
+def _row(model, obj):
+    row = {column.name: getattr(obj, column.name) for column in model.__table__.columns}
+    return {name: value.isoformat() if isinstance(value, dt.datetime) else value for name, value in row.items()}
+
+
+### ARCHIVAL ###
+class _ArchiveLock(object):
+    # one writer of the partitions of a kind at a time over all workers, without `wait` a held lock skips the run
+    def __init__(self, kind, wait=False):
+        self.path = os.path.join(_partition_dir(kind), ".lock")
+        self.wait = wait
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "w")
+        if fcntl:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX if self.wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                return False
+        return True
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+def archive_rows(kind, before):
+    """
+    Moves rows older than `before` from the table to the monthly partition files. Rows are deleted only after the
+    file with them is written - a run interrupted in between appends them again, readers keep each ID once.
+
+    :param kind: "messages" or "notifications".
+    :param before: datetime, older rows are archived.
+    :return: Number of archived rows, None if another process is archiving.
+    """
+    model, key_of = ARCHIVES[kind]
+    archived = 0
+    with _ArchiveLock(kind) as locked:
+        if not locked:
+            return None
+        while True:
+            rows = model.query.filter(model.timestamp < before).order_by(model.id).limit(
+                current_app.config["ARCHIVE_BATCH"]).all()
+            if not rows:
+                break
+            months = {}
+            for row in rows:
+                month = (row.timestamp or before).strftime("%Y-%m")
+                months.setdefault(month, []).append(row)
+            for month, month_rows in months.items():
+                blocks = {}
+                for row in month_rows:
+                    blocks.setdefault(key_of(row), []).append(_row(model, row))
+                _append_partition(os.path.join(_partition_dir(kind), f"{month}{SUFFIX}"), blocks)
+            model.query.filter(model.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+            db.session.commit()
+            archived += len(rows)
+    return archived
+
+
+def run_archival():
+    """
+    Archives messages and notifications older than ARCHIVE_AFTER_DAYS. Runs every ARCHIVE_INTERVAL_SECONDS.
+    """
+    days = current_app.config["ARCHIVE_AFTER_DAYS"]
+    for kind in ARCHIVES:
+        archived = archive_rows(kind, _now() - dt.timedelta(days=days))
+        if archived:
+            logger.info("%s %s archived", archived, kind)
+
+
+def purge_user(user_id):
+    """
+    Removes archived messages and notifications of a user, called when the account is deleted.
+
+    :return: Number of removed rows.
+    """
+    removed = 0
+    for kind in ARCHIVES:
+        with _ArchiveLock(kind, wait=True):
+            for path in _partitions_of(kind):
+                blocks = _read_partition(path)
+                kept = {key: [row for row in rows if user_id not in (row["sender_id"], row["recipient_id"])]
+                        for key, rows in blocks.items()}
+                kept = {key: rows for key, rows in kept.items() if rows}
+                count = sum(map(len, blocks.values())) - sum(map(len, kept.values()))
+                if count:
+                    removed += count
+                    _write_partition(path, kept)
+    return removed
+
+
+### READING ###
+def archived_messages(user_id, partner_id, before_id, limit):
+    """
+    Newest archived messages of a conversation, read from the newest partitions until `limit` is reached.
+
+    :param before_id: Only messages with a lower ID, None for all.
+    :return: List of message-like objects (id, sender_id, recipient_id, body, timestamp, seen), oldest first.
+    """
+    key = conversation_key(user_id, partner_id)
+    if not has_archived("messages", key):
+        return []
+    found = []
+    for path in _partitions_of("messages"):
+        mapped, index = _open_partition(path)
+        rows = [row for row in _read_block(mapped, index, key) if before_id is None or row["id"] < before_id]
+        found = rows + found
+        if len(found) >= limit:
+            break
+    for row in found:
+        row["timestamp"] = dt.datetime.fromisoformat(row["timestamp"]) if row["timestamp"] else None
+    return [SimpleNamespace(**row) for row in found[-limit:]]
+
+
+### CLI ###
+@archive_cli.command("run")
+@click.option("--days", type=int, help="archive rows older than this, ARCHIVE_AFTER_DAYS by default")
+def run_command(days):
+    """Move old messages and notifications to the archive files."""
+    days = days or current_app.config["ARCHIVE_AFTER_DAYS"]
+    if not days:
+        print("set --days or ARCHIVE_AFTER_DAYS")
+        return
+    for kind in ARCHIVES:
+        print(f"{archive_rows(kind, _now() - dt.timedelta(days=days))} {kind} archived")
+
+
+@archive_cli.command("status")
+def status_command():
+    """Rows and size of every partition file."""
+    for kind in ARCHIVES:
+        for path in _partitions_of(kind, newest_first=False):
+            _, index = _open_partition(path)
+            rows = sum(segment[2] for segments in index.values() for segment in segments)
+            print(f"{kind} {os.path.basename(path)[:-len(SUFFIX)]} rows={rows} blocks={len(index)} "
+                  f"bytes={os.path.getsize(path)}")
+
+
+def init_archive(app):
+    """
+    Configures the archive of old messages and notifications in ARCHIVE_DIR. ARCHIVE_AFTER_DAYS=0 disables the
+    periodic archival, "flask archive run --days N" still works.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("ARCHIVE_DIR", "archive")
+    app.config.setdefault("ARCHIVE_AFTER_DAYS", 0)
+    app.config.setdefault("ARCHIVE_BATCH", 10000)
+    app.config.setdefault("ARCHIVE_INTERVAL_SECONDS", 24 * 3600)
+    if app.config["ARCHIVE_AFTER_DAYS"]:
+        every(app, app.config["ARCHIVE_INTERVAL_SECONDS"], run_archival)
+    app.cli.add_command(archive_cli)
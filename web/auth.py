@@ -1,15 +1,16 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
-from . import db, mail
+from . import db
 from .models import User
 from werkzeug.urls import url_parse
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from .forms import RegistrationForm, LoginForm, ResetForm, NewPasswordForm, ChangePasswordForm
-from flask_mail import Message
 from time import time
 import jwt
 import os
 from .helpers import follow_user
+from .cache import invalidate_user
+from .mailer import queue_mail
 
 
 auth = Blueprint("auth", __name__)
@@ -21,7 +22,7 @@ JWT_SECRET = os.getenv("WT_SECRET")
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.query.filter_by(email=form.email.data, deleted=False).first()
         if user:
             if check_password_hash(user.password, form.password.data):
                 login_user(user, remember=True)
@@ -80,6 +81,7 @@ def change_password():
         if check_password_hash(current_user.password, form.old_password.data):
             current_user.password = generate_password_hash(form.password.data, method="sha256")
             db.session.commit()
+            invalidate_user(current_user.id)
             flash('Password has been changed.', category="success")
             return redirect(url_for('views.home'))
         else:
@@ -112,12 +114,12 @@ def password_reset():
     form = ResetForm()
     if form.validate_on_submit():
         flash('Mail has been sent.', category="success")
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.query.filter_by(email=form.email.data, deleted=False).first()
         if user:
             token = get_reset_token(user=user)
             mail_content = render_template('reset-email.html', token=token)
-            msg = Message(subject="InstagramClone - password reset", html=mail_content, recipients=[user.email])
-            mail.send(msg)
+            queue_mail(subject="InstagramClone - password reset", recipients=[user.email], html=mail_content)
+            db.session.commit()
             return redirect(url_for("auth.login"))
         else:
             flash("This mail is not registered.", category="error")
@@ -134,6 +136,7 @@ def reset_verified(token):
         user = verify_reset_token(token)
         user.password = generate_password_hash(form.password.data, method="sha256")
         db.session.commit()
+        invalidate_user(user.id)
         flash('Password has been changed.', category="success")
         return redirect(url_for('auth.login'))
     return render_template('reset-verified.html', form=form)
\ No newline at end of file
@@ -0,0 +1,281 @@
+from flask import current_app
+from markupsafe import Markup
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+import datetime as dt
+import hashlib
+import json
+
+
+### BACKENDS ###
+class LRUCache(object):
+    """
+    In-process least recently used cache with an optional time to live. Every gunicorn worker has its own copy.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires = monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    """
+    Cache shared by all workers, stored in Redis or any server speaking the Redis protocol. The client only needs
+    get/set/delete of redis-py, so a fake client (e.g. fakeredis) can be passed in tests.
+    """
+
+    def __init__(self, client, prefix="instaclone:", ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class DatabaseCache(object):
+    """
+    Cache shared by all workers without a cache server, stored in the cache_entry table. Every set commits the
+    session - meant for small state which has to be the same on every worker, not for hot paths.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    @staticmethod
+    def _now():
+        return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+    def get(self, key):
+        from .models import CacheEntry
+        from . import db
+        entry = db.session.get(CacheEntry, key)
+        if entry is None or (entry.expires_at is not None and entry.expires_at < self._now()):
+            return None
+        return entry.value
+
+    def set(self, key, value):
+        from .models import CacheEntry
+        from . import db
+        from sqlalchemy.exc import IntegrityError
+        expires = self._now() + dt.timedelta(seconds=self.ttl) if self.ttl else None
+        try:
+            with db.session.begin_nested():
+                db.session.merge(CacheEntry(key=key, value=value, expires_at=expires))
+        except IntegrityError:
+            pass  # inserted by another worker at the same time, its value wins
+        db.session.commit()
+
+    def delete(self, key):
+        from .models import CacheEntry
+        from . import db
+        db.session.query(CacheEntry).filter_by(key=key).delete(synchronize_session=False)
+        db.session.commit()
+
+    def purge(self):
+        """
+        Deletes expired entries, run periodically by the owner of the backend.
+
+        :return: Number of deleted entries.
+        """
+        from .models import CacheEntry
+        from . import db
+        deleted = db.session.query(CacheEntry).filter(CacheEntry.expires_at < self._now()).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+def create_backend(url, maxsize, ttl):
+    """
+    Creates a cache backend from a URL: "memory" for LRUCache, "database" for DatabaseCache, "redis://host:port/db"
+    for RedisCache.
+    """
+    if url == "database":
+        return DatabaseCache(ttl=ttl)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        # optional dependency, only needed for a shared cache
+        import redis
+        return RedisCache(redis.Redis.from_url(url), ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
+
+
+### FRAGMENT CACHE ###
+def fragment_key(name, picture, viewer_state):
+    """
+    Key of a rendered fragment: (fragment name, picture ID, picture version, hash of the viewer state). The version
+    is bumped whenever something shown in the fragment changes, old versions are never read again and simply expire.
+
+    :param name: Name of the fragment, e.g. "post-header".
+    :param picture: Picture rendered in the fragment.
+    :param viewer_state: Tuple of other values the fragment depends on, e.g. (is_author, author's avatar).
+    :return: String key.
+    """
+    state = repr(viewer_state).encode()
+    return f"fragment:{name}:{picture.id}:{picture.version}:{hashlib.blake2b(state, digest_size=8).hexdigest()}"
+
+
+def cached_fragment(name, picture, *viewer_state, caller):
+    """
+    Jinja helper rendering the body of a {% call %} block only on a cache miss:
+
+        {% call cached_fragment("post-media", picture) %} ... {% endcall %}
+
+    :param name: Name of the fragment.
+    :param picture: Picture rendered in the fragment.
+    :param viewer_state: Viewer dependent values the fragment depends on.
+    :param caller: Body of the call block, passed by Jinja.
+    :return: Rendered markup.
+    """
+    backend = current_app.extensions.get("fragment_cache")
+    if backend is None:
+        return caller()
+    key = fragment_key(name, picture, viewer_state)
+    html = backend.get(key)
+    if html is None:
+        html = caller()
+        backend.set(key, str(html))
+    return Markup(html)
+
+
+def init_fragment_cache(app):
+    """
+    Registers the cached_fragment Jinja helper and creates the backend set by FRAGMENT_CACHE_URL. With an empty URL
+    the helper renders fragments without caching.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("FRAGMENT_CACHE_URL", "memory")
+    app.config.setdefault("FRAGMENT_CACHE_SIZE", 5000)
+    app.config.setdefault("FRAGMENT_CACHE_TTL", 24 * 3600)
+    app.jinja_env.globals["cached_fragment"] = cached_fragment
+    if app.config["FRAGMENT_CACHE_URL"]:
+        app.extensions["fragment_cache"] = create_backend(app.config["FRAGMENT_CACHE_URL"],
+                                                          app.config["FRAGMENT_CACHE_SIZE"],
+                                                          app.config["FRAGMENT_CACHE_TTL"])
+
+
+### USER CACHE ###
+# columns of the logged in user read on almost every request, other columns are loaded on first access
+USER_CACHE_COLUMNS = ("id", "username", "avatar", "last_notification_read_time", "last_message_read_time",
+                      "last_message_sent_time", "deleted")
+# datetime columns, stored as ISO strings - the row is kept as JSON, which every backend can store
+USER_CACHE_DATETIMES = ("last_notification_read_time", "last_message_read_time", "last_message_sent_time")
+
+
+def _user_key(user_id):
+    return f"user:{user_id}"
+
+
+def _dump_user(user):
+    row = {column: getattr(user, column) for column in USER_CACHE_COLUMNS}
+    for column in USER_CACHE_DATETIMES:
+        row[column] = row[column].isoformat() if row[column] else None
+    return json.dumps(row)
+
+
+def _load_row(value):
+    row = json.loads(value)
+    for column in USER_CACHE_DATETIMES:
+        row[column] = dt.datetime.fromisoformat(row[column]) if row[column] else None
+    return row
+
+
+def load_user(user_id):
+    """
+    Loader of the logged in user for Flask-Login. The cached row is attached to the session without a SELECT. The
+    cache (USER_CACHE_URL) is shared by all workers and cleared by invalidate_user after a change of the user, so
+    every worker sees the change - e.g. the deleted flag - with the next request.
+
+    :param user_id: ID of the user stored in the session cookie.
+    :return: User object or None.
+    """
+    from .models import User
+    from . import db
+    from sqlalchemy.orm import make_transient_to_detached
+    backend = current_app.extensions.get("user_cache")
+    if backend is None:
+        user = db.session.get(User, user_id)
+        return user if user is not None and not user.deleted else None
+    value = backend.get(_user_key(user_id))
+    if value is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        backend.set(_user_key(user_id), _dump_user(user))
+        return user if not user.deleted else None
+    row = _load_row(value)
+    if row["deleted"]:
+        # accounts being deleted are logged out
+        return None
+    user = User(**row)
+    make_transient_to_detached(user)
+    # load=False attaches the object as it is, or returns the instance already present in the session
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    """
+    Removes the cached row of the user, must be called after a change of any column in USER_CACHE_COLUMNS or of the
+    password.
+
+    :param user_id: ID of the changed user.
+    """
+    backend = current_app.extensions.get("user_cache")
+    if backend is not None:
+        backend.delete(_user_key(user_id))
+
+
+def init_user_cache(app):
+    """
+    Creates the cache of logged in users in the USER_CACHE_URL backend, see create_backend. An empty URL or a
+    USER_CACHE_TTL of 0 turns it off. "memory" keeps a copy per worker - an invalidation clears only the worker
+    which made the change, so it is meant for a single worker process.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("USER_CACHE_URL", "")
+    app.config.setdefault("USER_CACHE_TTL", 30)
+    app.config.setdefault("USER_CACHE_SIZE", 10000)
+    if app.config["USER_CACHE_URL"] and app.config["USER_CACHE_TTL"]:
+        app.extensions["user_cache"] = create_backend(app.config["USER_CACHE_URL"], app.config["USER_CACHE_SIZE"],
+                                                      app.config["USER_CACHE_TTL"])
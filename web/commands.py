@@ -0,0 +1,47 @@
+from flask.cli import AppGroup
+from .models import AccountDeletion, Comment, Picture
+from .deletion import resume_deletions
+
+
+accounts_cli = AppGroup("accounts", help="Account maintenance.")
+comments_cli = AppGroup("comments", help="Comment maintenance.")
+likes_cli = AppGroup("likes", help="Like maintenance.")
+
+
+@accounts_cli.command("deletions")
+def deletions():
+    """Progress of account deletions."""
+    for deletion in AccountDeletion.query.order_by(AccountDeletion.id.desc()).limit(50):
+        print(f"{deletion.id} {deletion.username} {deletion.status} step={deletion.step} "
+              f"rows={deletion.rows_deleted} {deletion.error or ''}")
+
+
+@accounts_cli.command("resume-deletions")
+def resume():
+    """Run again account deletions which did not finish."""
+    print(f"{resume_deletions()} deletions resumed")
+
+
+@comments_cli.command("recount-likes")
+def recount_likes():
+    """Set like_count of all comments from the likes table."""
+    Comment.recount_likes()
+    print("like counts updated")
+
+
+@likes_cli.command("recount")
+def recount_picture_likes():
+    """Set like_count of all pictures from the likes table and empty the like shards."""
+    Picture.recount_likes()
+    print("like counts updated")
+
+
+def init_commands(app):
+    """
+    Registers maintenance CLI commands, e.g. "flask accounts deletions" or "flask likes recount".
+
+    :param app: Flask application.
+    """
+    app.cli.add_command(accounts_cli)
+    app.cli.add_command(comments_cli)
+    app.cli.add_command(likes_cli)
@@ -0,0 +1,148 @@
+from flask import current_app, url_for
+from . import db
+from .models import User, Picture, PictureLikeShard, LikeEvent, Notification
+from .helpers import _insert_ignore
+from .tasks import submit, every
+from .trending import score_values
+from threading import Lock
+import random
+
+
+### WRITE-BEHIND JOURNAL ###
+def _buffer():
+    # likes journaled by this worker since its last early flush
+    return current_app.extensions["counters"]
+
+
+def record_like(picture, user, delta):
+    """
+    Adds a like (+1) or an unlike (-1) of the picture to the journal, in the transaction of the Like row - the
+    caller commits both, so a worker killed before the next flush loses no count. The request only inserts rows, the
+    picture row, its shards and the notification of the author are written later by flush_likes, once for all
+    likes of the picture journaled in the meantime.
+
+    :param picture: Picture object.
+    :param user: User who (un)liked the picture.
+    :param delta: 1 for a like, -1 for an unlike.
+    """
+    db.session.add(LikeEvent(picture_id=picture.id, author_id=picture.author_id, user_id=user.id, delta=delta,
+                             link=url_for("views.view_picture", id=picture.id)))
+    counters = _buffer()
+    with counters["lock"]:
+        counters["events"] += 1
+        full = counters["events"] >= current_app.config["LIKE_BUFFER_SIZE"]
+        if full:
+            counters["events"] = 0
+    if current_app.config["TASKS_EAGER"]:
+        # no periodic threads - write through, committing the like as well
+        submit(flush_likes)
+        submit(fold_likes)
+    elif full:
+        submit(flush_likes)
+
+
+def _notification_body(likers):
+    if len(likers) == 1:
+        return f"{likers[0]} liked your post."
+    return f"{likers[-1]} and {len(likers) - 1} other user(s) liked your post."
+
+
+def flush_likes():
+    """
+    Writes up to LIKE_FLUSH_BATCH journaled events: the delta of every picture is added to one of its LIKE_SHARDS
+    shard rows, picked at random, and to its trending score, and one notification is created per picture for all its
+    new likes. The events are deleted in the same transaction, a failed flush leaves them for the next one. Runs
+    every LIKE_FLUSH_SECONDS and when a worker journaled LIKE_BUFFER_SIZE likes.
+
+    :return: Number of pictures written.
+    """
+    events = LikeEvent.query.order_by(LikeEvent.id).limit(current_app.config["LIKE_FLUSH_BATCH"]).all()
+    if not events:
+        return 0
+    try:
+        # claims the events - if a flush of another worker deleted some of them first, it writes them
+        claimed = db.session.query(LikeEvent).filter(LikeEvent.id.in_([event.id for event in events])).delete(
+            synchronize_session=False)
+        if claimed != len(events):
+            db.session.rollback()
+            return 0
+        pending = {}
+        for event in events:
+            entry = pending.setdefault(event.picture_id, {"delta": 0, "author_id": event.author_id, "likers": [],
+                                                          "link": event.link})
+            entry["delta"] += event.delta
+            if event.delta > 0 and event.user_id and event.user_id != event.author_id:
+                entry["likers"].append(event.user_id)
+        # pictures deleted in the meantime are skipped, their shards would violate the foreign key
+        existing = {row.id for row in db.session.query(Picture.id).filter(Picture.id.in_(list(pending)))}
+        liker_ids = {user_id for entry in pending.values() for user_id in entry["likers"]}
+        names = dict(db.session.query(User.id, User.username).filter(User.id.in_(liker_ids))) if liker_ids else {}
+        shards = current_app.config["LIKE_SHARDS"]
+        for picture_id in sorted(existing):
+            entry = pending[picture_id]
+            if entry["delta"]:
+                shard = random.randrange(shards)
+                db.session.execute(_insert_ignore(PictureLikeShard.__table__).values(
+                    picture_id=picture_id, shard=shard, delta=0))
+                db.session.query(PictureLikeShard).filter_by(picture_id=picture_id, shard=shard).update(
+                    {"delta": PictureLikeShard.delta + entry["delta"]}, synchronize_session=False)
+                db.session.query(Picture).filter_by(id=picture_id).update(
+                    score_values("like", entry["delta"]), synchronize_session=False)
+            # users deleted in the meantime are left out of the notification
+            likers = [user_id for user_id in entry["likers"] if user_id in names]
+            if likers:
+                db.session.add(Notification(sender_id=likers[-1],
+                                            recipient_id=entry["author_id"],
+                                            type="like",
+                                            body=_notification_body([names[user_id] for user_id in likers]),
+                                            link=entry["link"]))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(existing)
+
+
+def fold_likes():
+    """
+    Moves the shard deltas into Picture.like_count and bumps the version of the changed pictures, so cached gallery
+    tiles are rendered again. A shard is decreased by the folded amount - deltas flushed while folding stay in it -
+    and deleted once it is 0, so the table only holds shards with unfolded likes. Runs every LIKE_FOLD_SECONDS in one
+    process of the host.
+
+    :return: Number of pictures folded.
+    """
+    rows = db.session.query(PictureLikeShard.picture_id, PictureLikeShard.shard, PictureLikeShard.delta).filter(
+        PictureLikeShard.delta != 0).order_by(PictureLikeShard.picture_id, PictureLikeShard.shard).all()
+    folded = {}
+    for picture_id, shard, delta in rows:
+        db.session.query(PictureLikeShard).filter_by(picture_id=picture_id, shard=shard).update(
+            {"delta": PictureLikeShard.delta - delta}, synchronize_session=False)
+        folded[picture_id] = folded.get(picture_id, 0) + delta
+    for picture_id, delta in folded.items():
+        db.session.query(Picture).filter_by(id=picture_id).update(
+            {"like_count": Picture.like_count + delta, "version": Picture.version + 1}, synchronize_session=False)
+    if folded:
+        db.session.query(PictureLikeShard).filter(PictureLikeShard.picture_id.in_(list(folded)),
+                                                  PictureLikeShard.delta == 0).delete(synchronize_session=False)
+    db.session.commit()
+    return len(folded)
+
+
+def init_counters(app):
+    """
+    Sets up write-behind like counters. A like is visible in counts after at most LIKE_FLUSH_SECONDS (summed from
+    the shards) and in cached gallery tiles after LIKE_FLUSH_SECONDS + LIKE_FOLD_SECONDS, unless more than
+    LIKE_FLUSH_BATCH likes are journaled per LIKE_FLUSH_SECONDS.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("LIKE_SHARDS", 8)
+    app.config.setdefault("LIKE_FLUSH_SECONDS", 2)
+    app.config.setdefault("LIKE_FOLD_SECONDS", 10)
+    app.config.setdefault("LIKE_BUFFER_SIZE", 500)
+    app.config.setdefault("LIKE_FLUSH_BATCH", 5000)
+    app.extensions["counters"] = {"lock": Lock(), "events": 0}
+    every(app, app.config["LIKE_FLUSH_SECONDS"], flush_likes)
+    every(app, app.config["LIKE_FOLD_SECONDS"], fold_likes, single=True)
+
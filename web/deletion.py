@@ -0,0 +1,227 @@
+from flask import current_app
+from . import db
+from .models import (User, Picture, Comment, Like, Story, Notification, UserMessage, ConversationRead, Bookmark,
+                     AccountDeletion, PictureLikeShard, LikeEvent, followers, blocked)
+from .tasks import submit, every
+from .counters import flush_likes, fold_likes
+from .archive import purge_user
+from .uploads import discard_uploads
+from werkzeug.utils import secure_filename
+import datetime as dt
+import logging
+import os
+import shutil
+
+
+logger = logging.getLogger("instaclone.deletion")
+
+
+def _now():
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+def start_deletion(user):
+    """
+    Marks the user as deleted - they can no longer log in and are hidden immediately - and starts the background
+    job deleting their data.
+
+    :param user: User to delete.
+    :return: AccountDeletion object tracking the progress.
+    """
+    user.deleted = True
+    deletion = AccountDeletion(user_id=user.id, username=user.username, status="pending")
+    db.session.add(deletion)
+    # without follow relations the user drops out of feeds, stories and recommendations right away, the job's
+    # relations step finds nothing left to delete
+    db.session.execute(followers.delete().where(db.or_(followers.c.follower_id == user.id,
+                                                       followers.c.followed_id == user.id)))
+    db.session.commit()
+    submit(run_deletion, deletion.id)
+    return deletion
+
+
+### BATCHED DELETES ###
+def _delete_batches(deletion, step, model, condition, on_batch=None):
+    """
+    Deletes rows of the model matching the condition, ACCOUNT_DELETION_BATCH rows per statement and transaction, so
+    that no transaction holds locks on a large part of a table.
+
+    :param on_batch: Called with the IDs of every batch before it is deleted.
+    """
+    deletion.step = step
+    while True:
+        ids = [row.id for row in db.session.query(model.id).filter(condition).limit(
+            current_app.config["ACCOUNT_DELETION_BATCH"])]
+        if not ids:
+            break
+        if on_batch:
+            on_batch(ids)
+        deleted = db.session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        deletion.rows_deleted += deleted
+        db.session.commit()
+
+
+def _remove_files(paths):
+    # paths are stored as browser paths: /static/uploads/<username>/<file>, shared static files are never removed
+    for path in paths:
+        if not path or not path.startswith("/static/uploads/"):
+            continue
+        try:
+            os.remove(f"web{path}")
+        except FileNotFoundError:
+            pass
+
+
+def run_deletion(deletion_id):
+    """
+    Background job deleting all data of a user with set-based DELETEs in bounded batches. Every step is idempotent,
+    so an interrupted job is simply started again (see "flask accounts resume-deletions").
+
+    :param deletion_id: ID of the AccountDeletion.
+    """
+    deletion = db.session.get(AccountDeletion, deletion_id)
+    user_id = deletion.user_id
+    deletion.status = "running"
+    deletion.started_at = deletion.started_at or _now()
+    db.session.commit()
+    try:
+        user_pictures = db.session.query(Picture.id).filter(Picture.author_id == user_id)
+        picture_comments = db.session.query(Comment.id).filter(Comment.picture_id.in_(user_pictures))
+
+        def correct_like_counts(ids):
+            # likes of pictures of other users go through the counters journal like unlikes, so their shards,
+            # trending scores and cached tiles follow - comment counts are kept in sync directly
+            for picture_id, author_id, count in db.session.query(
+                    Like.picture_id, Picture.author_id, db.func.count(Like.id)).join(
+                    Picture, Picture.id == Like.picture_id).filter(
+                    Like.id.in_(ids), Picture.author_id != user_id).group_by(Like.picture_id, Picture.author_id):
+                db.session.add(LikeEvent(picture_id=picture_id, author_id=author_id, delta=-count))
+            for comment_id, count in db.session.query(Like.comment_id, db.func.count(Like.id)).filter(
+                    Like.id.in_(ids), Like.comment_id.isnot(None)).group_by(Like.comment_id):
+                db.session.query(Comment).filter_by(id=comment_id).update(
+                    {"like_count": Comment.like_count - count}, synchronize_session=False)
+
+        # likes given by the user and likes of their pictures and of comments below them
+        _delete_batches(deletion, "likes", Like, db.or_(Like.author_id == user_id,
+                                                         Like.picture_id.in_(user_pictures),
+                                                         Like.comment_id.in_(picture_comments)),
+                        correct_like_counts)
+        submit(flush_likes)
+        submit(fold_likes)
+        # comments below the user's pictures, likes of these comments are gone already
+        _delete_batches(deletion, "comments", Comment, Comment.picture_id.in_(user_pictures))
+
+        # association rows, at most one row per followed/blocked user or bookmark - a single statement each
+        deletion.step = "relations"
+        deletion.rows_deleted += db.session.query(Bookmark).filter(db.or_(
+            Bookmark.user_id == user_id, Bookmark.picture_id.in_(user_pictures))).delete(synchronize_session=False)
+        for statement in (followers.delete().where(db.or_(followers.c.follower_id == user_id,
+                                                          followers.c.followed_id == user_id)),
+                          blocked.delete().where(db.or_(blocked.c.blocked_id == user_id,
+                                                        blocked.c.blocker_id == user_id))):
+            deletion.rows_deleted += db.session.execute(statement).rowcount
+        deletion.rows_deleted += db.session.query(PictureLikeShard).filter(
+            PictureLikeShard.picture_id.in_(user_pictures)).delete(synchronize_session=False)
+        deletion.rows_deleted += db.session.query(ConversationRead).filter(db.or_(
+            ConversationRead.user_id == user_id, ConversationRead.partner_id == user_id)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+        def remove_picture_files(ids):
+            paths = [row.file for row in db.session.query(Picture.file).filter(Picture.id.in_(ids))]
+            submit(_remove_files, paths)
+
+        def remove_story_files(ids):
+            paths = [row.file for row in db.session.query(Story.file).filter(Story.id.in_(ids))]
+            submit(_remove_files, paths)
+
+        _delete_batches(deletion, "pictures", Picture, Picture.author_id == user_id, remove_picture_files)
+        _delete_batches(deletion, "stories", Story, Story.author_id == user_id, remove_story_files)
+        _delete_batches(deletion, "notifications", Notification, db.or_(Notification.sender_id == user_id,
+                                                                         Notification.recipient_id == user_id))
+        _delete_batches(deletion, "messages", UserMessage, db.or_(UserMessage.sender_id == user_id,
+                                                                  UserMessage.recipient_id == user_id))
+        # messages and notifications already moved to the archive files
+        deletion.step = "archive"
+        deletion.rows_deleted += purge_user(user_id)
+        db.session.commit()
+
+        # comments below pictures of other users stay, without their author - as before
+        deletion.step = "comment authors"
+        while db.session.query(Comment).filter(Comment.id.in_(
+                db.session.query(Comment.id).filter(Comment.author_id == user_id).limit(
+                    current_app.config["ACCOUNT_DELETION_BATCH"]).scalar_subquery())).update(
+                {"author_id": None}, synchronize_session=False):
+            db.session.commit()
+
+        # unfinished uploads and their part files
+        deletion.step = "uploads"
+        deletion.rows_deleted += discard_uploads(user_id)
+
+        # the user row itself, through the ORM to remove it from the search index as well
+        deletion.step = "user"
+        user = db.session.get(User, user_id)
+        if user is not None:
+            db.session.delete(user)
+            deletion.rows_deleted += 1
+        deletion.status = "done"
+        deletion.finished_at = _now()
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        deletion.status = "failed"
+        deletion.error = str(error)[:500]
+        db.session.commit()
+        raise
+    # avatar and anything left in the upload directory - never a path outside of it
+    if deletion.username and secure_filename(deletion.username) == deletion.username:
+        submit(shutil.rmtree, f"web/static/uploads/{deletion.username}", True)
+    return deletion.rows_deleted
+
+
+def resume_deletions():
+    """
+    Starts again all deletions which did not finish, e.g. because the worker was restarted.
+
+    :return: Number of restarted deletions.
+    """
+    unfinished = AccountDeletion.query.filter(AccountDeletion.status != "done").all()
+    for deletion in unfinished:
+        submit(run_deletion, deletion.id)
+    return len(unfinished)
+
+
+def requeue_deletions():
+    """
+    Periodic task starting again deletions which failed or made no progress for ACCOUNT_DELETION_STALE_SECONDS,
+    e.g. because the worker running them was restarted. Every deletion is claimed with a conditional UPDATE, so only
+    one worker starts it.
+
+    :return: Number of restarted deletions.
+    """
+    cutoff = _now() - dt.timedelta(seconds=current_app.config["ACCOUNT_DELETION_STALE_SECONDS"])
+    last_progress = db.func.coalesce(AccountDeletion.updated_at, AccountDeletion.date_created)
+    stale = db.session.query(AccountDeletion.id, AccountDeletion.status).filter(
+        AccountDeletion.status.in_(("pending", "running", "failed")), last_progress < cutoff).all()
+    requeued = 0
+    for deletion_id, status in stale:
+        claimed = db.session.query(AccountDeletion).filter(
+            AccountDeletion.id == deletion_id, AccountDeletion.status == status, last_progress < cutoff).update(
+            {"status": "pending", "updated_at": _now()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            logger.warning("restarting %s account deletion %s", status, deletion_id)
+            submit(run_deletion, deletion_id)
+            requeued += 1
+    return requeued
+
+
+def init_deletion(app):
+    """
+    Restarts failed and stuck account deletions in the background, see requeue_deletions.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("ACCOUNT_DELETION_BATCH", 1000)
+    app.config.setdefault("ACCOUNT_DELETION_STALE_SECONDS", 600)
+    every(app, max(app.config["ACCOUNT_DELETION_STALE_SECONDS"] // 2, 1), requeue_deletions)
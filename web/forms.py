@@ -2,6 +2,7 @@ from flask_wtf import FlaskForm
 from wtforms.validators import DataRequired, Length, Email, EqualTo
 from wtforms import ValidationError
 from .models import User
+from .helpers import sniff_image, SNIFF_BYTES
 from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
 from flask import request
@@ -68,9 +69,19 @@ class ChangePasswordForm(FlaskForm):
 
 
 ### VIEWS FORMS ###
+def image_content(form, field):
+    # custom validator - the file must start like a JPEG or PNG, whatever its extension says
+    if field.data:
+        header = field.data.stream.read(SNIFF_BYTES)
+        field.data.stream.seek(0)
+        if sniff_image(header) is None:
+            raise ValidationError('File was not accepted. Please upload images only.')
+
+
 class UploadForm(FlaskForm):
     file = FileField('Upload Picture', validators=[DataRequired(), FileAllowed(['jpg', 'png', 'jpeg'],
-                                                                               'File was not accepted. Please upload images only.')])
+                                                                               'File was not accepted. Please upload images only.'),
+                                                   image_content])
     description = TextAreaField('Description', validators=[DataRequired(), Length(1, 750)])
     private = BooleanField('Disable comments and likes')
     location = BooleanField('Share your current location')
@@ -81,7 +92,8 @@ class SettingsForm(FlaskForm):
     description = TextAreaField('Description', validators=[DataRequired(), Length(1, 750)])
     file = FileField('New Profile Picture',
                      validators=[
-                         FileAllowed(['jpg', 'png', 'jpeg'], 'File was not accepted. Please upload images only.')])
+                         FileAllowed(['jpg', 'png', 'jpeg'], 'File was not accepted. Please upload images only.'),
+                         image_content])
     not_recommend = BooleanField('Do not recommend profile')
     submit = SubmitField('Save Edits')
 
@@ -103,7 +115,8 @@ class CommentForm(FlaskForm):
 
 class StoryForm(FlaskForm):
     file = FileField('Upload Picture', validators=[DataRequired(), FileAllowed(['jpg', 'png', 'jpeg'],
-                                                                               'File was not accepted. Please upload images only.')])
+                                                                               'File was not accepted. Please upload images only.'),
+                                                   image_content])
     time_span = SelectField('Show for', validators=[DataRequired()], choices=[('12', '12 Hours'),
                                                                               ('24', '24 Hours'),
                                                                               ('48', '48 Hours'),
@@ -0,0 +1,164 @@
+from flask import current_app, request
+from . import db
+from .cache import LRUCache
+from .metrics import timer
+from .tasks import submit
+from threading import Lock
+import ipaddress
+import logging
+import os
+
+
+logger = logging.getLogger("instaclone.geo")
+
+
+### CLIENT IP ###
+def client_ip():
+    """
+    IP address of the client. X-Forwarded-For is read from the right, skipping the GEO_PROXY_COUNT proxies in front
+    of the application - addresses further left are set by the client and cannot be trusted. Local and private
+    addresses are replaced with the MY_IP environment variable when running locally.
+
+    :return: ipaddress.IPv4Address/IPv6Address or None.
+    """
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    hops.append(request.remote_addr or "")
+    index = max(0, len(hops) - 1 - current_app.config["GEO_PROXY_COUNT"])
+    try:
+        ip = ipaddress.ip_address(hops[index])
+    except ValueError:
+        return None
+    if not ip.is_global:
+        try:
+            return ipaddress.ip_address(os.getenv("MY_IP", ""))
+        except ValueError:
+            return None
+    return ip
+
+
+def _cache_key(ip):
+    # addresses of one /24 (IPv6 /48) network are practically always at the same place
+    prefix = 24 if ip.version == 4 else 48
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+### BACKENDS ###
+def _format(country, region):
+    return ", ".join(part for part in (country, region) if part)
+
+
+def _lookup_http(ip):
+    """
+    Location from ip-api.com, bounded by GEO_CONNECT_TIMEOUT and GEO_READ_TIMEOUT.
+    """
+    # imported here, only the HTTP backend needs it
+    import requests
+    config = current_app.config
+    with timer("upload_seconds", step="location"):
+        response = requests.get(f"http://ip-api.com/json/{ip}?fields=status,country,regionName",
+                                timeout=(config["GEO_CONNECT_TIMEOUT"], config["GEO_READ_TIMEOUT"]))
+    data = response.json()
+    if data.get("status") != "success":
+        return ""
+    return _format(data.get("country"), data.get("regionName"))
+
+
+def _lookup_mmdb(ip):
+    """
+    Location from a MaxMind GeoLite2/GeoIP2 City database (GEO_DATABASE). The file is memory-mapped once per worker,
+    a lookup does not touch the network.
+    """
+    geo = current_app.extensions["geo"]
+    if geo["reader"] is None:
+        with geo["lock"]:
+            if geo["reader"] is None:
+                # optional dependency, only needed with a local database
+                import maxminddb
+                geo["reader"] = maxminddb.open_database(current_app.config["GEO_DATABASE"], maxminddb.MODE_MMAP)
+    record = geo["reader"].get(str(ip)) or {}
+    country = record.get("country", {}).get("names", {}).get("en")
+    subdivisions = record.get("subdivisions") or [{}]
+    return _format(country, subdivisions[0].get("names", {}).get("en"))
+
+
+### LOOKUP ###
+def cached_location(ip):
+    """
+    Location without waiting on the network - from the cache or from the local database.
+
+    :param ip: IP address.
+    :return: Location string ("" if unknown), or None if it has to be resolved over the network.
+    """
+    geo = current_app.extensions["geo"]
+    location = geo["cache"].get(_cache_key(ip))
+    if location is None and current_app.config["GEO_DATABASE"]:
+        location = _lookup_mmdb(ip)
+        geo["cache"].set(_cache_key(ip), location)
+    return location
+
+
+def resolve_location(ip):
+    """
+    Location of the IP address, from the cache, the local database or ip-api.com. Errors and timeouts give "" and
+    are cached for GEO_FAILURE_TTL seconds, so an unreachable service is not asked again for every upload but a
+    short outage does not leave the network without locations for a day.
+
+    :param ip: IP address.
+    :return: Location string, e.g. "Czechia, Prague", or "" if unknown.
+    """
+    location = cached_location(ip)
+    if location is not None:
+        return location
+    try:
+        location = _lookup_http(ip)
+    except Exception as error:
+        logger.warning("geolocation of %s failed: %s", ip, error)
+        current_app.extensions["geo"]["cache"].set(_cache_key(ip), "", current_app.config["GEO_FAILURE_TTL"])
+        return ""
+    current_app.extensions["geo"]["cache"].set(_cache_key(ip), location)
+    return location
+
+
+def _fill_location(picture_id, ip):
+    from .models import Picture
+    location = resolve_location(ip)
+    if location:
+        Picture.query.filter_by(id=picture_id).update({"location": location})
+        db.session.commit()
+
+
+def locate_picture(picture, ip=None):
+    """
+    Sets location of an uploaded picture. Known locations are set immediately, otherwise the location is resolved
+    in the background and written to the picture later - the upload never waits on ip-api.com. Must be called after
+    the picture is committed.
+
+    :param picture: Picture object.
+    :param ip: IP address, client_ip() by default.
+    """
+    ip = ip or client_ip()
+    if ip is None:
+        return
+    location = cached_location(ip)
+    if location is None:
+        submit(_fill_location, picture.id, ip)
+    elif location:
+        picture.location = location
+        db.session.commit()
+
+
+def init_geo(app):
+    """
+    Configures geolocation. GEO_DATABASE is the path to a .mmdb file, without it ip-api.com is used.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("GEO_DATABASE", None)
+    app.config.setdefault("GEO_PROXY_COUNT", 1)
+    app.config.setdefault("GEO_CONNECT_TIMEOUT", 1.0)
+    app.config.setdefault("GEO_READ_TIMEOUT", 2.0)
+    app.config.setdefault("GEO_CACHE_SIZE", 10000)
+    app.config.setdefault("GEO_CACHE_TTL", 24 * 3600)
+    app.config.setdefault("GEO_FAILURE_TTL", 300)
+    app.extensions["geo"] = {"cache": LRUCache(maxsize=app.config["GEO_CACHE_SIZE"], ttl=app.config["GEO_CACHE_TTL"]),
+                             "reader": None, "lock": Lock()}
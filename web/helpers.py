@@ -1,69 +1,123 @@
 from werkzeug.utils import secure_filename
 import uuid
 import os
+import shutil
 from . import db
-from .models import User, Picture, followers, Story
+from .models import (User, Picture, Comment, Like, followers, blocked, Bookmark, Story, UserMessage, ConversationRead,
+                     Notification)
+from sqlalchemy.exc import IntegrityError
 from flask_login import current_user
 from random import shuffle
 import datetime as dt
-import shutil
-from flask import flash, request
-import requests
-import tinify
+from flask import flash, g, abort
+from .metrics import timer
+from .archive import archived_messages
+from .geo import locate_picture
 
 
-tinify.key = os.getenv("YOUR_API_KEY")
+### UPLOADING ###
+# leading bytes of the accepted image types, see sniff_image
+IMAGE_SIGNATURES = {"jpeg": b"\xff\xd8\xff", "png": b"\x89PNG\r\n\x1a\n"}
+SNIFF_BYTES = 8
 
 
-### UPLOADING ###
-def get_location():
+def sniff_image(header):
     """
-    Gets current location data from user's IP using ip-api.com
+    Detects the image type from the first bytes of a file instead of trusting its extension.
 
-    :return: Returns string with user location or empty string on error.
+    :param header: At least SNIFF_BYTES leading bytes of the file.
+    :return: "jpeg", "png" or None if the file is not an accepted image.
     """
-    try:
-        _ip_addr = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-        # if run locally
-        if _ip_addr == "127.0.0.1":
-            ip_addr = os.getenv("MY_IP")
-        # if deployed
-        else:
-            ip_addr = _ip_addr.split(",")[1].replace(' ', '')
-        response = requests.get(f"http://ip-api.com/json/{ip_addr}?fields=country,regionName,city")
-        data = response.json()
-        location = f"{data['country'], data['regionName']}".replace('(', '').replace(')', '').replace("'", '')
-    except:
-        return ""
-    return location
+    for image_type, signature in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return image_type
+    return None
 
 
-def upload_file(file, user_name):
+def upload_file(file, user_name, filename=None):
     """
     Saves a picture file uploaded by the user and returns string with the filepath. The file name is hashed to allow
     uploading multiple files with the same name. Pictures are compressed using tinify api.
 
-    :param file: (werkzeug.datastructures.FileStorage) A file uploaded by the user
+    :param file: (werkzeug.datastructures.FileStorage) A file uploaded by the user, or the path of a file assembled
+        by a resumable upload (see uploads.py) - it is moved into the upload directory.
     :param user_name: Name of the user under which the file will be stored
+    :param filename: Original name of a file given by its path.
     :return: String with the filepath: f'/static/uploads/{user_name}/{filename}
     """
     salt = str(uuid.uuid4())
-    filename = f"{salt}{secure_filename(file.filename)}"
+    if isinstance(file, str):
+        filename = f"{salt}{secure_filename(filename or os.path.basename(file))}"
+    else:
+        filename = f"{salt}{secure_filename(file.filename)}"
     filepath = f'web/static/uploads/{user_name}'
     save_path = f"{filepath}/{filename}"
     browser_path = f'/static/uploads/{user_name}/{filename}'
     if not os.path.exists(filepath):
         os.makedirs(filepath)
-    file.save(save_path)
-    # image compression
+    with timer("upload_seconds", step="save"):
+        if isinstance(file, str):
+            shutil.move(file, save_path)
+        else:
+            file.save(save_path)
+    # image compression - tinify is imported on the first upload, not on worker start
+    import tinify
+    tinify.key = os.getenv("YOUR_API_KEY")
     try:
-        source = tinify.from_file(save_path)
-        source.to_file(save_path)
+        with timer("upload_seconds", step="compress"):
+            source = tinify.from_file(save_path)
+            source.to_file(save_path)
     except tinify.AccountError:
         pass
     return browser_path
 
 
+def create_picture(user, filepath, description, private=False, share_location=False):
+    """
+    Creates a picture post of an uploaded file - from the upload form or a finished resumable upload.
+
+    :param filepath: Browser path returned by upload_file.
+    :param share_location: Fill in the location from the uploader's IP address.
+    :return: Picture object.
+    """
+    picture = Picture(description=description, location="", private=private, file=filepath, author=user)
+    db.session.add(picture)
+    db.session.commit()
+    # if user wants to share location, it is filled in from the cache or in the background
+    if share_location:
+        locate_picture(picture)
+    return picture
+
+
+def create_story(user, filepath, time_span):
+    """
+    Creates a story of an uploaded file, shown for time_span hours.
+
+    :return: Story object.
+    """
+    story = Story(time_span=time_span, file=filepath, author=user)
+    db.session.add(story)
+    db.session.commit()
+    return story
+
+
+### VISIBLE OBJECTS ###
+# accounts marked deleted are hidden at once, their rows are removed later by the background job in deletion.py
+def active_user_or_404(user_id):
+    """
+    Loads a user, 404 if the user does not exist or deleted their account.
+    """
+    return User.query.filter(User.id == user_id, User.deleted.isnot(True)).first_or_404()
+
+
+def visible_picture_or_404(picture_id):
+    """
+    Loads a picture, 404 if it does not exist or its author deleted their account.
+    """
+    return Picture.query.join(User, Picture.author_id == User.id).filter(
+        Picture.id == picture_id, User.deleted.isnot(True)).first_or_404()
+
+
 ### BLOCKING USERS ###
 def block_user(user_id):
     """
@@ -84,6 +138,8 @@ def block_user(user_id):
         if user in current_user.followed:
             current_user.followed.remove(user)
     db.session.commit()
+    # followed users changed, drop IDs cached by User.followed_ids()
+    g.pop("_followed_ids", None)
     return True
 
 
@@ -112,20 +168,23 @@ def follow_user(user_id):
     :param user_id: ID of the user to be (un)followed.
     :return: True if successful.
     """
-    user = User.query.filter_by(id=user_id).first_or_404()
+    user = active_user_or_404(user_id)
     if user in current_user.followed:
         current_user.followed.remove(user)
     else:
         current_user.followed.append(user)
     db.session.commit()
+    # followed users changed, drop IDs cached by User.followed_ids()
+    g.pop("_followed_ids", None)
     return True
 
 
-def followed_posts():
+def followed_posts(page=0):
     """
     Provides main page feed of pictures for current_user.
 
-    :return: Query result of pictures for the current user's main page feed.
+    :param page: Offset of the first picture, see load_page.
+    :return: List of PAGE_SIZE pictures for the current user's main page feed.
     """
     # posts of followed users
     # query below explained here: https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-viii-followers
@@ -135,7 +194,7 @@ def followed_posts():
     # user's own pictures
     own = Picture.query.filter_by(author_id=current_user.id)
     # combine 2 queries
-    return followed.union(own).order_by(Picture.date_created.desc()).all()
+    return paginate(followed.union(own).order_by(Picture.date_created.desc()).options(*post_card_options()), page)
 
 
 def followed_stories():
@@ -151,7 +210,7 @@ def followed_stories():
     # current_user's stories
     own = Story.query.filter_by(author_id=current_user.id)
     # combine 2 queries
-    combine = followed.union(own).order_by(Story.date_created.desc()).all()
+    combine = followed.union(own).order_by(Story.date_created.desc()).options(db.joinedload(Story.author)).all()
     # check if story should be shown according to its time_span
     stories = []
     now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
@@ -180,11 +239,10 @@ def recommended_follow_you():
 
     :return: Shuffled list of users that follow current user and are not followed back.
     """
-    follows_you = []
-    # find users that meet conditions
-    for follower in current_user.followers:
-        if follower not in current_user.followed and follower.not_recommend is False:
-            follows_you.append(follower)
+    followed_ids = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == current_user.id)
+    # find users that meet conditions in one query
+    follows_you = current_user.followers.filter(~User.id.in_(followed_ids.scalar_subquery()),
+                                                User.not_recommend.is_(False)).all()
     # shuffle result
     shuffle(follows_you)
     return follows_you
@@ -197,45 +255,321 @@ def recommended_by_followed():
 
     :return: Shuffled list of tuples [(recommended_user, [mutual_friend_X, mutual_friend_Y, ...]), (...[...])]
     """
-    friends_follow = []
-    # find all users that current_user does not follow
-    not_followed_users = User.query.filter(~User.id.in_([followed.id for followed in current_user.followed])).all()
-    # find "mutual friends"
-    for user in not_followed_users:
-        # do not include 1) current_user 2) blocked users 3) users that block current_user 4) users with not_recommend True
-        if user != current_user and current_user not in user.blocked and user not in current_user.blocked and user.not_recommend is False:
-            # find "mutual friends" by intersecting current_user.followed and user.followers
-            common_followed = current_user.followed.intersect(user.followers).all()
-            if common_followed:
-                # append the list with (recommended_user, [mutual_friend_X, mutual_friend_Y, ...]
-                friends_follow.append((user, common_followed))
+    followed_ids = db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == current_user.id).scalar_subquery()
+    # blocked table stores the blocking user in blocked_id and the blocked user in blocker_id (see User.blocked)
+    blocked_ids = db.session.query(blocked.c.blocker_id).filter(blocked.c.blocked_id == current_user.id)
+    blocked_by_ids = db.session.query(blocked.c.blocked_id).filter(blocked.c.blocker_id == current_user.id)
+    # find "mutual friends" - pairs (recommended user, followed user that follows them) in one query
+    pairs_query = db.session.query(followers.c.followed_id, followers.c.follower_id).filter(
+        followers.c.follower_id.in_(followed_ids),
+        ~followers.c.followed_id.in_(followed_ids),
+        followers.c.followed_id != current_user.id,
+        # do not include 1) current_user 2) blocked users 3) users that block current_user
+        ~followers.c.followed_id.in_(blocked_ids.union(blocked_by_ids).scalar_subquery()))
+    pairs = pairs_query.all()
+    if not pairs:
+        return []
+    # load all involved users at once, 4) do not recommend users with not_recommend True
+    pairs_subquery = pairs_query.subquery()
+    users = {user.id: user for user in User.query.filter(db.or_(
+        User.id.in_(db.select(pairs_subquery.c.followed_id)), User.id.in_(db.select(pairs_subquery.c.follower_id))))}
+    mutual = {}
+    for recommended_id, friend_id in pairs:
+        if users[recommended_id].not_recommend is False:
+            mutual.setdefault(recommended_id, []).append(users[friend_id])
+    # append the list with (recommended_user, [mutual_friend_X, mutual_friend_Y, ...]
+    friends_follow = [(users[recommended_id], common_followed) for recommended_id, common_followed in mutual.items()]
     # shuffle result
     shuffle(friends_follow)
     return friends_follow
 
 
+### LIKES ###
+def _insert_ignore(table):
+    """
+    INSERT which skips rows violating a unique constraint - ON CONFLICT DO NOTHING on PostgreSQL and SQLite.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return db.insert(table).prefix_with("IGNORE", dialect="mysql")
+    return insert(table).on_conflict_do_nothing()
+
+
+def add_like(author_id, picture_id=None, comment_id=None):
+    """
+    Likes a picture or a comment with a single statement. Liking twice (double-clicks, concurrent requests) does
+    nothing - the unique constraint of likes makes the INSERT a no-op instead of creating a duplicate.
+
+    :return: True if the like was created, False if it existed already.
+    """
+    now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    result = db.session.execute(_insert_ignore(Like.__table__).values(
+        author_id=author_id, picture_id=picture_id, comment_id=comment_id, date_created=now))
+    return result.rowcount == 1
+
+
+def remove_like(author_id, picture_id=None, comment_id=None):
+    """
+    Removes a like of a picture or a comment with a single DELETE, removing a missing like does nothing.
+
+    :return: True if a like was deleted.
+    """
+    query = Like.query.filter_by(author_id=author_id)
+    query = query.filter_by(picture_id=picture_id) if picture_id else query.filter_by(comment_id=comment_id)
+    return query.delete(synchronize_session=False) > 0
+
+
+### QUERY BUILDERS ###
+# pictures are loaded in pages of 6, the last picture of a page asks for the next one through load_page
+PAGE_SIZE = 6
+COMMENT_PAGE_SIZE = 20
+# chat shows the last 30 messages, "load previous" adds 15 more, see messages-div.html
+CHAT_PAGE_SIZE = 30
+# the likes dropdown lists the latest 50 users who liked a picture
+LIKERS_LIMIT = 50
+
+
+def post_card_options():
+    """
+    Loader options for pictures rendered by home-feed.html, post-footer.html and picture.html - the author and the
+    like counter are loaded with the page. Likes are never loaded, the footer reads the viewer's like and followed
+    likers with Picture.load_viewer_likes and the list of likers is loaded on demand by picture_likers. Comments of
+    picture.html are loaded page by page with comment_page.
+    """
+    return (db.joinedload(Picture.author),
+            db.undefer(Picture.pending_likes))
+
+
+def gallery_options():
+    """
+    Loader options for pictures rendered by gallery-div.html, which shows the number of likes and comments. Likes
+    are counted by Picture.like_count and the shards summed with the page, the likes themselves are not loaded.
+    """
+    return (db.undefer(Picture.pending_likes),
+            db.selectinload(Picture.comments).load_only(Comment.id))
+
+
+def paginate(query, page):
+    """
+    Returns one page of the query.
+
+    :param query: Ordered query of pictures.
+    :param page: Offset of the first picture.
+    :return: List of up to PAGE_SIZE objects.
+    """
+    return query.offset(page).limit(PAGE_SIZE).all()
+
+
+def profile_pictures(user_id, page=0):
+    """
+    Provides pictures shown in the profile gallery.
+
+    :param user_id: ID of the profile owner.
+    :param page: Offset of the first picture, see load_page.
+    :return: List of PAGE_SIZE pictures.
+    """
+    query = Picture.query.filter_by(author_id=user_id).order_by(Picture.date_created.desc())
+    return paginate(query.options(*gallery_options()), page)
+
+
+def bookmark_cursor(bookmark):
+    """
+    Position of a bookmark in the saved posts, "<created_at>_<picture_id>" - the picture ID breaks ties of
+    bookmarks created in the same second.
+    """
+    return f"{bookmark.created_at.isoformat()}_{bookmark.picture_id}"
+
+
+def bookmarked_pictures(user, cursor=None):
+    """
+    Provides pictures bookmarked by the user, newest bookmarks first. Pages are selected by keyset pagination -
+    the query continues after the last shown bookmark and reads only PAGE_SIZE rows of the
+    (user_id, created_at) index, however many pictures the user has saved.
+
+    :param user: User whose bookmarks are shown.
+    :param cursor: Cursor of the last shown bookmark, see bookmark_cursor, None for the first page.
+    :return: Tuple (list of up to PAGE_SIZE pictures, cursor of the last one or None).
+    """
+    query = db.session.query(Bookmark, Picture).join(Picture, Bookmark.picture_id == Picture.id).join(
+        User, Picture.author_id == User.id).filter(Bookmark.user_id == user.id, User.deleted.isnot(True))
+    if cursor:
+        try:
+            created_at, picture_id = cursor.rsplit("_", 1)
+            created_at, picture_id = dt.datetime.fromisoformat(created_at), int(picture_id)
+        except ValueError:
+            abort(400, "Invalid cursor.")
+        query = query.filter(db.or_(Bookmark.created_at < created_at,
+                                    db.and_(Bookmark.created_at == created_at, Bookmark.picture_id < picture_id)))
+    rows = query.order_by(Bookmark.created_at.desc(), Bookmark.picture_id.desc()).options(
+        *gallery_options()).limit(PAGE_SIZE).all()
+    next_cursor = bookmark_cursor(rows[-1][0]) if rows else None
+    return [picture for bookmark, picture in rows], next_cursor
+
+
+def comment_page(picture_id, before=None):
+    """
+    Provides one page of comments of a picture, newest first. Keyset pagination - the next page continues below the
+    ID of the last shown comment, an index range scan of (picture_id, id) however many comments the picture has.
+
+    :param picture_id: ID of the picture.
+    :param before: ID of the last shown comment, None for the first page.
+    :return: Tuple (list of up to COMMENT_PAGE_SIZE comments with authors, ID for the next page or None).
+    """
+    query = Comment.query.filter_by(picture_id=picture_id)
+    if before:
+        query = query.filter(Comment.id < before)
+    comments = query.order_by(Comment.id.desc()).options(db.joinedload(Comment.author)).limit(
+        COMMENT_PAGE_SIZE + 1).all()
+    # one extra row tells whether there is a next page
+    if len(comments) > COMMENT_PAGE_SIZE:
+        comments = comments[:COMMENT_PAGE_SIZE]
+        return comments, comments[-1].id
+    return comments, None
+
+
+def picture_likers(picture_id):
+    """
+    Users who liked the picture, newest likes first, shown in the likes dropdown - at most LIKERS_LIMIT of them.
+
+    :return: List of User objects.
+    """
+    return User.query.join(Like, Like.author_id == User.id).filter(
+        Like.picture_id == picture_id, User.deleted.isnot(True)).order_by(Like.id.desc()).limit(LIKERS_LIMIT).all()
+
+
+def liked_comment_ids(user_id, comments):
+    """
+    IDs of the given comments liked by the user, one query for the whole page of comments.
+
+    :return: Set of comment IDs.
+    """
+    if not comments:
+        return set()
+    return {row.comment_id for row in db.session.query(Like.comment_id).filter(
+        Like.author_id == user_id, Like.comment_id.in_([comment.id for comment in comments]))}
+
+
+def picture_page(picture_id):
+    """
+    Loads a picture with everything shown by picture.html.
+
+    :param picture_id: ID of the picture.
+    :return: Picture object or 404, also if its author deleted their account.
+    """
+    return Picture.query.join(User, Picture.author_id == User.id).filter(
+        Picture.id == picture_id, User.deleted.isnot(True)).options(*post_card_options()).first_or_404()
+
+
 ### MICS ###
-def delete_user(user):
-    # delete files
-    try:
-        shutil.rmtree(f"web/static/uploads/{user.username}")
-    except FileNotFoundError:
-        pass
-    # delete object
-    db.session.delete(user)
+def mark_as_seen(user_id, partner_id):
+    """
+    Marks all messages from partner to user as seen with a single UPDATE and moves the read watermark of the
+    conversation. Polling an already read conversation costs one UPDATE served by the partial index of unseen messages.
+
+    :param user_id: ID of the user reading the conversation.
+    :param partner_id: ID of the other user.
+    :return: Number of newly seen messages.
+    """
+    seen = UserMessage.query.filter_by(recipient_id=user_id, sender_id=partner_id, seen=False).update(
+        {"seen": True}, synchronize_session=False)
+    if seen:
+        last_id = db.session.query(db.func.max(UserMessage.id)).filter_by(recipient_id=user_id,
+                                                                          sender_id=partner_id).scalar()
+        now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+        watermark = db.session.get(ConversationRead, (user_id, partner_id))
+        if watermark is None:
+            try:
+                # savepoint - a failed insert must not roll back the UPDATE of the seen flags
+                with db.session.begin_nested():
+                    db.session.add(ConversationRead(user_id=user_id, partner_id=partner_id,
+                                                    last_read_message_id=last_id, read_at=now))
+            except IntegrityError:
+                # watermark created by a concurrent request, move it if it is behind
+                ConversationRead.query.filter(
+                    ConversationRead.user_id == user_id, ConversationRead.partner_id == partner_id,
+                    ConversationRead.last_read_message_id < last_id).update(
+                    {"last_read_message_id": last_id, "read_at": now}, synchronize_session=False)
+        elif watermark.last_read_message_id < last_id:
+            watermark.last_read_message_id = last_id
+            watermark.read_at = now
     db.session.commit()
-    return True
+    return seen
 
 
-def mark_as_seen(messages_received):
+def read_up_to(user_id, partner_id):
     """
-    Changes the "seen" status of all given messages to True
+    Read receipt - ID of the last message from user which partner has read.
 
-    :param messages_received: Query object of all messages that should be checked.
-    :return: Returns True if successful.
+    :return: Message ID, 0 if partner has not read anything yet.
     """
-    not_seen = messages_received.filter_by(seen=False).all()
-    for message in not_seen:
-        message.seen = True
-    db.session.commit()
-    return True
\ No newline at end of file
+    return db.session.query(ConversationRead.last_read_message_id).filter_by(user_id=partner_id,
+                                                                             partner_id=user_id).scalar() or 0
+
+
+def conversation_state(user_id, partner_id):
+    """
+    State of a conversation polled by the chat window, in one query - ID of its latest message and the read receipt
+    of messages from user (see read_up_to).
+
+    :return: Tuple (latest message ID, read up to message ID), 0 if none.
+    """
+    latest = db.session.query(db.func.max(UserMessage.id)).filter(db.or_(
+        db.and_(UserMessage.sender_id == user_id, UserMessage.recipient_id == partner_id),
+        db.and_(UserMessage.sender_id == partner_id, UserMessage.recipient_id == user_id))).scalar_subquery()
+    read = db.session.query(ConversationRead.last_read_message_id).filter_by(
+        user_id=partner_id, partner_id=user_id).scalar_subquery()
+    latest_id, read_id = db.session.query(latest, read).one()
+    return latest_id or 0, read_id or 0
+
+
+def conversation_states(pairs):
+    """
+    conversation_state of many conversations with two queries, used by the long-poll watcher in longpoll.py.
+
+    :param pairs: List of (user ID, partner ID) tuples.
+    :return: Dictionary {(user ID, partner ID): (latest message ID, read up to message ID)}.
+    """
+    directions = set(pairs) | {(partner_id, user_id) for user_id, partner_id in pairs}
+    latest = dict(((sender_id, recipient_id), message_id) for sender_id, recipient_id, message_id in db.session.query(
+        UserMessage.sender_id, UserMessage.recipient_id, db.func.max(UserMessage.id)).filter(
+        db.tuple_(UserMessage.sender_id, UserMessage.recipient_id).in_(directions)).group_by(
+        UserMessage.sender_id, UserMessage.recipient_id))
+    # read watermark of the partner, the user is the partner of the row
+    read = dict(((partner_id, user_id), message_id) for user_id, partner_id, message_id in db.session.query(
+        ConversationRead.user_id, ConversationRead.partner_id, ConversationRead.last_read_message_id).filter(
+        db.tuple_(ConversationRead.partner_id, ConversationRead.user_id).in_(pairs)))
+    return {(user_id, partner_id): (max(latest.get((user_id, partner_id), 0), latest.get((partner_id, user_id), 0)),
+                                    read.get((user_id, partner_id)) or 0)
+            for user_id, partner_id in pairs}
+
+
+def notification_watermark(user_id):
+    """
+    ID of the newest notification of the user, 0 if none. Notifications are only added, so it changes with every
+    new one.
+    """
+    return db.session.query(db.func.max(Notification.id)).filter(Notification.recipient_id == user_id).scalar() or 0
+
+
+def conversation_messages(user_id, partner_id, limit):
+    """
+    Newest messages of a conversation. Messages moved to the archive (see archive.py) are read only if the table
+    has fewer than `limit` of them and the archive holds the conversation - for most chats a cached key lookup.
+
+    :param limit: Number of messages.
+    :return: List of UserMessage objects (and archived message-like objects), oldest first.
+    """
+    messages = UserMessage.query.filter(db.or_(
+        db.and_(UserMessage.sender_id == user_id, UserMessage.recipient_id == partner_id),
+        db.and_(UserMessage.sender_id == partner_id, UserMessage.recipient_id == user_id))).order_by(
+        UserMessage.id.desc()).limit(limit).all()
+    messages.reverse()
+    if len(messages) < limit:
+        older = archived_messages(user_id, partner_id, messages[0].id if messages else None, limit - len(messages))
+        messages = older + messages
+    return messages
@@ -0,0 +1,132 @@
+from urllib.parse import parse_qs
+from .helpers import conversation_states
+import asyncio
+import logging
+import re
+
+
+logger = logging.getLogger("instaclone.longpoll")
+
+# chat poller asking to wait for a change, see messages-div.html
+WAIT_PATH = re.compile(r"^/refresh-messages/(\d+)$")
+
+
+### WATCHER ###
+class MessageWatcher(object):
+    """
+    Waits for changes of conversations on behalf of long-polling clients. Waiting costs a future per client - one
+    task checks all watched conversations every LONG_POLL_CHECK_SECONDS with two queries, in a thread so that the
+    event loop is never blocked, however many clients are waiting.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.waiters = {}
+        self.task = None
+
+    async def wait(self, user_id, partner_id, after, seen, timeout):
+        """
+        Waits until the conversation has a message newer than `after` or its read receipt differs from `seen`.
+
+        :return: True if the conversation changed, False after the timeout.
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (after, seen, future)
+        self.waiters.setdefault((user_id, partner_id), []).append(waiter)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._watch())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self.waiters.get((user_id, partner_id), [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self.waiters.pop((user_id, partner_id), None)
+
+    def _states(self, pairs):
+        with self.app.app_context():
+            return conversation_states(pairs)
+
+    async def _watch(self):
+        while self.waiters:
+            await asyncio.sleep(self.app.config["LONG_POLL_CHECK_SECONDS"])
+            pairs = list(self.waiters)
+            try:
+                states = await asyncio.to_thread(self._states, pairs)
+            except Exception:
+                logger.exception("checking %s conversations failed", len(pairs))
+                continue
+            for pair in pairs:
+                latest_id, read_id = states[pair]
+                for after, seen, future in self.waiters.get(pair, []):
+                    if (latest_id > after or read_id != seen) and not future.done():
+                        future.set_result(True)
+
+
+### ASGI APPLICATION ###
+class LongPollApp(object):
+    """
+    ASGI application serving the chat long-poll in front of the Flask application. A poll of refresh_messages with
+    wait=1 is held here until the conversation changes or LONG_POLL_SECONDS pass, then the unchanged request is
+    handed to Flask, which renders the answer exactly as for a short poll. All other requests go to Flask directly.
+    """
+
+    def __init__(self, app, fallback):
+        self.app = app
+        self.fallback = fallback
+        self.watcher = MessageWatcher(app)
+
+    def _user_id(self, path, headers):
+        # the logged in user from the Flask session cookie, see flask_login
+        with self.app.test_request_context(path, headers=headers):
+            from flask import request
+            session = self.app.session_interface.open_session(self.app, request)
+            return int(session["_user_id"]) if session and session.get("_user_id") else None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.watcher.task:
+                    self.watcher.task.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        match = WAIT_PATH.match(scope.get("path", "")) if scope["type"] == "http" else None
+        args = parse_qs(scope.get("query_string", b"").decode("latin-1")) if match else {}
+        if match and args.get("wait") == ["1"]:
+            headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]]
+            user_id = await asyncio.to_thread(self._user_id, scope["path"], headers)
+            if user_id is not None:
+                try:
+                    await self.watcher.wait(user_id, int(match.group(1)), int(args.get("after", ["0"])[0]),
+                                            int(args.get("seen", ["0"])[0]), self.app.config["LONG_POLL_SECONDS"])
+                except ValueError:
+                    pass  # malformed IDs, Flask answers right away
+        await self.fallback(scope, receive, send)
+
+
+def create_asgi_app(app):
+    """
+    Wraps the Flask application for an ASGI server (uvicorn) and enables the chat long-poll. Flask views keep running
+    in a thread pool, only the waiting of the long-poll happens on the event loop.
+
+    :param app: Flask application.
+    :return: ASGI application.
+    """
+    # optional dependency, only needed when served over ASGI - unlike asgiref's WsgiToAsgi, which runs all requests
+    # in one thread, a2wsgi runs Flask in a pool of ASGI_WSGI_THREADS threads
+    from a2wsgi import WSGIMiddleware
+    app.config.setdefault("LONG_POLL_SECONDS", 25)
+    app.config.setdefault("LONG_POLL_CHECK_SECONDS", 0.5)
+    app.config.setdefault("ASGI_WSGI_THREADS", 10)
+    app.config["LONG_POLL_ENABLED"] = True
+    return LongPollApp(app, WSGIMiddleware(app, workers=app.config["ASGI_WSGI_THREADS"]))
@@ -0,0 +1,264 @@
+from flask import current_app
+from flask.cli import AppGroup
+from flask_mail import Message
+from . import db
+from .models import OutboundMail
+from .metrics import timer
+from .tasks import submit_after_commit, every
+import datetime as dt
+import logging
+import os
+import random
+import smtplib
+import uuid
+
+
+logger = logging.getLogger("instaclone.mailer")
+mail_cli = AppGroup("mail", help="Outbound mail queue.")
+
+
+def _now():
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+### QUEUE ###
+def queue_mail(subject, recipients, body=None, html=None):
+    """
+    Stores the mail in the outbound queue, the sender is woken up once the caller commits. The request does not
+    wait for the SMTP server.
+
+    :param subject: Subject of the mail.
+    :param recipients: List of email addresses.
+    :param body: Plain text body.
+    :param html: HTML body.
+    :return: OutboundMail object.
+    """
+    mail = OutboundMail(subject=subject, recipients=",".join(recipients), body=body, html=html, kind="mail",
+                        next_attempt_at=_now())
+    db.session.add(mail)
+    submit_after_commit(flush_outbox)
+    return mail
+
+
+def queue_report(line, recipient):
+    """
+    Adds a line to the next report digest of the recipient. All reports queued within MAIL_DIGEST_MINUTES are sent
+    in one mail, the digest is due MAIL_DIGEST_MINUTES after its first report. The caller commits.
+
+    :param line: Text of the report.
+    :param recipient: Email address receiving the digest.
+    :return: OutboundMail object.
+    """
+    pending = OutboundMail.query.filter_by(kind="report", recipients=recipient, status="queued", attempts=0).order_by(
+        OutboundMail.id).first()
+    due = pending.next_attempt_at if pending else _now() + dt.timedelta(
+        minutes=current_app.config["MAIL_DIGEST_MINUTES"])
+    report = OutboundMail(kind="report", recipients=recipient, subject="Instaclone - pictures reported", body=line,
+                          next_attempt_at=due)
+    db.session.add(report)
+    return report
+
+
+def _claim(batch_size):
+    """
+    Claims due mails for this sender. The claim is a lease - next_attempt_at is moved into the future, so a sender
+    that dies while sending releases its mails after MAIL_CLAIM_SECONDS.
+    """
+    now = _now()
+    token = uuid.uuid4().hex
+    due = db.session.query(OutboundMail.id).filter(OutboundMail.status == "queued",
+                                                   OutboundMail.next_attempt_at <= now).order_by(
+        OutboundMail.id).limit(batch_size).scalar_subquery()
+    db.session.query(OutboundMail).filter(OutboundMail.id.in_(due), OutboundMail.status == "queued",
+                                          OutboundMail.next_attempt_at <= now).update(
+        {"claimed_by": token,
+         "next_attempt_at": now + dt.timedelta(seconds=current_app.config["MAIL_CLAIM_SECONDS"])},
+        synchronize_session=False)
+    db.session.commit()
+    return OutboundMail.query.filter_by(claimed_by=token).order_by(OutboundMail.id).all()
+
+
+def _messages(claimed):
+    """
+    Builds flask_mail messages from the claimed rows, report rows of one recipient are merged into a digest.
+
+    :return: List of (Message, rows sent by it).
+    """
+    messages = []
+    digests = {}
+    for mail in claimed:
+        if mail.kind == "report":
+            digests.setdefault(mail.recipients, []).append(mail)
+            continue
+        messages.append((Message(subject=mail.subject, recipients=mail.recipients.split(","), body=mail.body,
+                                 html=mail.html), [mail]))
+    for recipient, reports in digests.items():
+        body = "\n".join(report.body for report in reports)
+        messages.append((Message(subject=f"Instaclone - {len(reports)} pictures reported", recipients=[recipient],
+                                 body=body), reports))
+    return messages
+
+
+def _retry(rows, error):
+    # exponential backoff with jitter, the mail is given up after MAIL_MAX_ATTEMPTS
+    config = current_app.config
+    for mail in rows:
+        mail.attempts += 1
+        mail.claimed_by = None
+        mail.last_error = str(error)[:500]
+        if mail.attempts >= config["MAIL_MAX_ATTEMPTS"]:
+            mail.status = "failed"
+            logger.error("giving up mail %s to %s: %s", mail.id, mail.recipients, error)
+            continue
+        delay = min(config["MAIL_RETRY_SECONDS"] * 2 ** (mail.attempts - 1), 3600)
+        mail.next_attempt_at = _now() + dt.timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def flush_outbox(batch_size=None):
+    """
+    Sends due mails of the queue over one transport connection per batch. Called after queue_mail, periodically
+    by every worker and by "flask mail flush".
+
+    :param batch_size: Maximum number of mails claimed at once, MAIL_BATCH_SIZE by default.
+    :return: Number of sent messages.
+    """
+    claimed = _claim(batch_size or current_app.config["MAIL_BATCH_SIZE"])
+    if not claimed:
+        return 0
+    pending = _messages(claimed)
+    sent = 0
+    with timer("mail_seconds"):
+        try:
+            with _transport() as send:
+                while pending:
+                    message, rows = pending[0]
+                    try:
+                        send(message)
+                    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as error:
+                        # rejected by the server, only this message is retried
+                        _retry(rows, error)
+                    else:
+                        for mail in rows:
+                            mail.status = "sent"
+                            mail.claimed_by = None
+                            mail.sent_at = _now()
+                        sent += 1
+                    pending.pop(0)
+        except (OSError, smtplib.SMTPException) as error:
+            # connection lost or not opened at all, every message not sent yet is retried
+            logger.warning("mail transport failed: %s", error)
+            _retry([mail for message, rows in pending for mail in rows], error)
+    db.session.commit()
+    return sent
+
+
+### TRANSPORTS ###
+class _SMTPTransport(object):
+    """
+    One SMTP connection (with a timeout) for the whole batch.
+    """
+
+    def __enter__(self):
+        config = current_app.config
+        smtp_class = smtplib.SMTP_SSL if config["MAIL_USE_SSL"] else smtplib.SMTP
+        self.host = smtp_class(config["MAIL_SERVER"], config["MAIL_PORT"], timeout=config["MAIL_TIMEOUT"])
+        try:
+            if config["MAIL_USE_TLS"]:
+                self.host.starttls()
+            if config["MAIL_USERNAME"] and config["MAIL_PASSWORD"]:
+                self.host.login(config["MAIL_USERNAME"], config["MAIL_PASSWORD"])
+        except BaseException:
+            # __exit__ is not called when __enter__ fails
+            self.host.close()
+            raise
+        return self.send
+
+    def send(self, message):
+        message.sender = message.sender or current_app.config["MAIL_DEFAULT_SENDER"]
+        self.host.sendmail(message.sender, message.send_to, message.as_bytes())
+
+    def __exit__(self, *exc):
+        try:
+            self.host.quit()
+        except (OSError, smtplib.SMTPException):
+            pass
+
+
+class _FileTransport(object):
+    """
+    Writes every message as an .eml file into MAIL_FILE_DIR, for development.
+    """
+
+    def __enter__(self):
+        os.makedirs(current_app.config["MAIL_FILE_DIR"], exist_ok=True)
+        return self.send
+
+    def send(self, message):
+        message.sender = message.sender or current_app.config["MAIL_DEFAULT_SENDER"] or "instaclone@localhost"
+        path = os.path.join(current_app.config["MAIL_FILE_DIR"], f"{_now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.eml")
+        with open(path, "wb") as file:
+            file.write(message.as_bytes())
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _MemoryTransport(object):
+    """
+    Appends messages to app.extensions["mailer"]["outbox"], for tests.
+    """
+
+    def __enter__(self):
+        return current_app.extensions["mailer"]["outbox"].append
+
+    def __exit__(self, *exc):
+        pass
+
+
+TRANSPORTS = {"smtp": _SMTPTransport, "file": _FileTransport, "memory": _MemoryTransport}
+
+
+def _transport():
+    return TRANSPORTS[current_app.config["MAIL_TRANSPORT"]]()
+
+
+### CLI ###
+@mail_cli.command("flush")
+def flush_command():
+    """Send all due mails now."""
+    total = 0
+    while True:
+        sent = flush_outbox()
+        if not sent:
+            break
+        total += sent
+    print(f"{total} mails sent")
+
+
+@mail_cli.command("status")
+def status_command():
+    """Number of mails by status."""
+    for status, count in db.session.query(OutboundMail.status, db.func.count(OutboundMail.id)).group_by(
+            OutboundMail.status):
+        print(f"{status}: {count}")
+
+
+def init_mailer(app):
+    """
+    Configures the outbound mail queue. MAIL_TRANSPORT is "smtp", "file" (MAIL_FILE_DIR) or "memory".
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("MAIL_TRANSPORT", "smtp")
+    app.config.setdefault("MAIL_FILE_DIR", "mail")
+    app.config.setdefault("MAIL_TIMEOUT", 10)
+    app.config.setdefault("MAIL_BATCH_SIZE", 50)
+    app.config.setdefault("MAIL_MAX_ATTEMPTS", 8)
+    app.config.setdefault("MAIL_RETRY_SECONDS", 30)
+    app.config.setdefault("MAIL_CLAIM_SECONDS", 600)
+    app.config.setdefault("MAIL_DIGEST_MINUTES", 15)
+    app.config.setdefault("MAIL_POLL_SECONDS", 30)
+    app.extensions["mailer"] = {"outbox": []}
+    # retries and digests become due without a new mail waking up the sender
+    every(app, app.config["MAIL_POLL_SECONDS"], flush_outbox)
+    app.cli.add_command(mail_cli)
@@ -0,0 +1,145 @@
+from flask import g, request, Response
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from contextlib import contextmanager
+from time import perf_counter
+import os
+
+
+# metric objects, filled by init_metrics() - stays empty (and every hook a no-op) when metrics are disabled
+_metrics = {}
+
+# latency buckets in seconds, HTMX polling endpoints answer in a few ms, page views in tens/hundreds of ms
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0)
+
+
+def _create_metrics():
+    """
+    Creates the metric objects. prometheus_client is imported here so that it is only needed when metrics are
+    enabled. With PROMETHEUS_MULTIPROC_DIR set, the values are written to shared files and every gunicorn worker
+    reports into the same /metrics output.
+    """
+    from prometheus_client import Counter, Gauge, Histogram
+    _metrics["request_seconds"] = Histogram("instaclone_request_duration_seconds", "Request latency by route.",
+                                            ["blueprint", "endpoint", "method"], buckets=LATENCY_BUCKETS)
+    _metrics["requests_in_flight"] = Gauge("instaclone_requests_in_flight", "Requests currently being handled.",
+                                           ["blueprint", "endpoint"], multiprocess_mode="livesum")
+    _metrics["pool_checkouts"] = Counter("instaclone_db_pool_checkouts_total",
+                                         "DB connections checked out of the pool.")
+    _metrics["pool_connects"] = Counter("instaclone_db_pool_connects_total",
+                                        "New DB connections opened because the pool had no idle connection.")
+    _metrics["pool_checked_out"] = Gauge("instaclone_db_pool_checked_out", "DB connections currently checked out.",
+                                         multiprocess_mode="livesum")
+    _metrics["pool_checkout_seconds"] = Histogram("instaclone_db_pool_checkout_duration_seconds",
+                                                  "How long a DB connection was held before returning to the pool.",
+                                                  buckets=LATENCY_BUCKETS)
+    _metrics["mail_seconds"] = Histogram("instaclone_mail_send_duration_seconds", "Duration of sending an email.",
+                                         buckets=LATENCY_BUCKETS)
+    _metrics["search_seconds"] = Histogram("instaclone_search_duration_seconds", "Duration of search index calls.",
+                                           ["index"], buckets=LATENCY_BUCKETS)
+    _metrics["upload_seconds"] = Histogram("instaclone_upload_duration_seconds", "Duration of upload pipeline steps.",
+                                           ["step"], buckets=LATENCY_BUCKETS)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Measures the duration of the with-block and records it in a histogram. Does nothing if metrics are disabled.
+
+    :param name: Key of the histogram, e.g. "mail_seconds".
+    :param labels: Label values of the histogram.
+    """
+    if not _metrics:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        histogram = _metrics[name].labels(**labels) if labels else _metrics[name]
+        histogram.observe(perf_counter() - started)
+
+
+### REQUEST HOOKS ###
+def _route_labels():
+    return request.blueprint or "", request.endpoint or "unmatched"
+
+
+def _start_request():
+    if request.endpoint == "metrics":
+        return
+    g._metrics_started = perf_counter()
+    _metrics["requests_in_flight"].labels(*_route_labels()).inc()
+
+
+def _finish_request(exc):
+    started = g.pop("_metrics_started", None)
+    if started is None:
+        return
+    blueprint, endpoint = _route_labels()
+    _metrics["requests_in_flight"].labels(blueprint, endpoint).dec()
+    _metrics["request_seconds"].labels(blueprint, endpoint, request.method).observe(perf_counter() - started)
+
+
+### DB POOL HOOKS ###
+def _pool_connect(dbapi_connection, connection_record):
+    _metrics["pool_connects"].inc()
+
+
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info["_metrics_checkout"] = perf_counter()
+    _metrics["pool_checkouts"].inc()
+    _metrics["pool_checked_out"].inc()
+
+
+def _pool_checkin(dbapi_connection, connection_record):
+    started = connection_record.info.pop("_metrics_checkout", None)
+    if started is None:
+        return
+    _metrics["pool_checked_out"].dec()
+    _metrics["pool_checkout_seconds"].observe(perf_counter() - started)
+
+
+### ENDPOINT ###
+def metrics():
+    """
+    Returns all metrics in the Prometheus text exposition format.
+    """
+    from prometheus_client import CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+    registry = REGISTRY
+    # gunicorn - collect values of all workers
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead(pid):
+    """
+    Removes live gauge values of a stopped worker, to be called from the gunicorn child_exit hook.
+
+    :param pid: Process ID of the stopped worker.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+
+def init_metrics(app):
+    """
+    Registers request and DB pool hooks and the /metrics endpoint if METRICS_ENABLED is set.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("METRICS_ENABLED", False)
+    if not app.config["METRICS_ENABLED"]:
+        return
+    # metrics are registered globally in prometheus_client, create them only once
+    if not _metrics:
+        _create_metrics()
+        event.listen(Pool, "connect", _pool_connect)
+        event.listen(Pool, "checkout", _pool_checkout)
+        event.listen(Pool, "checkin", _pool_checkin)
+    app.before_request(_start_request)
+    app.teardown_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
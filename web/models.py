@@ -2,16 +2,11 @@ from . import db
 from flask_login import UserMixin
 from sqlalchemy.sql import func
 from flask_login import current_user
+from flask import g, has_app_context
 from .search import add_to_index, remove_from_index, query_index
 from datetime import datetime
 
 
-# setting up many-to-many relationship for user-bookmarks
-user_picture = db.Table("user_picture",
-                        db.Column("user_id", db.Integer(), db.ForeignKey("user.id")),
-                        db.Column("picture_id", db.Integer(), db.ForeignKey("picture.id"))
-                        )
-
 # setting up many-to-many relationship for followers (user-user)
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer(), db.ForeignKey('user.id')),
@@ -91,6 +86,7 @@ class User(db.Model, UserMixin, SearchableMixin):
     avatar = db.Column(db.String(), default="/static/img/default-user.png")
     date_created = db.Column(db.DateTime(), default=func.now())
     pictures = db.relationship("Picture", backref="author", cascade="all,delete")
+    bookmarks = db.relationship("Bookmark", backref="user", cascade="all,delete", lazy="dynamic")
     stories = db.relationship("Story", backref="author", cascade="all,delete")
     comments = db.relationship("Comment", backref="author")
     likes = db.relationship("Like", backref="author", cascade="all,delete")
@@ -116,6 +112,38 @@ class User(db.Model, UserMixin, SearchableMixin):
                                         lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime())
     last_message_sent_time = db.Column(db.DateTime(), server_default=func.now())
+    # set when the user deletes the account, their data is removed by a background job (deletion.py)
+    deleted = db.Column(db.Boolean(), default=False, server_default=db.false(), nullable=False)
+
+    def followed_ids(self):
+        """
+        Returns IDs of followed users. The set is cached for the current request because templates check it for
+        every like and every follower shown on the page.
+
+        :return: Set of user IDs.
+        """
+        cache = g.setdefault("_followed_ids", {}) if has_app_context() else {}
+        if self.id not in cache:
+            cache[self.id] = {row.followed_id for row in
+                              db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id)}
+        return cache[self.id]
+
+    def bookmarked_ids(self):
+        """
+        Returns IDs of bookmarked pictures, cached for the current request like followed_ids(). The bookmark icon of
+        every rendered post is a set lookup instead of loading all bookmarked pictures.
+
+        :return: Set of picture IDs.
+        """
+        cache = g.setdefault("_bookmarked_ids", {}) if has_app_context() else {}
+        if self.id not in cache:
+            cache[self.id] = {row.picture_id for row in
+                              db.session.query(Bookmark.picture_id).filter(Bookmark.user_id == self.id)}
+        return cache[self.id]
+
+    def picture_count(self):
+        # number of pictures without loading them
+        return Picture.query.filter_by(author_id=self.id).count()
 
     def new_notifications(self):
         # returns number of unread notifications, function called by htmx every 60s and shows notification if > 0
@@ -123,12 +151,23 @@ class User(db.Model, UserMixin, SearchableMixin):
         return Notification.query.filter_by(recipient=self).filter(Notification.timestamp > last_read_time,
                                                                    Notification.author != self).count()
 
+    def recent_notifications(self, limit=20):
+        # latest notifications shown in the navbar drop-down, queried only when the drop-down is rendered
+        return self.notification_received.order_by(Notification.timestamp.desc()).limit(limit).all()
+
     def new_messages(self):
         # returns unread messages, function called by htmx every 5s and shows notification if True
         return UserMessage.query.filter_by(recipient_id=self.id).filter_by(seen=False).all()
 
 
 class UserMessage(db.Model):
+    __table_args__ = (
+        # messages of one conversation in one direction
+        db.Index("ix_user_message_conversation", "sender_id", "recipient_id"),
+        # partial index - only unseen messages, stays small however long the histories are
+        db.Index("ix_user_message_unseen", "recipient_id", "sender_id",
+                 postgresql_where=db.text("seen = false"), sqlite_where=db.text("seen = 0")),
+    )
     id = db.Column(db.Integer(), primary_key=True)
     sender_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
     recipient_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
@@ -137,7 +176,17 @@ class UserMessage(db.Model):
     seen = db.Column(db.Boolean(), default=False)
 
 
+class ConversationRead(db.Model):
+    # read watermark of a conversation - user has read all messages from partner up to last_read_message_id
+    user_id = db.Column(db.Integer(), db.ForeignKey("user.id"), primary_key=True)
+    partner_id = db.Column(db.Integer(), db.ForeignKey("user.id"), primary_key=True)
+    last_read_message_id = db.Column(db.Integer(), default=0)
+    read_at = db.Column(db.DateTime(), default=func.now())
+
+
 class Picture(db.Model):
+    # the explore page reads the best scores of an epoch, see trending.py
+    __table_args__ = (db.Index("ix_picture_trending", "trending_epoch", "trending_score"),)
     id = db.Column(db.Integer(), primary_key=True)
     description = db.Column(db.String())
     location = db.Column(db.String(), default=None)
@@ -145,27 +194,78 @@ class Picture(db.Model):
     author_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
     private = db.Column(db.Boolean, default=False)
     file = db.Column(db.String())
-    bookmarked_by = db.relationship("User", secondary=user_picture, backref="bookmarks")
+    # bumped on every change shown in cached fragments (likes, comments, privacy), see cache.fragment_key
+    version = db.Column(db.Integer(), default=1, server_default="1", nullable=False)
+    # likes folded from the shard rows, the displayed count is like_count + pending_likes, see counters.py
+    like_count = db.Column(db.Integer(), default=0, server_default="0", nullable=False)
+    like_shards = db.relationship("PictureLikeShard", cascade="all,delete")
+    # time-decayed likes and comments relative to the start of trending_epoch, see trending.py
+    trending_score = db.Column(db.Float(), default=0.0, server_default="0", nullable=False)
+    trending_epoch = db.Column(db.Integer(), default=0, server_default="0", nullable=False)
+    bookmarks = db.relationship("Bookmark", backref="picture", cascade="all,delete")
     likes = db.relationship("Like", backref="picture", cascade="all,delete")
     comments = db.relationship("Comment", backref="picture", cascade="all,delete")
 
+    def bump_version(self):
+        # invalidates cached fragments of the picture, incremented in SQL to be safe with concurrent requests
+        self.version = Picture.version + 1
+
+    @property
+    def like_total(self):
+        # folded likes and likes flushed to the shards but not folded yet
+        return self.like_count + self.pending_likes
+
+    @classmethod
+    def recount_likes(cls):
+        # sets like_count of all pictures from the likes table and empties the shards, e.g. to correct drift
+        count = db.select(func.count(Like.id)).where(Like.picture_id == cls.id).scalar_subquery()
+        db.session.execute(db.update(cls).values(like_count=count))
+        db.session.execute(db.delete(PictureLikeShard))
+        db.session.commit()
+
+    @staticmethod
+    def load_viewer_likes(pictures):
+        """
+        Loads for the pictures of a page whether current_user liked them and up to three followed users who did - two
+        queries for the whole page, however many likes the pictures have. Cached for the current request like
+        User.followed_ids(), see liked_by_viewer and mutual_likes.
+
+        :return: Dictionary of picture ID to tuple (liked, list of usernames of followed likers).
+        """
+        states = g.setdefault("_viewer_likes", {}) if has_app_context() else {}
+        ids = [picture.id for picture in pictures if picture.id not in states]
+        if not ids:
+            return states
+        liked = {row.picture_id for row in db.session.query(Like.picture_id).filter(
+            Like.author_id == current_user.id, Like.picture_id.in_(ids))}
+        followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == current_user.id)
+        rank = func.row_number().over(partition_by=Like.picture_id, order_by=Like.id).label("rank")
+        friends = db.session.query(Like.picture_id, User.username, rank).join(User, User.id == Like.author_id).filter(
+            Like.picture_id.in_(ids), Like.author_id.in_(followed.scalar_subquery()),
+            Like.author_id != current_user.id).subquery()
+        for picture_id in ids:
+            states[picture_id] = (picture_id in liked, [])
+        for picture_id, username in db.session.query(friends.c.picture_id, friends.c.username).filter(
+                friends.c.rank <= 3).order_by(friends.c.picture_id, friends.c.rank):
+            states[picture_id][1].append(username)
+        return states
+
+    def liked_by_viewer(self):
+        # whether current_user liked the picture, see load_viewer_likes
+        return Picture.load_viewer_likes([self])[self.id][0]
+
     def mutual_likes(self):
         """
-        Returns string of who liked the picture in format: "Liked by friend1, friend2 and XX other user(s)."
+        Returns string of who liked the picture in format: "Liked by friend1, friend2 and XX other user(s)." The total
+        is the like counter (like_total), the names come from load_viewer_likes - the likes are not loaded.
 
         :return: String to be shown to the user.
         """
-        mutual_likes_list = []
-        for like in self.likes:
-            user = User.query.filter_by(id=like.author_id).first_or_404()
-            # if liked by current_user
-            if user == current_user:
-                mutual_likes_list.insert(0, "you")
-            # if liked by followed users
-            if user in current_user.followed and user != current_user:
-                mutual_likes_list.append(user.username)
+        liked, friends = Picture.load_viewer_likes([self])[self.id]
+        # if liked by current_user, then by followed users
+        mutual_likes_list = (["you"] if liked else []) + friends
         # like_number = total number of likes - likes by followed users
-        like_number = len(self.likes) - len(mutual_likes_list[0:3])
+        like_number = self.like_total - len(mutual_likes_list[0:3])
         # liked only by friends
         if mutual_likes_list and like_number < 1:
             return f"Liked by {' and '.join(mutual_likes_list[0:3])}"
@@ -174,20 +274,70 @@ class Picture(db.Model):
             return f"Liked by {' and '.join(mutual_likes_list[0:3])} and {like_number} other user(s)"
         # if no friend liked post
         if not mutual_likes_list:
-            return f"Liked by {len(self.likes)} user(s)"
+            return f"Liked by {self.like_total} user(s)"
+
+
+class PictureLikeShard(db.Model):
+    # likes of a picture not folded into Picture.like_count yet, spread over LIKE_SHARDS rows so that concurrent
+    # flushes of several workers do not wait on one row lock
+    picture_id = db.Column(db.Integer(), db.ForeignKey("picture.id"), primary_key=True)
+    shard = db.Column(db.Integer(), primary_key=True)
+    delta = db.Column(db.Integer(), default=0, server_default="0", nullable=False)
+
+
+class LikeEvent(db.Model):
+    # like (+1) or unlike (-1) committed with its Like row and not yet added to the shards, see counters.py - no
+    # foreign keys, events of pictures and users deleted in the meantime are dropped by the flush
+    id = db.Column(db.Integer(), primary_key=True)
+    picture_id = db.Column(db.Integer(), nullable=False)
+    author_id = db.Column(db.Integer())
+    # user who (un)liked, None for corrections without a notification (account deletion)
+    user_id = db.Column(db.Integer())
+    delta = db.Column(db.Integer(), nullable=False)
+    link = db.Column(db.String())
+
+
+# sum of the shards, deferred - loaded with the page by helpers.gallery_options, otherwise on first access
+Picture.pending_likes = db.column_property(
+    db.select(func.coalesce(func.sum(PictureLikeShard.delta), 0)).where(
+        PictureLikeShard.picture_id == Picture.id).correlate_except(PictureLikeShard).scalar_subquery(),
+    deferred=True)
+
+
+class Bookmark(db.Model):
+    # picture saved by a user, newest bookmarks are shown first
+    __tablename__ = "user_picture"
+    __table_args__ = (db.Index("ix_user_picture_user_created", "user_id", "created_at"),)
+    user_id = db.Column(db.Integer(), db.ForeignKey("user.id"), primary_key=True)
+    picture_id = db.Column(db.Integer(), db.ForeignKey("picture.id"), primary_key=True)
+    created_at = db.Column(db.DateTime(), default=func.now(), server_default=func.now(), nullable=False)
 
 
 class Comment(db.Model):
+    # comments of a picture are paginated newest first, see helpers.comment_page
+    __table_args__ = (db.Index("ix_comment_picture", "picture_id", "id"),)
     id = db.Column(db.Integer(), primary_key=True)
     text = db.Column(db.String())
     date_created = db.Column(db.DateTime(), default=func.now())
     author_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
     picture_id = db.Column(db.Integer(), db.ForeignKey("picture.id"))
     deleted = db.Column(db.Boolean(), default=False)
+    # number of likes shown next to the comment, kept in sync by views.like_comment
+    like_count = db.Column(db.Integer(), default=0, server_default="0", nullable=False)
     likes = db.relationship("Like", backref="comment", cascade="all,delete")
 
+    @classmethod
+    def recount_likes(cls):
+        # sets like_count of all comments from the likes table, e.g. to correct counts written without the counter
+        count = db.select(func.count(Like.id)).where(Like.comment_id == cls.id).scalar_subquery()
+        db.session.execute(db.update(cls).values(like_count=count))
+        db.session.commit()
+
 
 class Like(db.Model):
+    # one like per user and picture/comment, see helpers.add_like
+    __table_args__ = (db.UniqueConstraint("author_id", "picture_id", name="uq_like_author_picture"),
+                      db.UniqueConstraint("author_id", "comment_id", name="uq_like_author_comment"))
     id = db.Column(db.Integer(), primary_key=True)
     author_id = db.Column(db.Integer(), db.ForeignKey("user.id"))
     comment_id = db.Column(db.Integer(), db.ForeignKey("comment.id"), default=None)
@@ -210,4 +360,72 @@ class Notification(db.Model):
     body = db.Column(db.String())
     type = db.Column(db.String())
     link = db.Column(db.String())
-    timestamp = db.Column(db.DateTime(), index=True, default=func.now())
\ No newline at end of file
+    timestamp = db.Column(db.DateTime(), index=True, default=func.now())
+
+
+class ChunkedUpload(db.Model):
+    # resumable upload of a picture, story or avatar received in chunks, see uploads.py
+    # random token, part of the upload URL
+    id = db.Column(db.String(), primary_key=True)
+    user_id = db.Column(db.Integer(), db.ForeignKey("user.id"), index=True)
+    # "picture", "story" or "avatar"
+    purpose = db.Column(db.String())
+    # JSON of the fields of the upload form - description, private, location, time_span, filename
+    meta = db.Column(db.String())
+    length = db.Column(db.Integer())
+    # bytes received so far, the next chunk must start here
+    offset = db.Column(db.Integer(), default=0, nullable=False)
+    # "jpeg" or "png", sniffed from the first bytes
+    image_type = db.Column(db.String())
+    # sha256 of the complete file
+    checksum = db.Column(db.String())
+    # URL of the created picture, story or profile once the upload is complete
+    result = db.Column(db.String())
+    date_created = db.Column(db.DateTime(), default=func.now())
+    expires_at = db.Column(db.DateTime(), index=True)
+
+
+class AccountDeletion(db.Model):
+    # progress of a background account deletion, see deletion.py
+    id = db.Column(db.Integer(), primary_key=True)
+    # not a foreign key, the user row is deleted as the last step
+    user_id = db.Column(db.Integer(), index=True)
+    username = db.Column(db.String())
+    # "pending" -> "running" -> "done" or "failed"
+    status = db.Column(db.String(), default="pending")
+    step = db.Column(db.String())
+    rows_deleted = db.Column(db.Integer(), default=0)
+    error = db.Column(db.String())
+    date_created = db.Column(db.DateTime(), default=func.now())
+    started_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
+    # bumped with every committed batch, deletions without progress are started again, see requeue_deletions
+    updated_at = db.Column(db.DateTime(), default=func.now(), onupdate=func.now())
+
+
+class OutboundMail(db.Model):
+    # persistent queue of outgoing mails, delivered by the background sender in mailer.py
+    __table_args__ = (db.Index("ix_outbound_mail_due", "status", "next_attempt_at"),)
+    id = db.Column(db.Integer(), primary_key=True)
+    # "mail" is sent on its own, "report" rows are collected into one digest mail
+    kind = db.Column(db.String(), default="mail")
+    recipients = db.Column(db.String())  # comma separated
+    subject = db.Column(db.String())
+    body = db.Column(db.String())
+    html = db.Column(db.String())
+    # "queued" -> "sent", or "failed" after MAIL_MAX_ATTEMPTS
+    status = db.Column(db.String(), default="queued")
+    attempts = db.Column(db.Integer(), default=0)
+    next_attempt_at = db.Column(db.DateTime(), default=func.now())
+    # sender currently holding the row, the claim expires with next_attempt_at
+    claimed_by = db.Column(db.String())
+    last_error = db.Column(db.String())
+    date_created = db.Column(db.DateTime(), default=func.now())
+    sent_at = db.Column(db.DateTime())
+
+
+class CacheEntry(db.Model):
+    # value of a cache backend shared by all workers without a cache server, see cache.DatabaseCache
+    key = db.Column(db.String(), primary_key=True)
+    value = db.Column(db.Text())
+    expires_at = db.Column(db.DateTime(), index=True)
@@ -0,0 +1,127 @@
+from flask import current_app, request, g, render_template
+from time import time
+import random
+
+
+# weight of the latest request in the moving average of the queue time
+QUEUE_SMOOTHING = 0.1
+
+
+### INTERVALS ###
+def load_factor():
+    """
+    How much polling intervals are stretched. POLL_LOAD_FACTOR is set by the operator to shed load globally, on top
+    of it the intervals grow with the time requests wait in the queue before a worker picks them up (X-Request-Start
+    set by the proxy, see _queue_seconds) above POLL_BUSY_QUEUE_MS, up to POLL_MAX_BACKOFF times. Without the header
+    POLL_LOAD_FACTOR is the only control.
+
+    :return: Factor >= POLL_LOAD_FACTOR.
+    """
+    config = current_app.config
+    queued = current_app.extensions["polling"]["queue_seconds"]
+    backoff = min(max(1.0, queued * 1000 / config["POLL_BUSY_QUEUE_MS"]), config["POLL_MAX_BACKOFF"])
+    return config["POLL_LOAD_FACTOR"] * backoff
+
+
+def _delay(name, idle):
+    base, longest = current_app.config["POLL_INTERVALS"][name]
+    # exponential backoff while nothing changes, jitter spreads polls of tabs opened at the same time
+    delay = min(base * 2 ** min(idle, 16), longest) * load_factor() * random.uniform(0.9, 1.1)
+    return round(delay, 2)
+
+
+def poll_state(name):
+    """
+    Interval of the next poll of the poller, computed by next_poll in this request or the initial one.
+
+    :param name: Key of POLL_INTERVALS, e.g. "messages".
+    :return: Dictionary with "idle" (number of polls without a change) and "delay" (seconds).
+    """
+    polls = g.setdefault("_polls", {})
+    if name not in polls:
+        polls[name] = {"idle": 0, "delay": _delay(name, 0)}
+    return polls[name]
+
+
+def next_poll(name, changed):
+    """
+    Computes the next poll of a polling endpoint. The idle count comes from the poller's URL: it is reset when the
+    response carries new data and grows with every poll without a change, doubling the interval up to its maximum.
+
+    :param name: Key of POLL_INTERVALS.
+    :param changed: True if something changed since the last poll.
+    :return: Dictionary with "idle" and "delay", also sent in the X-Poll-Interval header.
+    """
+    # a long-poll already waited for the change on the server (longpoll.py), no backoff needed
+    waited = request.args.get("wait", type=int) == 1
+    idle = 0 if changed or waited else request.args.get("idle", 0, type=int) + 1
+    poll = {"idle": idle, "delay": _delay(name, idle)}
+    g.setdefault("_polls", {})[name] = poll
+    g._poll_interval = poll["delay"]
+    return poll
+
+
+def render_poller(poller_id, name, url):
+    """
+    Response of a poll without changes - only the poller element with the next (longer) delay, the content stays.
+
+    :param poller_id: ID of the poller element.
+    :param name: Key of POLL_INTERVALS.
+    :param url: URL polled, without the idle count.
+    """
+    return render_template("poller.html", poller_id=poller_id, poll_name=name, poll_url=url)
+
+
+### REQUEST HOOKS ###
+def _queue_seconds():
+    """
+    Time the request waited between the proxy and the worker, from the X-Request-Start header - "t=<Unix time>" in
+    seconds (nginx: "t=${msec}"), milliseconds or microseconds. With sync workers a saturated site shows up here:
+    every worker is busy and new requests wait in the listen backlog.
+
+    :return: Seconds or None without a valid header.
+    """
+    value = request.headers.get("X-Request-Start", "").removeprefix("t=")
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    # microseconds and milliseconds since the Unix epoch have more digits than seconds
+    while started > 1e11:
+        started /= 1000
+    return max(time() - started, 0.0)
+
+
+def _start_request():
+    waited = _queue_seconds()
+    if waited is not None:
+        # moving average of the recent requests of this worker, the workers see the same queue
+        state = current_app.extensions["polling"]
+        state["queue_seconds"] += (waited - state["queue_seconds"]) * QUEUE_SMOOTHING
+
+
+def _set_header(response):
+    interval = g.get("_poll_interval")
+    if interval is not None:
+        response.headers["X-Poll-Interval"] = str(interval)
+    return response
+
+
+def init_polling(app):
+    """
+    Sets up server-driven polling. POLL_INTERVALS maps a poller to its (initial, maximum) interval in seconds,
+    POLL_LOAD_FACTOR stretches all intervals, e.g. 2 doubles them while the site is overloaded - automatically only
+    if the proxy sets X-Request-Start, see load_factor.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("POLL_INTERVALS", {"messages": (0.5, 8), "inbox": (30, 300), "notifications": (60, 600)})
+    app.config.setdefault("POLL_LOAD_FACTOR", 1.0)
+    app.config.setdefault("POLL_BUSY_QUEUE_MS", 100)
+    app.config.setdefault("POLL_MAX_BACKOFF", 8)
+    # set by longpoll.create_asgi_app when served over ASGI
+    app.config.setdefault("LONG_POLL_ENABLED", False)
+    app.extensions["polling"] = {"queue_seconds": 0.0}
+    app.jinja_env.globals["poll_state"] = poll_state
+    app.before_request(_start_request)
+    app.after_request(_set_header)
@@ -0,0 +1,185 @@
+from flask import (
+    g,
+    request,
+    current_app,
+    has_request_context,
+    render_template,
+    before_render_template,
+    template_rendered,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import Counter
+from time import perf_counter
+import logging
+import json
+import re
+
+
+logger = logging.getLogger("instaclone.profiler")
+
+# statements are fingerprinted so that "SELECT ... WHERE user.id = 1" and "... = 2" count as the same query
+_IN_LIST = re.compile(r"\(\s*(?:\?|%\(\w+\)s|:\w+|\d+)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+|\d+))*\s*\)")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+_listening = False
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised in testing mode when a request issues more SQL statements than PROFILER_MAX_QUERIES allows.
+    """
+
+
+class RequestProfile(object):
+    """
+    Collects SQL and template timings of a single request.
+    """
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.fingerprints = Counter()
+        self._template_started = []
+
+    @property
+    def total_time(self):
+        return perf_counter() - self.started
+
+    def repeated(self, limit=5):
+        """
+        Returns statements executed more than once during the request - the usual sign of an N+1 pattern.
+
+        :param limit: Maximal number of returned statements.
+        :return: List of tuples [(fingerprint, count), ...] ordered by count.
+        """
+        return [(sql, count) for sql, count in self.fingerprints.most_common(limit) if count > 1]
+
+    def server_timing(self):
+        """
+        Formats the profile as a Server-Timing header value, see
+        https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+        """
+        return (f'db;dur={self.db_time * 1000:.1f};desc="{self.query_count} queries", '
+                f'tpl;dur={self.template_time * 1000:.1f};desc="templates", '
+                f'total;dur={self.total_time * 1000:.1f}')
+
+    def as_dict(self):
+        return {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "queries": self.query_count,
+            "db_ms": round(self.db_time * 1000, 2),
+            "template_ms": round(self.template_time * 1000, 2),
+            "total_ms": round(self.total_time * 1000, 2),
+            "repeated": [{"sql": sql, "count": count} for sql, count in self.repeated()],
+        }
+
+
+def fingerprint(statement):
+    """
+    Normalizes an SQL statement by replacing literals and parameter lists with placeholders.
+
+    :param statement: SQL statement as sent to the DB driver.
+    :return: Normalized statement used to group repeated queries.
+    """
+    statement = _STRING.sub("?", statement)
+    statement = _IN_LIST.sub("(...)", statement)
+    statement = _NUMBER.sub("?", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+def current_profile():
+    """
+    Returns RequestProfile of the current request or None if profiling is disabled or called outside a request.
+    """
+    if not has_request_context():
+        return None
+    return g.get("_profile")
+
+
+### SQLALCHEMY HOOKS ###
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault("_profiler_started", []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    if profile is None or not conn.info.get("_profiler_started"):
+        return
+    profile.db_time += perf_counter() - conn.info["_profiler_started"].pop()
+    profile.query_count += 1
+    profile.fingerprints[fingerprint(statement)] += 1
+
+
+### TEMPLATE HOOKS ###
+def _before_render_template(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None:
+        profile._template_started.append(perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    profile = current_profile()
+    if profile is not None and profile._template_started:
+        started = profile._template_started.pop()
+        # nested render_template calls are already counted by the outer one
+        if not profile._template_started:
+            profile.template_time += perf_counter() - started
+
+
+### REQUEST HOOKS ###
+def _start_profile():
+    g._profile = RequestProfile()
+
+
+def _finish_profile(response):
+    profile = g.pop("_profile", None)
+    if profile is None:
+        return response
+    response.headers["Server-Timing"] = profile.server_timing()
+    data = profile.as_dict()
+    logger.info(json.dumps(data))
+    # debug toolbar - appended to full pages only, HTMX fragments are swapped into existing pages
+    if (current_app.config["PROFILER_TOOLBAR"] and response.mimetype == "text/html" and not response.direct_passthrough
+            and "HX-Request" not in request.headers):
+        body = response.get_data(as_text=True)
+        if "</body>" in body:
+            toolbar = render_template("_profiler.html", profile=data)
+            response.set_data(body.replace("</body>", f"{toolbar}</body>", 1))
+    max_queries = current_app.config["PROFILER_MAX_QUERIES"]
+    if max_queries is not None and profile.query_count > max_queries:
+        message = f"{request.endpoint} issued {profile.query_count} queries (limit {max_queries})"
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+
+def init_profiler(app):
+    """
+    Registers the SQL, template and request hooks if PROFILER_ENABLED is set. When disabled, nothing is registered
+    and requests are not slowed down at all.
+
+    :param app: Flask application.
+    """
+    global _listening
+    app.config.setdefault("PROFILER_ENABLED", False)
+    app.config.setdefault("PROFILER_TOOLBAR", False)
+    app.config.setdefault("PROFILER_MAX_QUERIES", None)
+    if not app.config["PROFILER_ENABLED"]:
+        return
+    # engine events are global, listen only once even if create_app is called multiple times (tests)
+    if not _listening:
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        before_render_template.connect(_before_render_template)
+        template_rendered.connect(_template_rendered)
+        _listening = True
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
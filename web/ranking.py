@@ -0,0 +1,206 @@
+from flask import current_app, session
+from sqlalchemy import func
+from . import db
+from .models import User, Picture, Comment, Like, UserMessage, followers
+from .cache import create_backend, DatabaseCache
+from .helpers import followed_posts, post_card_options, PAGE_SIZE
+from .tasks import every
+import datetime as dt
+import math
+import secrets
+
+
+# inputs of the score of a candidate picture, see score_candidates
+FEATURES = ("age_hours", "affinity_likes", "affinity_comments", "affinity_messages", "likes", "comments", "seen")
+
+
+### FEED MODE ###
+def feed_mode():
+    """
+    Home feed mode of the current user - "latest" (reverse chronological) or "ranked", chosen with views.feed_mode.
+    """
+    mode = session.get("feed_mode", current_app.config["FEED_DEFAULT_MODE"])
+    return mode if mode in ("latest", "ranked") else "latest"
+
+
+### FEATURES ###
+def _now():
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+def _seen_key(user_id):
+    return f"feed-seen:{user_id}"
+
+
+def _seen_ids(user_id):
+    value = current_app.extensions["feed_cache"].get(_seen_key(user_id))
+    return {int(picture_id) for picture_id in value.split(",")} if value else set()
+
+
+def mark_seen(user_id, picture_ids):
+    """
+    Remembers pictures shown in the ranked feed, the next ranking moves them down. Keeps the last FEED_SEEN_LIMIT.
+    """
+    if not picture_ids:
+        return
+    backend = current_app.extensions["feed_cache"]
+    value = backend.get(_seen_key(user_id))
+    seen = (value.split(",") if value else []) + [str(picture_id) for picture_id in picture_ids]
+    backend.set(_seen_key(user_id), ",".join(seen[-current_app.config["FEED_SEEN_LIMIT"]:]))
+
+
+def _affinity(query, author_column, authors):
+    return dict(query.filter(author_column.in_(authors)).group_by(author_column).with_entities(
+        author_column, func.count()).all()) if authors else {}
+
+
+def candidate_features(user_id):
+    """
+    Candidates of the ranked feed - the newest FEED_CANDIDATES pictures of followed users and of the user, the same
+    pictures the chronological feed starts with - and their features:
+
+    - age_hours: age of the picture
+    - affinity_likes/comments/messages: likes and comments the user gave to pictures of the author and messages the
+      user sent to the author in the last FEED_AFFINITY_DAYS
+    - likes, comments: number of likes and comments of the picture
+    - seen: 1 if the picture was already shown in the ranked feed, see mark_seen
+
+    :return: Tuple (list of picture IDs, list of author IDs, dictionary of feature name to list of values).
+    """
+    followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == user_id)
+    rows = db.session.query(Picture.id, Picture.author_id, Picture.date_created, Picture.like_count).filter(
+        db.or_(Picture.author_id.in_(followed.scalar_subquery()), Picture.author_id == user_id)).order_by(
+        Picture.date_created.desc(), Picture.id.desc()).limit(current_app.config["FEED_CANDIDATES"]).all()
+    picture_ids = [row.id for row in rows]
+    author_ids = [row.author_id for row in rows]
+    authors = sorted(set(author_ids) - {user_id})
+    since = _now() - dt.timedelta(days=current_app.config["FEED_AFFINITY_DAYS"])
+    liked = _affinity(db.session.query(Like).join(Picture, Like.picture_id == Picture.id).filter(
+        Like.author_id == user_id, Like.date_created >= since), Picture.author_id, authors)
+    commented = _affinity(db.session.query(Comment).join(Picture, Comment.picture_id == Picture.id).filter(
+        Comment.author_id == user_id, Comment.date_created >= since), Picture.author_id, authors)
+    messaged = _affinity(db.session.query(UserMessage).filter(
+        UserMessage.sender_id == user_id, UserMessage.timestamp >= since), UserMessage.recipient_id, authors)
+    comments = dict(db.session.query(Comment.picture_id, func.count()).filter(
+        Comment.picture_id.in_(picture_ids), Comment.deleted.isnot(True)).group_by(
+        Comment.picture_id).all()) if picture_ids else {}
+    seen = _seen_ids(user_id)
+    now = _now()
+    features = {
+        "age_hours": [max((now - (row.date_created or now)).total_seconds() / 3600, 0.0) for row in rows],
+        "affinity_likes": [liked.get(author_id, 0) for author_id in author_ids],
+        "affinity_comments": [commented.get(author_id, 0) for author_id in author_ids],
+        "affinity_messages": [messaged.get(author_id, 0) for author_id in author_ids],
+        "likes": [row.like_count for row in rows],
+        "comments": [comments.get(picture_id, 0) for picture_id in picture_ids],
+        "seen": [1 if picture_id in seen else 0 for picture_id in picture_ids],
+    }
+    return picture_ids, author_ids, features
+
+
+### SCORING ###
+def score_candidates(features):
+    """
+    Scores candidates in one vectorized pass (NumPy, if installed):
+
+        (1 + sum of FEED_WEIGHTS[name] * log(1 + feature)) * recency
+        * FEED_SEEN_PENALTY if seen
+
+    where recency = FEED_RECENCY_FLOOR + (1 - FEED_RECENCY_FLOOR) * 2 ** (-age_hours / FEED_HALF_LIFE_HOURS). New
+    pictures get a boost, but the floor keeps older pictures of close authors above fresh ones of distant authors -
+    without it a few half-lives of age outweigh any engagement and the order is the chronological one.
+
+    :param features: Dictionary of feature name to list of values, see candidate_features.
+    :return: List of scores.
+    """
+    config = current_app.config
+    weights = config["FEED_WEIGHTS"]
+    floor = config["FEED_RECENCY_FLOOR"]
+    try:
+        import numpy
+    except ImportError:
+        scores = []
+        for values in zip(*(features[name] for name in FEATURES)):
+            row = dict(zip(FEATURES, values))
+            engagement = 1 + sum(weight * math.log1p(row[name]) for name, weight in weights.items())
+            decay = 2 ** (-row["age_hours"] / config["FEED_HALF_LIFE_HOURS"])
+            score = engagement * (floor + (1 - floor) * decay)
+            scores.append(score * config["FEED_SEEN_PENALTY"] if row["seen"] else score)
+        return scores
+    columns = {name: numpy.asarray(features[name], dtype=float) for name in FEATURES}
+    engagement = 1 + sum(weight * numpy.log1p(columns[name]) for name, weight in weights.items())
+    scores = engagement * (floor + (1 - floor) * numpy.exp2(-columns["age_hours"] / config["FEED_HALF_LIFE_HOURS"]))
+    return numpy.where(columns["seen"] > 0, scores * config["FEED_SEEN_PENALTY"], scores).tolist()
+
+
+def rank_feed(user_id):
+    """
+    Ranks the candidates of the user's feed.
+
+    :return: List of picture IDs, best first.
+    """
+    picture_ids, _, features = candidate_features(user_id)
+    scores = score_candidates(features)
+    return [picture_id for _, picture_id in sorted(zip(scores, picture_ids), reverse=True)]
+
+
+### RANKED PAGES ###
+def ranked_posts(user, page=0, token=None):
+    """
+    Provides one page of the ranked feed. The ranking is computed when the home page is opened and cached under a
+    new token for FEED_CACHE_TTL seconds - load_page passes the token, so scrolling reads a consistent order and
+    does not score again. Pictures older than the candidate window follow in chronological order.
+
+    :param user: User viewing the feed, current_user.
+    :param page: Offset of the first picture.
+    :param token: Token of the cached ranking, None to rank again.
+    :return: Tuple (list of up to PAGE_SIZE pictures, token of the ranking).
+    """
+    backend = current_app.extensions["feed_cache"]
+    value = backend.get(f"feed:{user.id}:{token}") if token else None
+    if value is None:
+        # first page, or the ranking expired - rank again under the same token. With the per-worker "memory"
+        # backend this also happens when the next page is served by another worker, see init_ranking
+        token = token or secrets.token_urlsafe(8)
+        ranked = rank_feed(user.id)
+        backend.set(f"feed:{user.id}:{token}", ",".join(map(str, ranked)))
+    else:
+        ranked = [int(picture_id) for picture_id in value.split(",")] if value else []
+    ids = ranked[page:page + PAGE_SIZE]
+    # a cached ranking may still list pictures of accounts deleted since
+    loaded = {picture.id: picture for picture in Picture.query.join(User, Picture.author_id == User.id).filter(
+        Picture.id.in_(ids), User.deleted.isnot(True)).options(*post_card_options())} if ids else {}
+    pictures = [loaded[picture_id] for picture_id in ids if picture_id in loaded]
+    mark_seen(user.id, [picture.id for picture in pictures])
+    if len(ids) < PAGE_SIZE and len(ranked) >= current_app.config["FEED_CANDIDATES"]:
+        # past the candidate window - the chronological feed continues with the pictures after it
+        start = max(page, len(ranked))
+        pictures.extend(followed_posts(start)[:page + PAGE_SIZE - start])
+    return pictures, token
+
+
+def init_ranking(app):
+    """
+    Configures the ranked home feed. FEED_DEFAULT_MODE is the mode of users who did not choose one, rankings and
+    shown pictures are kept in the FEED_CACHE_URL backend - "database" or "redis://..." are shared by all workers,
+    "memory" only works with a single worker process: pages served by different workers would repeat or skip
+    pictures.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("FEED_DEFAULT_MODE", "latest")
+    app.config.setdefault("FEED_CANDIDATES", 500)
+    app.config.setdefault("FEED_AFFINITY_DAYS", 90)
+    app.config.setdefault("FEED_HALF_LIFE_HOURS", 48)
+    app.config.setdefault("FEED_RECENCY_FLOOR", 0.25)
+    app.config.setdefault("FEED_SEEN_PENALTY", 0.2)
+    app.config.setdefault("FEED_SEEN_LIMIT", 2000)
+    app.config.setdefault("FEED_WEIGHTS", {"affinity_likes": 1.0, "affinity_comments": 1.5,
+                                           "affinity_messages": 0.5, "likes": 0.3, "comments": 0.5})
+    app.config.setdefault("FEED_CACHE_URL", "database")
+    app.config.setdefault("FEED_CACHE_SIZE", 10000)
+    app.config.setdefault("FEED_CACHE_TTL", 3600)
+    app.extensions["feed_cache"] = create_backend(app.config["FEED_CACHE_URL"], app.config["FEED_CACHE_SIZE"],
+                                                  app.config["FEED_CACHE_TTL"])
+    if isinstance(app.extensions["feed_cache"], DatabaseCache):
+        every(app, app.config["FEED_CACHE_TTL"], app.extensions["feed_cache"].purge)
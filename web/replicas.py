@@ -0,0 +1,123 @@
+from flask import current_app, g, request, session, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, exc, text
+from functools import wraps
+from itertools import count
+from .tasks import every
+import logging
+import time
+
+
+logger = logging.getLogger("instaclone.replicas")
+
+
+### ROUTING ###
+def read_only(view):
+    """
+    Marks a view whose GET requests may read from a replica. Statements after the first write of the request, and
+    all statements of users who wrote in the last DB_REPLICA_PIN_SECONDS (read-your-writes), still go to the primary.
+    Must be placed below @login_required, the logged in user is always loaded from the primary.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g._db_read_only = request.method in ("GET", "HEAD")
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _is_read(clause):
+    return bool(getattr(clause, "is_select", False)) and getattr(clause, "_for_update_arg", None) is None
+
+
+def _pick_replica():
+    """
+    Replica of the current request - chosen round-robin from the healthy replicas on first use and kept for the
+    rest of the request, so all its reads see the same snapshot. None if no replica is healthy.
+    """
+    if "_db_replica" not in g:
+        replicas = current_app.extensions["replicas"]
+        healthy = [replica for replica in replicas["engines"] if replicas["healthy"].get(replica)]
+        g._db_replica = healthy[next(replicas["counter"]) % len(healthy)] if healthy else None
+    return g._db_replica
+
+
+class RoutingSession(Session):
+    """
+    Session sending reads of read-only views to a replica, everything else to the primary (SQLALCHEMY_DATABASE_URI).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and "replicas" in current_app.extensions:
+            if self._flushing or not _is_read(clause):
+                # writes go to the primary and so do all later reads of the request
+                g._db_wrote = True
+            elif g.get("_db_read_only") and not g.get("_db_wrote") and not g.get("_db_pinned"):
+                replica = _pick_replica()
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+### REQUEST HOOKS ###
+def _start_request():
+    g._db_pinned = session.get("_db_primary_until", 0) > time.time()
+
+
+def _pin_writer(response):
+    # the user reads their own writes from the primary until the replicas have caught up
+    if g.get("_db_wrote"):
+        session["_db_primary_until"] = time.time() + current_app.config["DB_REPLICA_PIN_SECONDS"]
+    return response
+
+
+### HEALTH CHECKS ###
+def check_replicas():
+    """
+    Checks every replica with SELECT 1, replicas failing the check get no reads until they pass it again. Runs every
+    DB_REPLICA_CHECK_SECONDS.
+
+    :return: Number of healthy replicas.
+    """
+    replicas = current_app.extensions["replicas"]
+    for replica in replicas["engines"]:
+        try:
+            with replica.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            if not replicas["healthy"].get(replica):
+                logger.info("replica %s is healthy", replica.url.render_as_string(hide_password=True))
+            replicas["healthy"][replica] = True
+        except Exception as error:
+            if replicas["healthy"].get(replica):
+                logger.warning("replica %s failed: %s", replica.url.render_as_string(hide_password=True), error)
+            replicas["healthy"][replica] = False
+    return sum(replicas["healthy"].values())
+
+
+def init_replicas(app):
+    """
+    Creates engines of the read replicas in DB_REPLICA_URIS. Without replicas the routing session uses the primary
+    only.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("DB_REPLICA_URIS", [])
+    app.config.setdefault("DB_REPLICA_PIN_SECONDS", 5)
+    app.config.setdefault("DB_REPLICA_CHECK_SECONDS", 10)
+    if not app.config["DB_REPLICA_URIS"]:
+        return
+    engines = [create_engine(uri, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+               for uri in app.config["DB_REPLICA_URIS"]]
+    replicas = {"engines": engines, "healthy": {engine: True for engine in engines}, "counter": count()}
+
+    def mark_failed(context):
+        # a replica losing its connection gets no more reads until the next successful check
+        failed = context.is_disconnect or isinstance(context.sqlalchemy_exception, exc.OperationalError)
+        if failed and context.engine in replicas["healthy"]:
+            replicas["healthy"][context.engine] = False
+
+    for engine in engines:
+        event.listen(engine, "handle_error", mark_failed)
+    app.extensions["replicas"] = replicas
+    app.before_request(_start_request)
+    app.after_request(_pin_writer)
+    every(app, app.config["DB_REPLICA_CHECK_SECONDS"], check_replicas)
@@ -1,30 +1,47 @@
 from flask import current_app
+from .metrics import timer
 
 
 # https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-xvi-full-text-search
 
 
+def _client():
+    """
+    Elasticsearch client of the application, created on first use so that workers start without importing the
+    elasticsearch package. None without ELASTICSEARCH_URL.
+    """
+    app = current_app._get_current_object()
+    if "elasticsearch" not in app.extensions:
+        client = None
+        if app.config["ELASTICSEARCH_URL"]:
+            from elasticsearch import Elasticsearch
+            client = Elasticsearch(app.config["ELASTICSEARCH_URL"])
+        app.extensions["elasticsearch"] = client
+    return app.extensions["elasticsearch"]
+
+
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    if not _client():
         return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    _client().index(index=index, id=model.id, body=payload)
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not _client():
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    _client().delete(index=index, id=model.id)
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not _client():
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    with timer("search_seconds", index=index):
+        search = _client().search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
\ No newline at end of file
@@ -0,0 +1,55 @@
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import text
+from . import db
+from time import perf_counter
+import logging
+import os
+
+
+logger = logging.getLogger("instaclone.startup")
+
+
+### WORKER START ###
+def init_startup(app):
+    """
+    Configures what a worker does on start. DB_CREATE_ALL creates missing tables (development) - in production the
+    schema comes from the migrations ("flask db upgrade") only and workers start without reflecting it. With
+    TEMPLATE_CACHE_DIR compiled templates are stored on disk, every worker (and restart) loads them instead of
+    compiling the templates again.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("DB_CREATE_ALL", True)
+    app.config.setdefault("TEMPLATE_CACHE_DIR", None)
+    if app.config["TEMPLATE_CACHE_DIR"]:
+        os.makedirs(app.config["TEMPLATE_CACHE_DIR"], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["TEMPLATE_CACHE_DIR"])
+    if app.config["DB_CREATE_ALL"]:
+        with app.app_context():
+            db.create_all()
+
+
+def warm_up(app):
+    """
+    Does the work of the first requests of a worker ahead of time: compiles all templates and opens a database
+    connection, which initializes the SQL dialect. Called by gunicorn.conf.py - with preload_app in the master, so the
+    forked workers share the compiled templates. The connections are closed afterwards, a connection must never be
+    shared by forked processes.
+
+    :param app: Flask application.
+    :return: Seconds spent.
+    """
+    start = perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    with app.app_context():
+        try:
+            db.session.execute(text("SELECT 1"))
+        except Exception as error:
+            logger.warning("database not reachable during warm-up: %s", error)
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    seconds = perf_counter() - start
+    logger.info("warmed up in %.3f s", seconds)
+    return seconds
@@ -0,0 +1,159 @@
+from flask import current_app
+from concurrent.futures import ThreadPoolExecutor, Future
+from sqlalchemy import event
+from threading import Event, Lock, Thread
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows - no locking, every process runs single tasks as well
+    fcntl = None
+
+
+logger = logging.getLogger("instaclone.tasks")
+
+
+### BACKGROUND TASKS ###
+def _run(app, function, args, kwargs):
+    # every task gets its own application context and therefore its own DB session
+    with app.app_context():
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            logger.exception("background task %s failed", function.__name__)
+            raise
+
+
+def _state(app):
+    """
+    Executor and periodic threads of the current process. Threads do not survive a fork, so they are created lazily
+    and again in every gunicorn worker (also with preload_app).
+    """
+    state = app.extensions["tasks"]
+    with state["lock"]:
+        if state["pid"] != os.getpid():
+            state["pid"] = os.getpid()
+            state["executor"] = ThreadPoolExecutor(max_workers=app.config["TASKS_WORKERS"],
+                                                   thread_name_prefix="instaclone-task")
+            state["stop"] = Event()
+            state["leases"] = {}
+            for seconds, function, single in state["periodic"]:
+                Thread(target=_repeat, args=(app, state["stop"], seconds, function, single), daemon=True,
+                       name=f"instaclone-{function.__name__}").start()
+    return state
+
+
+def _holds_lease(app, name):
+    """
+    Whether this process runs the single task - the first process to lock TASKS_LOCK_DIR/<name>.lock keeps the lock
+    until it exits, then another process takes over in its next period.
+    """
+    leases = app.extensions["tasks"]["leases"]
+    if name in leases or fcntl is None:
+        return True
+    os.makedirs(app.config["TASKS_LOCK_DIR"], exist_ok=True)
+    file = open(os.path.join(app.config["TASKS_LOCK_DIR"], f"{name}.lock"), "w")
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return False
+    leases[name] = file
+    return True
+
+
+def _repeat(app, stop, seconds, function, single):
+    name = f"{function.__module__}.{function.__qualname__}"
+    while not stop.wait(seconds):
+        if single and not _holds_lease(app, name):
+            continue
+        try:
+            _run(app, function, (), {})
+        except Exception:
+            pass  # already logged, try again in the next period
+
+
+def submit(function, *args, **kwargs):
+    """
+    Runs the function in a background thread of this worker, outside of the request. With TASKS_EAGER set (tests,
+    CLI) it runs immediately in the current context instead.
+
+    :param function: Function to call, it must not rely on the request context.
+    :return: concurrent.futures.Future with the result.
+    """
+    app = current_app._get_current_object()
+    if app.config["TASKS_EAGER"]:
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as error:
+            logger.exception("task %s failed", function.__name__)
+            future.set_exception(error)
+        return future
+    return _state(app)["executor"].submit(_run, app, function, args, kwargs)
+
+
+def _submit_committed(session):
+    for app, function, args, kwargs in session.info.pop("after_commit", []):
+        if app.config["TASKS_EAGER"]:
+            try:
+                # a new application context - the committed session can not run queries in this hook
+                _run(app, function, args, kwargs)
+            except Exception:
+                pass  # already logged
+        else:
+            _state(app)["executor"].submit(_run, app, function, args, kwargs)
+
+
+def _drop_uncommitted(session):
+    session.info.pop("after_commit", None)
+
+
+def submit_after_commit(function, *args, **kwargs):
+    """
+    Like submit, but only once the current DB transaction is committed by the caller, so the task sees its rows.
+    Nothing is submitted if the transaction is rolled back.
+
+    :param function: Function to call, it must not rely on the request context.
+    """
+    session = current_app.extensions["sqlalchemy"].session()
+    if "after_commit" not in session.info:
+        session.info["after_commit"] = []
+        if not event.contains(session, "after_commit", _submit_committed):
+            event.listen(session, "after_commit", _submit_committed)
+            event.listen(session, "after_rollback", _drop_uncommitted)
+    session.info["after_commit"].append((current_app._get_current_object(), function, args, kwargs))
+
+
+def every(app, seconds, function, single=False):
+    """
+    Registers a function called every given number of seconds in a background thread of each worker. The threads
+    start with the first request of the worker.
+
+    :param app: Flask application.
+    :param seconds: Period in seconds.
+    :param function: Function without arguments, called in an application context.
+    :param single: Run the function in one process of the host only, for jobs which rewrite whole tables.
+    """
+    app.extensions["tasks"]["periodic"].append((seconds, function, single))
+
+
+def _start_workers():
+    if not current_app.config["TASKS_EAGER"]:
+        _state(current_app._get_current_object())
+
+
+def init_tasks(app):
+    """
+    Sets up background tasks of the application. TASKS_WORKERS is the number of threads per worker process, the lock
+    files of periodic tasks run by a single process are kept in TASKS_LOCK_DIR.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("TASKS_WORKERS", 2)
+    app.config.setdefault("TASKS_EAGER", False)
+    app.config.setdefault("TASKS_LOCK_DIR", "task-locks")
+    app.extensions["tasks"] = {"lock": Lock(), "pid": None, "executor": None, "stop": None, "periodic": [],
+                              "leases": {}}
+    app.before_request(_start_workers)
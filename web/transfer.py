@@ -0,0 +1,156 @@
+from flask import current_app, request, make_response
+from flask_login import current_user
+from .models import Picture
+from time import time
+import hashlib
+import zlib
+
+
+### ETAGS ###
+# fragments polled or re-requested by HTMX get a weak ETag computed from the data versions they show (picture
+# versions, message and notification watermarks) - the browser revalidates with If-None-Match and an unchanged
+# fragment is answered with 304 before it is rendered
+def fragment_etag(*parts):
+    """
+    Weak ETag of a fragment of the current user. Besides the parts it covers the templates (a deploy changes all
+    ETags) and a time bucket of ETAG_TIME_BUCKET seconds, so "5 minutes ago" labels do not stay stale for long.
+
+    :param parts: Values the fragment depends on - reprs must be stable, e.g. tuples of IDs and versions.
+    :return: ETag value without quotes.
+    """
+    bucket = int(time() // current_app.config["ETAG_TIME_BUCKET"])
+    user_id = current_user.id if current_user.is_authenticated else None
+    state = repr((current_app.extensions["transfer"]["templates"], user_id, bucket, parts)).encode()
+    return hashlib.blake2b(state, digest_size=12).hexdigest()
+
+
+def conditional(etag, render):
+    """
+    Returns 304 if the request's If-None-Match has the ETag, otherwise renders the response and sets the ETag.
+    Responses must be revalidated every time (Cache-Control: no-cache), the ETag only saves rendering and bytes.
+
+    :param etag: ETag of the fragment, see fragment_etag.
+    :param render: Function returning the response, called only when the fragment changed.
+    :return: Response.
+    """
+    if not current_app.config["ETAGS_ENABLED"]:
+        return render()
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def picture_states(pictures, with_likes=False):
+    """
+    Data versions of rendered pictures for fragment_etag - the version bumped by every change of a cached fragment,
+    the like and comment counts of gallery tiles and, for post footers, the like count, the viewer's like and the
+    followed likers shown (see Picture.load_viewer_likes, loaded here for the whole page).
+
+    :return: Tuple of tuples.
+    """
+    if with_likes:
+        states = Picture.load_viewer_likes(pictures)
+        return tuple((picture.id, picture.version, picture.like_total, states[picture.id][0],
+                      tuple(states[picture.id][1])) for picture in pictures)
+    return tuple((picture.id, picture.version, picture.like_total, len(picture.comments)) for picture in pictures)
+
+
+def template_digest(app):
+    """
+    Hash of the sources of all templates, part of every ETag.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for name in sorted(app.jinja_loader.list_templates()):
+        digest.update(name.encode())
+        digest.update(app.jinja_loader.get_source(app.jinja_env, name)[0].encode())
+    return digest.hexdigest()
+
+
+### COMPRESSION ###
+def _encoding():
+    # best encoding accepted by the client - brotli if the module is installed, gzip otherwise
+    accepted = request.accept_encodings
+    if accepted["br"]:
+        try:
+            import brotli  # noqa: F401
+            return "br"
+        except ImportError:
+            pass
+    return "gzip" if accepted["gzip"] else None
+
+
+def _compressor(encoding):
+    """
+    Incremental compressor of the encoding.
+
+    :return: Tuple (compress(chunk), finish()) functions returning bytes.
+    """
+    config = current_app.config
+    if encoding == "br":
+        import brotli
+        compressor = brotli.Compressor(quality=config["COMPRESS_BROTLI_QUALITY"])
+        return compressor.process, compressor.finish
+    # wbits 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(config["COMPRESS_LEVEL"], zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def _stream(chunks, compress, finish):
+    for chunk in chunks:
+        data = compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(response):
+    """
+    Compresses text responses of COMPRESS_MIN_SIZE bytes and more with the best encoding the client accepts.
+    Streamed responses are compressed chunk by chunk as they are sent, their size is not known in advance.
+    Static files (direct passthrough) and responses with an encoding are left as they are.
+    """
+    config = current_app.config
+    if (response.mimetype not in config["COMPRESS_MIMETYPES"] or response.direct_passthrough
+            or "Content-Encoding" in response.headers or request.method == "HEAD"):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200:
+        return response
+    encoding = _encoding()
+    if encoding is None:
+        return response
+    compress, finish = _compressor(encoding)
+    if response.is_streamed:
+        response.response = _stream(response.response, compress, finish)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+        response.set_data(compress(data) + finish())
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_transfer(app):
+    """
+    Conditional requests and compression of responses. Must be registered before the other after_request hooks,
+    Flask runs them in reverse order and the compression has to see the final body (e.g. with the profiler toolbar).
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("ETAGS_ENABLED", True)
+    app.config.setdefault("ETAG_TIME_BUCKET", 300)
+    app.config.setdefault("COMPRESS_ENABLED", True)
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+    app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+    app.config.setdefault("COMPRESS_MIMETYPES", {"text/html", "text/css", "text/plain", "text/javascript",
+                                                 "application/javascript", "application/json", "image/svg+xml"})
+    app.extensions["transfer"] = {"templates": template_digest(app)}
+    if app.config["COMPRESS_ENABLED"]:
+        app.after_request(compress_response)
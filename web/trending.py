@@ -0,0 +1,251 @@
+from flask import current_app, abort
+from flask.cli import AppGroup
+from bisect import bisect_right
+from threading import Lock
+from . import db
+from .models import User, Picture, Like, Comment, blocked
+from .helpers import gallery_options, PAGE_SIZE
+from .tasks import every
+import datetime as dt
+import heapq
+import math
+import time
+
+
+trending_cli = AppGroup("trending", help="Trending scores of the explore page.")
+
+UNIX_EPOCH = dt.datetime(1970, 1, 1)
+
+
+### SCORES ###
+# Picture.trending_score is the sum of the weights of its likes and comments, each multiplied by
+# 2 ** ((event time - start of the epoch) / half-life) - the score decayed to the start of Picture.trending_epoch.
+# All scores of an epoch decay by the same factor, so their order is the order of the scores decayed to now and an
+# event only adds to the score of its picture. Epochs are TRENDING_EPOCH_DAYS long, which bounds the factor; scores
+# of the previous epoch are converted on the next event (or recompute), older scores have decayed to nothing.
+def _now():
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+def _epoch_seconds():
+    return current_app.config["TRENDING_EPOCH_DAYS"] * 86400
+
+
+def _half_life_seconds():
+    return current_app.config["TRENDING_HALF_LIFE_HOURS"] * 3600
+
+
+def current_epoch(now=None):
+    return int(((now or _now()) - UNIX_EPOCH).total_seconds() // _epoch_seconds())
+
+
+def _growth(now, epoch):
+    # weight of an event at `now` relative to the start of the epoch
+    return 2 ** (((now - UNIX_EPOCH).total_seconds() - epoch * _epoch_seconds()) / _half_life_seconds())
+
+
+def _previous_factor():
+    # a score decayed to the start of the previous epoch, converted to the start of the current one
+    return 2 ** (-_epoch_seconds() / _half_life_seconds())
+
+
+def score_values(kind, count=1):
+    """
+    Column values adding events to the trending score of a picture, computed in SQL - safe with concurrent updates.
+
+    :param kind: "like" or "comment", key of TRENDING_WEIGHTS.
+    :param count: Number of events, negative for removed ones (unlikes).
+    :return: Dictionary for Query.update().
+    """
+    now = _now()
+    epoch = current_epoch(now)
+    decayed = db.case((Picture.trending_epoch == epoch, Picture.trending_score),
+                      (Picture.trending_epoch == epoch - 1, Picture.trending_score * _previous_factor()),
+                      else_=0.0)
+    weight = current_app.config["TRENDING_WEIGHTS"][kind] * count
+    return {"trending_score": decayed + weight * _growth(now, epoch), "trending_epoch": epoch}
+
+
+def add_score(picture, kind, count=1):
+    """
+    Adds events to the trending score of a picture, written with the picture's next flush.
+
+    :param picture: Picture object.
+    """
+    for name, value in score_values(kind, count).items():
+        setattr(picture, name, value)
+
+
+def _events(since):
+    # (picture ID, seconds since the Unix epoch, weight) of likes and comments of pictures since the datetime
+    weights = current_app.config["TRENDING_WEIGHTS"]
+    likes = db.session.query(Like.picture_id, Like.date_created).filter(
+        Like.picture_id.isnot(None), Like.date_created >= since)
+    comments = db.session.query(Comment.picture_id, Comment.date_created).filter(
+        Comment.deleted.isnot(True), Comment.date_created >= since)
+    for kind, query in (("like", likes), ("comment", comments)):
+        for picture_id, created in query.yield_per(10000):
+            yield picture_id, (created - UNIX_EPOCH).total_seconds(), weights[kind]
+
+
+def _sum_scores(events, start):
+    """
+    Sums the weighted, time-decayed events per picture - vectorized if NumPy is installed.
+
+    :param events: List of (picture ID, seconds since the Unix epoch, weight).
+    :param start: Start of the epoch the scores are decayed to, seconds since the Unix epoch.
+    :return: Dictionary of picture ID to score.
+    """
+    half_life = _half_life_seconds()
+    try:
+        import numpy
+    except ImportError:
+        scores = {}
+        for picture_id, seconds, weight in events:
+            scores[picture_id] = scores.get(picture_id, 0.0) + weight * 2 ** ((seconds - start) / half_life)
+        return scores
+    if not events:
+        return {}
+    picture_ids, seconds, weights = (numpy.array(column) for column in zip(*events))
+    unique_ids, positions = numpy.unique(picture_ids, return_inverse=True)
+    sums = numpy.bincount(positions, weights=weights * numpy.exp2((seconds - start) / half_life))
+    return dict(zip(unique_ids.tolist(), sums.tolist()))
+
+
+def recompute_scores():
+    """
+    Recomputes all trending scores from the likes and comments of the current and the previous epoch, correcting
+    the drift of the incremental updates (removed comments, pictures of deleted likes) and converting scores of the
+    previous epoch. Events recorded while it runs are only counted by the next recompute. Runs every
+    TRENDING_RECOMPUTE_SECONDS in one process of the host.
+
+    :return: Number of pictures with a score.
+    """
+    epoch = current_epoch()
+    start = epoch * _epoch_seconds()
+    events = list(_events(UNIX_EPOCH + dt.timedelta(seconds=start - _epoch_seconds())))
+    scores = _sum_scores(events, start)
+    # one transaction - readers see the old scores until the new ones are committed
+    db.session.query(Picture).filter(Picture.trending_score != 0).update(
+        {"trending_score": 0.0, "trending_epoch": epoch}, synchronize_session=False)
+    if scores:
+        db.session.execute(db.update(Picture), [{"id": picture_id, "trending_score": score, "trending_epoch": epoch}
+                                                for picture_id, score in scores.items()])
+    db.session.commit()
+    return len(scores)
+
+
+### TOP-K CACHE ###
+def _load_ranked():
+    """
+    The TRENDING_TOP_K pictures with the highest scores, without private pictures and pictures of deleted users. The
+    best of each of the two live epochs are read through the (trending_epoch, trending_score) index and merged.
+
+    :return: List of (score, picture ID, author ID), best first.
+    """
+    limit = current_app.config["TRENDING_TOP_K"]
+    epoch = current_epoch()
+    candidates = []
+    for live_epoch, factor in ((epoch, 1.0), (epoch - 1, _previous_factor())):
+        rows = db.session.query(Picture.trending_score, Picture.id, Picture.author_id).join(
+            User, User.id == Picture.author_id).filter(
+            Picture.trending_epoch == live_epoch, Picture.trending_score > 0, Picture.private.isnot(True),
+            User.deleted.isnot(True)).order_by(Picture.trending_score.desc()).limit(limit)
+        candidates.extend((score * factor, picture_id, author_id) for score, picture_id, author_id in rows)
+    return heapq.nlargest(limit, candidates)
+
+
+def ranked_pictures():
+    """
+    Ranked pictures of the explore page, cached per worker for TRENDING_CACHE_SECONDS.
+
+    :return: Tuple (list of (score, picture ID, author ID) best first, list of their (-score, -ID) sort keys).
+    """
+    cache = current_app.extensions["trending"]
+    with cache["lock"]:
+        if cache["expires"] > time.monotonic():
+            return cache["ranked"], cache["keys"]
+    ranked = _load_ranked()
+    keys = [(-score, -picture_id) for score, picture_id, _ in ranked]
+    with cache["lock"]:
+        cache.update(ranked=ranked, keys=keys, expires=time.monotonic() + current_app.config["TRENDING_CACHE_SECONDS"])
+    return ranked, keys
+
+
+def trending_cursor(score, picture_id):
+    """
+    Position of a picture on the explore page, "<score>_<picture_id>".
+    """
+    return f"{score!r}_{picture_id}"
+
+
+def _hidden_authors(user):
+    # the user, users they blocked and users who blocked them
+    rows = db.session.query(blocked.c.blocked_id, blocked.c.blocker_id).filter(
+        db.or_(blocked.c.blocker_id == user.id, blocked.c.blocked_id == user.id))
+    return {user.id} | {user_id for row in rows for user_id in row}
+
+
+def trending_pictures(user, cursor=None):
+    """
+    Provides pictures of the explore page, highest trending score first. Pages are selected by keyset pagination
+    over the cached ranking - the page continues after the cursor of the last shown picture, even if the ranking
+    was refreshed in the meantime. Pictures of the user and of blocked users are skipped.
+
+    :param user: User viewing the page.
+    :param cursor: Cursor of the last shown picture, see trending_cursor, None for the first page.
+    :return: Tuple (list of up to PAGE_SIZE pictures, cursor of the last one or None).
+    """
+    ranked, keys = ranked_pictures()
+    position = 0
+    if cursor:
+        try:
+            score, picture_id = cursor.rsplit("_", 1)
+            score, picture_id = float(score), int(picture_id)
+        except ValueError:
+            abort(400, "Invalid cursor.")
+        if not math.isfinite(score):
+            abort(400, "Invalid cursor.")
+        position = bisect_right(keys, (-score, -picture_id))
+    hidden = _hidden_authors(user)
+    pictures = []
+    next_cursor = None
+    while len(pictures) < PAGE_SIZE and position < len(ranked):
+        batch = []
+        while len(batch) < PAGE_SIZE - len(pictures) and position < len(ranked):
+            score, picture_id, author_id = ranked[position]
+            position += 1
+            if author_id not in hidden:
+                batch.append(picture_id)
+            next_cursor = trending_cursor(score, picture_id)
+        # pictures made private or deleted since the ranking was cached are skipped as well
+        loaded = {picture.id: picture for picture in Picture.query.filter(
+            Picture.id.in_(batch), Picture.private.isnot(True)).options(*gallery_options())} if batch else {}
+        pictures.extend(loaded[picture_id] for picture_id in batch if picture_id in loaded)
+    return pictures, next_cursor if pictures else None
+
+
+### CLI ###
+@trending_cli.command("recompute")
+def recompute_command():
+    """Recompute trending scores from likes and comments."""
+    print(f"{recompute_scores()} pictures scored")
+
+
+def init_trending(app):
+    """
+    Configures trending scores of the explore page. A like or comment adds TRENDING_WEIGHTS[kind] to the score of its
+    picture, halving every TRENDING_HALF_LIFE_HOURS.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("TRENDING_WEIGHTS", {"like": 1.0, "comment": 3.0})
+    app.config.setdefault("TRENDING_HALF_LIFE_HOURS", 24)
+    app.config.setdefault("TRENDING_EPOCH_DAYS", 7)
+    app.config.setdefault("TRENDING_TOP_K", 500)
+    app.config.setdefault("TRENDING_CACHE_SECONDS", 60)
+    app.config.setdefault("TRENDING_RECOMPUTE_SECONDS", 3600)
+    app.extensions["trending"] = {"lock": Lock(), "ranked": [], "keys": [], "expires": 0.0}
+    # every recompute rewrites the scores of all pictures - one process does it, not every worker
+    every(app, app.config["TRENDING_RECOMPUTE_SECONDS"], recompute_scores, single=True)
+    app.cli.add_command(trending_cli)
@@ -0,0 +1,376 @@
+from flask import Blueprint, current_app, request, abort, url_for
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException, ClientDisconnected
+from functools import wraps
+from . import db
+from .models import ChunkedUpload
+from .api import token_required, http_error
+from .cache import LRUCache, invalidate_user
+from .helpers import upload_file, create_picture, create_story, sniff_image, SNIFF_BYTES
+from .tasks import every
+import base64
+import binascii
+import datetime as dt
+import hashlib
+import json
+import os
+import secrets
+
+
+# resumable uploads following the tus protocol (https://tus.io/protocols/resumable-upload) - a client creates an
+# upload with POST, sends the file in PATCH chunks and after a broken connection asks with HEAD where to continue
+uploads = Blueprint("uploads", __name__)
+uploads.register_error_handler(HTTPException, http_error)
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,expiration,termination,checksum"
+CHECKSUM_ALGORITHMS = ("sha1", "sha256", "md5")
+# bytes read from the request and written to disk at once
+BLOCK_SIZE = 64 * 1024
+TIME_SPANS = ("12", "24", "48", "72")
+
+
+class ChecksumMismatch(HTTPException):
+    # status code of the tus checksum extension, unknown to werkzeug
+    code = 460
+    description = "Checksum mismatch."
+
+
+def _now():
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+### PROTOCOL ###
+@uploads.before_request
+def check_version():
+    # clients must send Tus-Resumable - a custom header a cross-site form cannot send without a CORS preflight
+    if request.method != "OPTIONS" and request.headers.get("Tus-Resumable") != TUS_VERSION:
+        abort(412, f"Tus-Resumable: {TUS_VERSION} is required.")
+
+
+@uploads.after_request
+def tus_headers(response):
+    response.headers["Tus-Resumable"] = TUS_VERSION
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+def upload_auth(view):
+    """
+    Browser uploads authenticate with the session cookie, API clients with their bearer token (see api.py).
+    """
+    by_token = token_required(view)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if "Authorization" in request.headers:
+            return by_token(*args, **kwargs)
+        if not current_user.is_authenticated:
+            # 401 instead of the redirect of login_required, upload clients do not follow it
+            abort(401, "Log in or send a bearer token.")
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _metadata():
+    """
+    Upload-Metadata header - comma separated "key base64(value)" pairs.
+
+    :return: Dictionary of strings.
+    """
+    metadata = {}
+    for pair in request.headers.get("Upload-Metadata", "").split(","):
+        if not pair.strip():
+            continue
+        key, _, value = pair.strip().partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode() if value else ""
+        except (binascii.Error, UnicodeDecodeError):
+            abort(400, f"Invalid Upload-Metadata value of '{key}'.")
+    return metadata
+
+
+def _form_fields(purpose, metadata):
+    """
+    Validates the metadata like the upload forms validate their fields, before any byte is sent.
+
+    :return: Dictionary stored in ChunkedUpload.meta.
+    """
+    filename = metadata.get("filename", "")
+    if filename and os.path.splitext(filename)[1].lower() not in (".jpg", ".jpeg", ".png"):
+        abort(415, "File was not accepted. Please upload images only.")
+    fields = {"filename": filename}
+    if purpose == "picture":
+        if not 1 <= len(metadata.get("description", "")) <= 750:
+            abort(400, "'description' of 1 to 750 characters is required.")
+        fields.update(description=metadata["description"], private=metadata.get("private") == "true",
+                      location=metadata.get("location") == "true")
+    elif purpose == "story":
+        if metadata.get("time_span") not in TIME_SPANS:
+            abort(400, f"'time_span' must be one of {', '.join(TIME_SPANS)}.")
+        fields["time_span"] = int(metadata["time_span"])
+    return fields
+
+
+### STORAGE ###
+def _part_path(upload_id):
+    return os.path.join(current_app.config["UPLOAD_TEMP_DIR"], f"{upload_id}.part")
+
+
+def _own_upload(upload_id):
+    # the upload of the current user, locked for the request - concurrent PATCHes of one upload wait
+    upload = ChunkedUpload.query.filter_by(id=upload_id, user_id=current_user.id).with_for_update().first()
+    if upload is None or upload.expires_at < _now():
+        abort(404, "Upload not found.")
+    return upload
+
+
+def _hasher(upload):
+    """
+    sha256 of the bytes received so far. Kept per worker between the chunks, a worker which did not see the
+    previous chunks (or was restarted) hashes the part file once.
+
+    :return: Copy of the running hash object - the cached one is replaced only when the chunk is accepted.
+    """
+    cached = current_app.extensions["uploads"]["hashers"].get(upload.id)
+    if cached is not None and cached[0] == upload.offset:
+        return cached[1].copy()
+    hasher = hashlib.sha256()
+    with open(_part_path(upload.id), "rb") as file:
+        remaining = upload.offset
+        while remaining:
+            block = file.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def _chunk_checksum():
+    # Upload-Checksum: "<algorithm> <base64 digest>" of the chunk, optional
+    value = request.headers.get("Upload-Checksum")
+    if not value:
+        return None
+    algorithm, _, digest = value.partition(" ")
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        abort(400, f"Unsupported checksum algorithm, use one of {', '.join(CHECKSUM_ALGORITHMS)}.")
+    try:
+        return algorithm, base64.b64decode(digest, validate=True)
+    except binascii.Error:
+        abort(400, "Invalid Upload-Checksum.")
+
+
+def _discard(upload):
+    current_app.extensions["uploads"]["hashers"].delete(upload.id)
+    try:
+        os.remove(_part_path(upload.id))
+    except FileNotFoundError:
+        pass
+    db.session.delete(upload)
+    db.session.commit()
+
+
+def write_chunk(upload):
+    """
+    Streams the request body to the part file at the upload's offset, block by block - the chunk is never held in
+    memory. The running hash is updated and the image type sniffed as soon as SNIFF_BYTES are on disk. If the
+    client disconnects, the bytes received until then are kept and the client resumes after them.
+
+    :return: Tuple (new offset, running hash).
+    """
+    checksum = _chunk_checksum()
+    chunk_hash = hashlib.new(checksum[0]) if checksum else None
+    hasher = _hasher(upload)
+    offset = upload.offset
+    with open(_part_path(upload.id), "r+b") as file:
+        file.seek(offset)
+        try:
+            while True:
+                block = request.stream.read(BLOCK_SIZE)
+                if not block:
+                    break
+                if offset + len(block) > upload.length:
+                    file.truncate(upload.offset)
+                    abort(413, "The chunk exceeds Upload-Length.")
+                file.write(block)
+                offset += len(block)
+                hasher.update(block)
+                if chunk_hash:
+                    chunk_hash.update(block)
+                if upload.image_type is None and offset >= min(SNIFF_BYTES, upload.length):
+                    file.flush()
+                    with open(_part_path(upload.id), "rb") as head:
+                        upload.image_type = sniff_image(head.read(SNIFF_BYTES))
+                    if upload.image_type is None:
+                        # rejected after the first bytes, not after the whole file was sent
+                        _discard(upload)
+                        abort(415, "File was not accepted. Please upload images only.")
+        except ClientDisconnected:
+            if chunk_hash:
+                # a partial chunk cannot be verified against the checksum of the whole chunk
+                file.truncate(upload.offset)
+                return upload.offset, None
+            return offset, hasher
+        if chunk_hash and chunk_hash.digest() != checksum[1]:
+            file.truncate(upload.offset)
+            raise ChecksumMismatch()
+    return offset, hasher
+
+
+def finish_upload(upload):
+    """
+    Hands the assembled file to the flow of the upload form it replaces - the picture, story or avatar is created
+    exactly as if the file was posted at once.
+
+    :return: URL of the created picture, story or profile.
+    """
+    fields = json.loads(upload.meta)
+    filename = fields.get("filename") or f"upload.{'jpg' if upload.image_type == 'jpeg' else 'png'}"
+    filepath = None
+    try:
+        filepath = upload_file(_part_path(upload.id), current_user.username, filename)
+        if upload.purpose == "picture":
+            picture = create_picture(current_user, filepath, fields["description"], fields["private"],
+                                     fields["location"])
+            return url_for("views.view_picture", id=picture.id)
+        if upload.purpose == "story":
+            create_story(current_user, filepath, fields["time_span"])
+            return url_for("views.home")
+        current_user.avatar = filepath
+        db.session.commit()
+        invalidate_user(current_user.id)
+        return url_for("views.profile", id=current_user.id)
+    except Exception:
+        # the part file may be moved already - the upload could never be resumed, remove it with the moved file
+        db.session.rollback()
+        if filepath and os.path.exists(f"web{filepath}"):
+            os.remove(f"web{filepath}")
+        _discard(upload)
+        raise
+
+
+def _upload_headers(upload):
+    headers = {"Upload-Offset": str(upload.offset), "Upload-Length": str(upload.length),
+               "Upload-Expires": upload.expires_at.strftime("%a, %d %b %Y %H:%M:%S GMT")}
+    if upload.result:
+        # where the client continues once the upload is complete, repeated by HEAD if the response got lost
+        headers["Upload-Result"] = upload.result
+    return headers
+
+
+### ENDPOINTS ###
+@uploads.route("/", methods=["OPTIONS"])
+def capabilities():
+    return "", 204, {"Tus-Version": TUS_VERSION, "Tus-Extension": TUS_EXTENSIONS,
+                     "Tus-Max-Size": str(current_app.config["UPLOAD_MAX_SIZE"]),
+                     "Tus-Checksum-Algorithm": ",".join(CHECKSUM_ALGORITHMS)}
+
+
+@uploads.route("/", methods=["POST"])
+@upload_auth
+def create_upload():
+    """
+    Creates an upload - Upload-Length is the size of the file, Upload-Metadata the fields of the upload form
+    (purpose: picture, story or avatar, filename, description, private, location, time_span).
+    """
+    length = request.headers.get("Upload-Length", type=int)
+    if length is None or length <= 0:
+        abort(400, "Upload-Length is required.")
+    if length > current_app.config["UPLOAD_MAX_SIZE"]:
+        abort(413, f"Files of at most {current_app.config['UPLOAD_MAX_SIZE']} bytes are accepted.")
+    metadata = _metadata()
+    purpose = metadata.get("purpose", "picture")
+    if purpose not in ("picture", "story", "avatar"):
+        abort(400, "'purpose' must be picture, story or avatar.")
+    upload = ChunkedUpload(id=secrets.token_urlsafe(16), user_id=current_user.id, purpose=purpose,
+                           meta=json.dumps(_form_fields(purpose, metadata)), length=length, offset=0,
+                           expires_at=_now() + dt.timedelta(hours=current_app.config["UPLOAD_EXPIRE_HOURS"]))
+    os.makedirs(current_app.config["UPLOAD_TEMP_DIR"], exist_ok=True)
+    open(_part_path(upload.id), "wb").close()
+    db.session.add(upload)
+    db.session.commit()
+    return "", 201, {"Location": url_for("uploads.upload_status", upload_id=upload.id), **_upload_headers(upload)}
+
+
+@uploads.route("/<upload_id>", methods=["HEAD"])
+@upload_auth
+def upload_status(upload_id):
+    """
+    Offset to resume the upload from.
+    """
+    return "", 200, _upload_headers(_own_upload(upload_id))
+
+
+@uploads.route("/<upload_id>", methods=["PATCH"])
+@upload_auth
+def upload_chunk(upload_id):
+    """
+    Appends a chunk at Upload-Offset. The last chunk creates the picture, story or avatar.
+    """
+    upload = _own_upload(upload_id)
+    if request.mimetype != "application/offset+octet-stream":
+        abort(415, "Content-Type must be application/offset+octet-stream.")
+    if request.headers.get("Upload-Offset", type=int) != upload.offset:
+        abort(409, f"Upload-Offset must be {upload.offset}.")
+    if upload.result:
+        abort(409, "The upload is complete.")
+    offset, hasher = write_chunk(upload)
+    hashers = current_app.extensions["uploads"]["hashers"]
+    upload.offset = offset
+    if hasher is not None:
+        hashers.set(upload.id, (offset, hasher))
+    if offset == upload.length:
+        upload.checksum = hasher.hexdigest()
+        hashers.delete(upload.id)
+        upload.result = finish_upload(upload)
+    db.session.commit()
+    return "", 204, _upload_headers(upload)
+
+
+@uploads.route("/<upload_id>", methods=["DELETE"])
+@upload_auth
+def delete_upload(upload_id):
+    _discard(_own_upload(upload_id))
+    return "", 204
+
+
+### CLEANUP ###
+def expire_uploads():
+    """
+    Removes uploads past their expiry, completed or not, and their part files. Runs every hour.
+
+    :return: Number of removed uploads.
+    """
+    expired = ChunkedUpload.query.filter(ChunkedUpload.expires_at < _now()).all()
+    for upload in expired:
+        _discard(upload)
+    return len(expired)
+
+
+def discard_uploads(user_id):
+    """
+    Removes all uploads of a user, called by the account deletion.
+
+    :return: Number of removed uploads.
+    """
+    own = ChunkedUpload.query.filter_by(user_id=user_id).all()
+    for upload in own:
+        _discard(upload)
+    return len(own)
+
+
+def init_uploads(app):
+    """
+    Registers the resumable uploads under /uploads. Part files are kept in UPLOAD_TEMP_DIR, unfinished uploads
+    expire after UPLOAD_EXPIRE_HOURS. Every PATCH is limited by MAX_CONTENT_LENGTH, the whole file by
+    UPLOAD_MAX_SIZE.
+
+    :param app: Flask application.
+    """
+    app.config.setdefault("UPLOAD_TEMP_DIR", "upload-parts")
+    app.config.setdefault("UPLOAD_MAX_SIZE", 50 * 1024 * 1024)
+    app.config.setdefault("UPLOAD_EXPIRE_HOURS", 24)
+    app.extensions["uploads"] = {"hashers": LRUCache(maxsize=1000, ttl=app.config["UPLOAD_EXPIRE_HOURS"] * 3600)}
+    every(app, 3600, expire_uploads)
+    app.register_blueprint(uploads, url_prefix="/uploads")
@@ -1,26 +1,48 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, g
-from flask_login import login_required, current_user
-from .models import User, Picture, Comment, Like, Story, Notification, UserMessage
-from . import db, mail
+from flask import Blueprint, render_template, request, flash, redirect, url_for, g, session
+from flask_login import login_required, current_user, logout_user
+from .models import User, Picture, Comment, Notification, UserMessage, Bookmark
+from . import db
 import os
-from flask_mail import Message
 from werkzeug.urls import url_parse
 from re import search as searchtext
 import datetime as dt
-from operator import itemgetter
+from .cache import invalidate_user
+from .mailer import queue_report
+from .deletion import start_deletion
+from .counters import record_like
+from .polling import next_poll, render_poller
+from .replicas import read_only
+from .trending import add_score, trending_pictures
+from .ranking import feed_mode, ranked_posts
+from .transfer import fragment_etag, conditional, picture_states
 from .forms import UploadForm, SettingsForm, CommentForm, StoryForm, DeleteForm, SearchForm, MessageForm
 from .helpers import (
+    active_user_or_404,
+    visible_picture_or_404,
     upload_file,
+    create_picture,
+    create_story,
     follow_user,
     followed_posts,
     recommended_follow_you,
     recommended_by_followed,
     followed_stories,
-    delete_user,
     block_user,
     block_guard,
-    get_location,
-    mark_as_seen
+    mark_as_seen,
+    read_up_to,
+    conversation_state,
+    conversation_messages,
+    notification_watermark,
+    CHAT_PAGE_SIZE,
+    profile_pictures,
+    bookmarked_pictures,
+    picture_page,
+    comment_page,
+    liked_comment_ids,
+    picture_likers,
+    add_like,
+    remove_like
 )
 
 
@@ -29,44 +51,78 @@ views = Blueprint("views", __name__)
 
 
 ### BEFORE REQUEST ###
+def request_kind():
+    """
+    Classifies the current request by what it renders.
+
+    :return: "static" for static files, "fragment" for HTMX requests (they never render the navbar), "page" otherwise.
+    """
+    if request.endpoint == "static":
+        return "static"
+    if "HX-Request" in request.headers:
+        return "fragment"
+    return "page"
+
+
 @views.before_app_request
 def before_request():
+    # navbar context only for full pages - static files do not even load the logged in user
+    if request_kind() != "page":
+        return
     if current_user.is_authenticated:
         g.search_form = SearchForm()
-        g.notifications_received = current_user.notification_received.order_by(Notification.timestamp.desc())
 
 
 ### CUSTOM PAGINATION ###
 @views.route('/load-page/<int:id>/<int:page>')
 @login_required
+@read_only
 def load_page(id, page):
     # pagination function called by HTMX every 6 pictures
-    # loaded pictures sliced in jinja [page:page+6]
-    # each iteration the page value is increased by 6
+    # each iteration the page value is increased by 6 and the next 6 pictures are loaded from the DB
+    # an unchanged page (same pictures in the same versions) is answered with 304 without rendering it
     new_page = page + 6
-    # if function called from homepage
+    # if function called from homepage - the ranked feed continues in the ranking cached under the feed token
     if url_parse(request.referrer).path in ("/", "/home"):
-        pictures = followed_posts()
-        return render_template("home-feed.html", pictures=pictures, page=new_page)
+        feed_token = None
+        if request.args.get("feed"):
+            pictures, feed_token = ranked_posts(current_user, new_page, request.args.get("feed"))
+        else:
+            pictures = followed_posts(new_page)
+        # post footers show the likes and the bookmark state
+        etag = fragment_etag("home-feed", new_page, feed_token, picture_states(pictures, with_likes=True),
+                             tuple(sorted(current_user.bookmarked_ids() & {picture.id for picture in pictures})))
+        return conditional(etag, lambda: render_template("home-feed.html", pictures=pictures, page=new_page,
+                                                         feed_token=feed_token))
     # if function called from profile view
     if searchtext("profile", url_parse(request.referrer).path):
-        user = User.query.filter_by(id=id).first_or_404()
-        pictures = Picture.query.filter_by(author_id=id).order_by(Picture.date_created.desc()).all()
-    # if function called from bookmarks view
+        user = active_user_or_404(id)
+        pictures = profile_pictures(id, new_page)
+    # if function called from bookmarks view - keyset pagination continues after the cursor of the last bookmark
+    cursor = None
     if searchtext("bookmarked", url_parse(request.referrer).path):
-        user = User.query.filter_by(id=id).first_or_404()
-        pictures = current_user.bookmarks
-    return render_template("gallery-div.html", pictures=pictures, user=user, page=new_page)
+        user = active_user_or_404(id)
+        pictures, cursor = bookmarked_pictures(current_user, request.args.get("cursor"))
+    # if function called from explore view - continues after the cursor of the last trending picture
+    if searchtext("explore", url_parse(request.referrer).path):
+        user = current_user
+        pictures, cursor = trending_pictures(current_user, request.args.get("cursor"))
+    etag = fragment_etag("gallery", user.id, new_page, cursor, picture_states(pictures))
+    return conditional(etag, lambda: render_template("gallery-div.html", pictures=pictures, user=user, page=new_page,
+                                                     cursor=cursor))
 
 
 ### SEARCH ###
 @views.route('/search')
 @login_required
+@read_only
 def search():
     # get page if next/prev url buttons
     page = request.args.get('page', 1, type=int)
     # calls class method
     results, total = User.search(g.search_form.q.data, page, 8)  # 8 results per page
+    # deleted accounts stay in the index until the background job removes them
+    results = results.filter(User.deleted.isnot(True))
     next_url = url_for('views.search', q=g.search_form.q.data, page=page + 1) if total > page * 8 else None
     prev_url = url_for('views.search', q=g.search_form.q.data, page=page - 1) if page > 1 else None
     return render_template('search.html', results=results, next_url=next_url, prev_url=prev_url)
@@ -76,21 +132,42 @@ def search():
 @views.route("/")
 @views.route("/home")
 @login_required
+@read_only
 def home():
     """
     Renders a page with:
-    1) feed of followed posts with pagination through load_page function
+    1) feed of followed posts with pagination through load_page function - newest first or ranked, see feed_mode
     2) user recommendations -  followed_by_friends, follows_you
     3) feed of stories
     """
+    feed_token = None
+    if feed_mode() == "ranked":
+        pictures, feed_token = ranked_posts(current_user)
+    else:
+        pictures = followed_posts()
+    # like state of all post footers in two queries
+    Picture.load_viewer_likes(pictures)
     return render_template("home.html",
-                           pictures=followed_posts(),
+                           pictures=pictures,
                            page=0,
+                           feed_token=feed_token,
+                           feed_mode=feed_mode(),
                            followed_by_friends=recommended_by_followed(),
                            follows_you=recommended_follow_you(),
                            stories=followed_stories())
 
 
+@views.route("/feed/<mode>")
+@login_required
+def change_feed_mode(mode):
+    """
+    Switches the home feed between "latest" and "ranked", stored in the session.
+    """
+    if mode in ("latest", "ranked"):
+        session["feed_mode"] = mode
+    return redirect(url_for("views.home"))
+
+
 @views.route("/disclaimer")
 @login_required
 def disclaimer():
@@ -109,42 +186,59 @@ def api_docs():
     return render_template("api-docs.html")
 
 
+### EXPLORE PAGE ###
+@views.route("/explore")
+@login_required
+@read_only
+def explore():
+    """
+    Renders a page with trending pictures of all users with pagination through load_page function.
+    """
+    pictures, cursor = trending_pictures(current_user)
+    return render_template("explore.html", pictures=pictures, user=current_user, active=("explore",), page=0,
+                           cursor=cursor)
+
+
 ### PROFILE PAGE ###
 @views.route("/profile/<int:id>")
 @login_required
+@read_only
 def profile(id):
     """
     Renders a page with user pictures with pagination through load_page function.
     """
-    user = User.query.filter_by(id=id).first_or_404()
-    pictures = Picture.query.filter_by(author_id=id).order_by(Picture.date_created.desc()).all()
+    user = active_user_or_404(id)
+    pictures = profile_pictures(id)
     # active parameter says what UI elements should be marked as active
     return render_template("profile.html", pictures=pictures, user=user, active=("profile", "gallery"), page=0)
 
 
 @views.route("/bookmarked/<int:id>")
 @login_required
+@read_only
 def bookmarked(id):
     """
     Renders a page with bookmarked pictures with pagination through load_page function.
     """
-    user = User.query.filter_by(id=id).first_or_404()
+    user = active_user_or_404(id)
     if current_user != user:
         flash("You cannot view saved posts of other users", category="error")
         return redirect(url_for("views.home"))
+    pictures, cursor = bookmarked_pictures(current_user)
     # active parameter says what UI elements should be marked as active
-    return render_template("profile.html", pictures=current_user.bookmarks, user=user, active=("profile", "bookmarks"),
-                           page=0)
+    return render_template("profile.html", pictures=pictures, user=user, active=("profile", "bookmarks"), page=0,
+                           cursor=cursor)
 
 
 ### PICTURE FUNCTIONS ###
 @views.route("/picture/<int:id>", methods=['GET', 'POST'])
 @login_required
+@read_only
 def view_picture(id):
     """
     Renders page with picture view and comments.
     """
-    picture = Picture.query.filter_by(id=id).first_or_404()
+    picture = picture_page(id)
     if block_guard(picture.author_id):
         return redirect(url_for("views.home"))
     form = CommentForm()
@@ -152,6 +246,8 @@ def view_picture(id):
     if form.validate_on_submit():
         comment = Comment(text=form.text.data, author_id=current_user.id, picture_id=picture.id)
         db.session.add(comment)
+        picture.bump_version()
+        add_score(picture, "comment")
         # send a new_notification if commenting pictures of other users
         if picture.author != current_user:
             new_notification = Notification(sender_id=current_user.id,
@@ -164,40 +260,72 @@ def view_picture(id):
         db.session.commit()
         flash("Comment has been posted", category="success")
         return redirect(url_for("views.view_picture", id=picture.id))
-    return render_template("picture.html", form=form, picture=picture)
+    comments, next_before = comment_page(picture.id)
+    return render_template("picture.html", form=form, picture=picture, comments=comments, next_before=next_before,
+                           liked_comments=liked_comment_ids(current_user.id, comments))
+
+
+@views.route("/load-comments/<int:id>")
+@login_required
+@read_only
+def load_comments(id):
+    """
+    Returns the next page of comments when user clicks on "load more" - called by HTMX with the ID of the last shown
+    comment in the "before" parameter.
+    """
+    picture = visible_picture_or_404(id)
+    if block_guard(picture.author_id) or picture.private:
+        return ('', 204)
+    comments, next_before = comment_page(picture.id, request.args.get("before", type=int))
+    return render_template("comments-div.html", picture=picture, comments=comments, next_before=next_before,
+                           liked_comments=liked_comment_ids(current_user.id, comments))
+
+
+def render_picture_likes(picture):
+    # like buttons are rendered in the post footer on the homepage and in the picture view
+    if url_parse(request.referrer).path in ("/", "/home"):
+        return render_template("post-footer.html", picture=picture)
+    return render_template("picture-like.html", picture=picture)
+
+
+@views.route("/picture-likers/<int:id>")
+@login_required
+@read_only
+def likers(id):
+    """
+    Renders the likes dropdown of a picture, loaded by HTMX when it is opened - follow buttons update the post footer
+    on the homepage and the likes section in the picture view.
+    """
+    picture = visible_picture_or_404(id)
+    target = f"#post-footer-{picture.id}" if url_parse(request.referrer).path in ("/", "/home") else "#likes"
+    return render_template("picture-likers.html", picture=picture, users=picture_likers(picture.id), target=target)
 
 
 @views.route("/like-picture/<int:id>")
 @login_required
 def like_picture(id):
     """
-    Creates or deletes a Like object and returns an updated <div>.
+    Likes the picture and returns an updated <div>. Idempotent - a repeated click changes nothing.
     """
-    picture = Picture.query.filter_by(id=id).first_or_404()
-    like = Like.query.filter_by(author_id=current_user.id, picture_id=id).first()
-    # if picture already liked, delete the like
-    if like:
-        db.session.delete(like)
+    picture = visible_picture_or_404(id)
+    if add_like(current_user.id, picture_id=picture.id):
+        # the count and the notification are written behind, the hot picture row is not locked by the request
+        record_like(picture, current_user, 1)
         db.session.commit()
-    # if picture not liked, create a new like object
-    else:
-        like = Like(author_id=current_user.id, picture_id=id)
-        db.session.add(like)
-        # if liking pictures of other users create new_notification
-        if picture.author != current_user:
-            new_notification = Notification(sender_id=current_user.id,
-                                            recipient_id=picture.author_id,
-                                            type="like",
-                                            body=f"{current_user.username} liked your post.",
-                                            link=f'{url_for("views.view_picture", id=picture.id)}'
-                                            )
-            db.session.add(new_notification)
+    return render_picture_likes(picture)
+
+
+@views.route("/unlike-picture/<int:id>")
+@login_required
+def unlike_picture(id):
+    """
+    Removes the like of the picture and returns an updated <div>. Idempotent as well.
+    """
+    picture = visible_picture_or_404(id)
+    if remove_like(current_user.id, picture_id=picture.id):
+        record_like(picture, current_user, -1)
         db.session.commit()
-    # if function called from homepage
-    if url_parse(request.referrer).path in ("/", "/home"):
-        return render_template("post-footer.html", picture=picture)
-    # if function called from pic view
-    return render_template("picture-like.html", picture=picture)
+    return render_picture_likes(picture)
 
 
 @views.route("/bookmark/<int:id>")
@@ -206,12 +334,15 @@ def bookmark_picture(id):
     """
     Adds or removes a Picture object to current_user's bookmarks and returns an updated <div> to HTMX call.
     """
-    picture = Picture.query.filter_by(id=id).first_or_404()
-    if picture in current_user.bookmarks:
-        current_user.bookmarks.remove(picture)
+    picture = visible_picture_or_404(id)
+    # primary key lookup instead of loading all bookmarks of the user
+    bookmark = db.session.get(Bookmark, (current_user.id, picture.id))
+    if bookmark:
+        db.session.delete(bookmark)
     else:
-        current_user.bookmarks.append(picture)
+        db.session.add(Bookmark(user_id=current_user.id, picture_id=picture.id))
     db.session.commit()
+    g.pop("_bookmarked_ids", None)
     # if function called from homepage
     if url_parse(request.referrer).path in ("/", "/home"):
         return render_template("post-footer.html", picture=picture)
@@ -223,20 +354,27 @@ def bookmark_picture(id):
 @login_required
 def like_comment(id):
     """
-    Creates or deletes a Like object and returns an updated <div> to HTMX call.
+    Likes the comment and returns an updated <div> to HTMX call. Idempotent - a repeated click changes nothing.
     """
     comment = Comment.query.filter_by(id=id).first_or_404()
-    like = Like.query.filter_by(author_id=current_user.id, comment_id=id).first()
-    # if comment already liked, delete the like
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-    # if comment not liked yet, create a new like object
-    else:
-        like = Like(author_id=current_user.id, comment_id=id)
-        db.session.add(like)
-        db.session.commit()
-    return render_template("comment-like.html", comment=comment)
+    if add_like(current_user.id, comment_id=comment.id):
+        # incremented in SQL, safe with concurrent likes
+        comment.like_count = Comment.like_count + 1
+    db.session.commit()
+    return render_template("comment-like.html", comment=comment, liked_comments={comment.id})
+
+
+@views.route("/unlike-comment/<int:id>")
+@login_required
+def unlike_comment(id):
+    """
+    Removes the like of the comment and returns an updated <div> to HTMX call.
+    """
+    comment = Comment.query.filter_by(id=id).first_or_404()
+    if remove_like(current_user.id, comment_id=comment.id):
+        comment.like_count = Comment.like_count - 1
+    db.session.commit()
+    return render_template("comment-like.html", comment=comment, liked_comments=set())
 
 
 @login_required
@@ -253,6 +391,7 @@ def change_privacy(id):
         picture.private = False
     else:
         picture.private = True
+    picture.bump_version()
     db.session.commit()
     return redirect(url_for("views.view_picture", id=picture.id))
 
@@ -273,8 +412,8 @@ def delete_picture(id):
         db.session.delete(picture)
         db.session.commit()
         flash("Picture deleted.", category="success")
-    pictures = Picture.query.filter_by(author_id=current_user.id).all()
-    return render_template("profile.html", pictures=pictures, user=current_user, active=("profile", "gallery"), page=0)
+    return render_template("profile.html", pictures=profile_pictures(current_user.id), user=current_user,
+                           active=("profile", "gallery"), page=0)
 
 
 @views.route("/report-picture/<int:id>", methods=["GET", "POST"])
@@ -283,14 +422,11 @@ def report_picture(id):
     """
     Send info to admin that User X reported Picture Y
     """
-    picture = Picture.query.filter_by(id=id).first_or_404()
-    msg = Message(
-        subject="Instaclone - picture reported",
-        body=f"Picture {picture.id} was reported by user {current_user.id}",
-        recipients=[ADMIN]
-    )
-    mail.send(msg)
-    flash('Mail has been sent.', category="success")
+    picture = visible_picture_or_404(id)
+    # admin receives one digest of all reports every MAIL_DIGEST_MINUTES
+    queue_report(f"Picture {picture.id} was reported by user {current_user.id}", ADMIN)
+    db.session.commit()
+    flash('Picture has been reported.', category="success")
     return redirect(url_for("views.home"))
 
 
@@ -302,17 +438,10 @@ def upload():
     Renders page to upload a new picture.
     """
     form = UploadForm()
-    location = ""
     if form.validate_on_submit():
-        # if user wants to share location, get location string
-        if form.location.data is True:
-            location = get_location()
         # create a new object
         filepath = upload_file(form.file.data, current_user.username)
-        picture = Picture(description=form.description.data, location=location,
-                          private=form.private.data, file=filepath, author=current_user)
-        db.session.add(picture)
-        db.session.commit()
+        create_picture(current_user, filepath, form.description.data, form.private.data, form.location.data is True)
         return redirect(url_for("views.profile", id=current_user.id, active=("profile", "gallery")))
     return render_template('upload-pictures.html', form=form, active="upload")
 
@@ -350,11 +479,15 @@ def settings():
         current_user.description = form.description.data
         current_user.not_recommend = form.not_recommend.data
         db.session.commit()
+        invalidate_user(current_user.id)
         return redirect(url_for("views.profile", id=current_user.id, active=("profile", "gallery")))
     # 2) if DeleteForm submitted
     if delete_form.delete.data and delete_form.validate():
         flash("The profile has been deleted.", category="success")
-        delete_user(current_user)
+        # the account is hidden immediately, its data is deleted in the background
+        start_deletion(current_user)
+        invalidate_user(current_user.id)
+        logout_user()
         return redirect(url_for("views.goodbye"))
     if delete_form.errors:
         # modal automatically closes after submission, even if an error was raised by the form and the error is not
@@ -377,59 +510,67 @@ def goodbye():
 @login_required
 def refresh_messages(id):
     """
-    Refreshes messages in the chat window if either user sent a message in the last 2 seconds or returns 204 No Content.
-    Function is called by HTMX every 0.5s. Messages are paginated through load_messages function.
-    """
-    now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
-    two_sec_ago = now - dt.timedelta(seconds=2)
-    user = User.query.filter_by(id=id).first_or_404()
-    if current_user.last_message_sent_time > two_sec_ago or user.last_message_sent_time > two_sec_ago:
-        messages_sent = UserMessage.query.filter_by(sender_id=current_user.id).filter_by(recipient_id=user.id)
-        messages_received = UserMessage.query.filter_by(recipient_id=current_user.id).filter_by(sender_id=user.id)
-        mark_as_seen(messages_received)
-        messages_all = messages_sent.union(messages_received).all()
-        return render_template('messages-div.html', user=user, messages=messages_all, page=0)
-    return ('', 204)
+    Polled by the chat window. Renders the messages again if a new message arrived or the partner read the messages
+    of current_user since the last poll (IDs sent by the poller), otherwise only the poller with a longer delay.
+    """
+    after = request.args.get("after", 0, type=int)
+    seen = request.args.get("seen", 0, type=int)
+    latest_id, read_id = conversation_state(current_user.id, id)
+    changed = latest_id > after or read_id != seen
+    next_poll("messages", changed)
+    if not changed:
+        url = url_for("views.refresh_messages", id=id, after=after, seen=seen, wait=request.args.get("wait", type=int))
+        return render_poller("message-poll", "messages", url)
+    user = active_user_or_404(id)
+    mark_as_seen(current_user.id, user.id)
+
+    def render():
+        messages_all = conversation_messages(current_user.id, user.id, CHAT_PAGE_SIZE + 1)
+        return render_template('messages-div.html', user=user, messages=messages_all, page=0,
+                               read_up_to=read_up_to(current_user.id, user.id))
+    # the rendered messages only change with the latest message and the read receipt
+    response = conditional(fragment_etag("messages", user.id, latest_id, read_id), render)
+    response.headers["HX-Retarget"] = "#message-div"
+    return response
 
 
 @views.route("/load-messages/<int:id>/<int:page>")
 @login_required
+@read_only
 def load_messages(id, page):
     """
     Custom pagination function for chat messages. Function is called by HTMX if user clicks on "load previous" button
     and shows 15 older messages to the user by updating the "page" variable. Messages are sliced in Jinja: [-page-30:]
+    Only the messages shown are loaded, older ones come from the archive when the table has no more of them.
     """
     new_page = page + 15
-    user = User.query.filter_by(id=id).first_or_404()
-    messages_sent = UserMessage.query.filter_by(sender_id=current_user.id).filter_by(recipient_id=user.id)
-    messages_received = UserMessage.query.filter_by(recipient_id=current_user.id).filter_by(sender_id=user.id)
-    messages_all = messages_sent.union(messages_received).all()
-    return render_template('messages-div.html', user=user, messages=messages_all, page=new_page)
+    user = active_user_or_404(id)
+    messages_all = conversation_messages(current_user.id, user.id, new_page + CHAT_PAGE_SIZE + 1)
+    return render_template('messages-div.html', user=user, messages=messages_all, page=new_page,
+                           read_up_to=read_up_to(current_user.id, user.id))
 
 
 @views.route("/chat-central")
 @login_required
+@read_only
 def chat_central():
     """
     Renders a page with all users(=contacts) with chats started with current_user.
     """
-    contacts = {}
-    # find all messages sent by current_user, for each recipient save the latest message (the highest ID)
-    for message in current_user.messages_sent:
-        contacts[message.recipient] = message.id
-        print(contacts)
-    # find all messages received by user
-    for message in current_user.messages_received:
-        # keep only latest message from one message.author
-        if message.author not in contacts:
-            contacts[message.author] = message.id
-        elif contacts[message.author] < message.id:
-            contacts[message.author] = message.id
-        else:
-            pass
-    # sort messages by message.id from newest to oldest, users will see most recent messages on top
-    sorted_contacts = dict(sorted(contacts.items(), key=itemgetter(1), reverse=True))
-    return render_template('chat-central.html', contacts=sorted_contacts)
+    # the other user of every message sent or received by current_user
+    partner_id = db.case((UserMessage.sender_id == current_user.id, UserMessage.recipient_id),
+                         else_=UserMessage.sender_id)
+    # for each contact keep only the latest message (the highest ID)
+    latest = db.session.query(partner_id.label("partner_id"), db.func.max(UserMessage.id).label("message_id")).filter(
+        db.or_(UserMessage.sender_id == current_user.id, UserMessage.recipient_id == current_user.id)).group_by(
+        partner_id).subquery()
+    # sort contacts by message.id from newest to oldest, users will see most recent messages on top
+    contacts = db.session.query(User, latest.c.message_id).join(latest, User.id == latest.c.partner_id).filter(
+        User.deleted.isnot(True)).order_by(latest.c.message_id.desc()).all()
+    sorted_contacts = dict(contacts)
+    # senders of unread messages, marked with "new message" in the contact list
+    unread_from = {message.sender_id for message in current_user.new_messages()}
+    return render_template('chat-central.html', contacts=sorted_contacts, unread_from=unread_from)
 
 
 @views.route("/chat/<int:id>", methods=["POST", "GET"])
@@ -439,13 +580,9 @@ def chat(id):
     Renders a chatting window.
     """
     form = MessageForm()
-    user = User.query.filter_by(id=id).first_or_404()
-    messages_sent = UserMessage.query.filter_by(sender_id=current_user.id).filter_by(recipient_id=user.id)
-    messages_received = UserMessage.query.filter_by(recipient_id=current_user.id).filter_by(sender_id=user.id)
+    user = active_user_or_404(id)
     # mark received messages as seen
-    mark_as_seen(messages_received)
-    # combine sent and received messages
-    messages_all = messages_sent.union(messages_received).all()
+    mark_as_seen(current_user.id, user.id)
     if form.validate_on_submit() and block_guard(id) is False:
         # create a new message object
         message = UserMessage(author=current_user, recipient=user, body=form.text.data)
@@ -453,18 +590,33 @@ def chat(id):
         # update time of last sent message, used in refresh_messages function
         current_user.last_message_sent_time = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
         db.session.commit()
+        invalidate_user(current_user.id)
         # clear the form input
         form.text.data = ""
-    return render_template('chat-window.html', form=form, user=user, messages=messages_all, page=0)
+    # newest messages of both users, including the one just sent
+    messages_all = conversation_messages(current_user.id, user.id, CHAT_PAGE_SIZE + 1)
+    return render_template('chat-window.html', form=form, user=user, messages=messages_all, page=0,
+                           read_up_to=read_up_to(current_user.id, user.id))
 
 
 @views.route('/messages')
 @login_required
+@read_only
 def messages():
     """
-    answers to htmx call with updated navbar message icon
+    Polled by the navbar message icon. Renders the icon again if the number of unread messages changed, otherwise
+    only the poller with a longer delay.
     """
-    return render_template('new-messages.html')
+    unread = request.args.get("unread", 0, type=int)
+    new_messages = current_user.new_messages()
+    changed = len(new_messages) != unread
+    next_poll("inbox", changed)
+    if not changed:
+        return render_poller("inbox-poll", "inbox", url_for("views.messages", unread=unread))
+    etag = fragment_etag("inbox", tuple(sorted(message.id for message in new_messages)))
+    response = conditional(etag, lambda: render_template('new-messages.html'))
+    response.headers["HX-Retarget"] = "#new-messages"
+    return response
 
 
 ### STORIES ###
@@ -477,9 +629,7 @@ def upload_story():
     form = StoryForm()
     if form.validate_on_submit():
         filepath = upload_file(form.file.data, current_user.username)
-        story = Story(time_span=form.time_span.data, file=filepath, author=current_user)
-        db.session.add(story)
-        db.session.commit()
+        create_story(current_user, filepath, form.time_span.data)
         return redirect(url_for("views.home"))
     return render_template('upload-story.html', form=form)
 
@@ -546,19 +696,19 @@ def followers_update(user_id, id):
     db.session.commit()
     # if function called from profile view
     if searchtext("bookmarked", url_parse(request.referrer).path):
-        user = User.query.filter_by(id=id).first_or_404()
+        user = active_user_or_404(id)
         return render_template("profile-header.html", user=user, active=("profile", "bookmarks"))
     # if function called from profile view
     if searchtext("profile", url_parse(request.referrer).path):
-        user = User.query.filter_by(id=id).first_or_404()
+        user = active_user_or_404(id)
         return render_template("profile-header.html", user=user, active=("profile", "gallery"))
     # if function called from pic view
     if searchtext("picture", url_parse(request.referrer).path):
-        picture = Picture.query.filter_by(id=id).first_or_404()
+        picture = visible_picture_or_404(id)
         return render_template("picture-followers-div.html", picture=picture)
     # if function called from homepage view
     if url_parse(request.referrer).path in ("/", "/home"):
-        picture = Picture.query.filter_by(id=id).first_or_404()
+        picture = visible_picture_or_404(id)
         return render_template("post-footer.html", picture=picture)
 
 
@@ -567,12 +717,25 @@ def followers_update(user_id, id):
 @login_required
 def notification(status):
     """
-    HTMX calls this function every 60 s to check for new notifications. Function returns an updated <div> which
-    automatically calls User.new_notifications(). When user clicks to see their notifications, the function is called
-    with status "read" and the last_notification_read_time of the current user is updated.
+    Polled by the navbar with status "noread" - renders the notifications again if the number of new notifications
+    changed, otherwise only the poller with a longer delay. When user clicks to see their notifications, the function
+    is called with status "read" and the last_notification_read_time of the current user is updated.
     """
     if status == "read":
         current_user.last_notification_read_time = dt.datetime.now(dt.timezone.utc)
         db.session.commit()
+        invalidate_user(current_user.id)
         return render_template('notification-icon.html')
-    return render_template('notifications.html')
\ No newline at end of file
+    count = request.args.get("count", type=int)
+    new_count = current_user.new_notifications()
+    changed = new_count != count
+    next_poll("notifications", changed)
+    if not changed:
+        return render_poller("notification-poll", "notifications",
+                             url_for("views.notification", status="noread", count=count))
+    # the drop-down shows the latest notifications - they change only with the newest one or the read time
+    etag = fragment_etag("notifications", new_count, notification_watermark(current_user.id),
+                         current_user.last_notification_read_time)
+    response = conditional(etag, lambda: render_template('notifications.html'))
+    response.headers["HX-Retarget"] = "#notifications"
+    return response